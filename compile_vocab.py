@@ -0,0 +1,41 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Writes the compiled copy of a vocab file that `FullTokenizer` loads."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tokenization
+import tensorflow as tf
+
+flags = tf.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("vocab_file", None,
+                    "The vocabulary file that the BERT model was trained on.")
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  compiled_vocab_file = tokenization.compile_vocab(FLAGS.vocab_file)
+  tf.logging.info("Wrote %s", compiled_vocab_file)
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("vocab_file")
+  tf.app.run()
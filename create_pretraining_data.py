@@ -18,9 +18,19 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import array
 import collections
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
 import random
+import shutil
+import struct
+import tempfile
 
+import numpy as np
 import tokenization
 import tensorflow as tf
 
@@ -35,6 +45,26 @@ flags.DEFINE_string(
     "output_file", None,
     "Output TF example file (or comma-separated list of files).")
 
+flags.DEFINE_string(
+    "output_dir", None,
+    "If set instead of `output_file`, every input file is turned into its own "
+    "output TF example file in this directory, with a random seed derived "
+    "from `random_seed` and the input file name, and a manifest of the "
+    "number of examples in every output file is written. The output does not "
+    "depend on `num_workers`.")
+
+flags.DEFINE_integer(
+    "num_workers", 1,
+    "Only used with `output_dir`. Number of processes that input files are "
+    "distributed to.")
+
+flags.DEFINE_bool(
+    "resume", False,
+    "Only used with `output_dir`. Whether to skip the input files whose "
+    "output file was already completed with the same input file, vocab and "
+    "settings, e.g. to continue an interrupted run or to add new input "
+    "files to an existing output directory.")
+
 flags.DEFINE_string("vocab_file", None,
                     "The vocabulary file that the BERT model was trained on.")
 
@@ -61,28 +91,143 @@ flags.DEFINE_float(
     "Probability of creating sequences which are shorter than the "
     "maximum length.")
 
+flags.DEFINE_integer(
+    "streaming_window_size", 0,
+    "If > 0, documents are read, shuffled and turned into instances in "
+    "windows of this many documents, and instances are written as soon as "
+    "their window is done. Memory use then does not grow with the corpus "
+    "size, but instances are only shuffled within a window.")
+
+flags.DEFINE_integer(
+    "random_document_pool_size", 10000,
+    "Only used if `streaming_window_size` > 0. Number of documents from "
+    "earlier windows kept as a uniform random sample, which \"random next\" "
+    "sentences are drawn from along with the current window.")
+
+flags.DEFINE_bool(
+    "batch_masking", False,
+    "Whether to create the masked LM predictions of many instances at once "
+    "with NumPy. The predictions follow the same distribution as the default "
+    "per-instance masking, but use a different random number stream.")
+
+flags.DEFINE_bool(
+    "dynamic_masking", False,
+    "Whether to write examples without masked LM predictions, to be masked "
+    "while training by `run_pretraining.py --dynamic_masking`. Since every "
+    "epoch is then masked differently, `dupe_factor` can usually be 1.")
+
+flags.DEFINE_integer(
+    "shuffle_buckets", 0,
+    "Only used if `streaming_window_size` > 0. If > 0, all instances are "
+    "shuffled through this many temporary files on disk before being "
+    "written, so the output is shuffled globally without holding every "
+    "instance in memory. Each temporary file has to fit in memory. Only one "
+    "file is open at a time, so this is not limited by the number of open "
+    "files.")
+
+flags.DEFINE_string(
+    "shuffle_temp_dir", None,
+    "Local directory for the temporary files of `shuffle_buckets`. Defaults "
+    "to the system temporary directory.")
+
+flags.DEFINE_string(
+    "token_cache_dir", None,
+    "If set, the tokenized input files are cached in this local directory "
+    "and reused by later runs with the same input files, vocab and "
+    "`do_lower_case`.")
+
+flags.DEFINE_string(
+    "tfrecord_compression_type", "",
+    "Compression type of the output files: \"\" (none), \"GZIP\" or "
+    "\"ZLIB\". Pass the same value to `run_pretraining.py`.")
+
+flags.DEFINE_bool(
+    "unpadded_records", False,
+    "Whether to write only the real tokens and masked LM predictions of every "
+    "example, without padding. Pass the same value to `run_pretraining.py`.")
+
+flags.DEFINE_integer(
+    "max_sequences_per_pack", 0,
+    "If > 0, instances are packed into rows of up to `max_seq_length` tokens "
+    "with at most this many instances each, which attend only to themselves. "
+    "Pass the same value to `run_pretraining.py`.")
+
+flags.DEFINE_string(
+    "masking_strategy", "token",
+    "How the masked LM positions are chosen: \"token\" masks single word "
+    "pieces, \"whole_word\" masks all the word pieces of a word together "
+    "and \"span\" masks spans of whole words with geometrically "
+    "distributed lengths.")
+
+flags.DEFINE_integer(
+    "max_span_length", 10,
+    "The maximum number of words in a span of `masking_strategy=span`.")
+
+flags.DEFINE_float(
+    "span_geometric_p", 0.2,
+    "The parameter of the geometric distribution of the span lengths of "
+    "`masking_strategy=span`, whose mean is 1 / `span_geometric_p` words "
+    "before clipping to `max_span_length`.")
+
+flags.DEFINE_bool(
+    "indexed_documents", False,
+    "Whether to access the documents through an index over the memory-mapped "
+    "token cache instead of loading them into memory. Requires "
+    "`token_cache_dir` and cannot be combined with `streaming_window_size`.")
+
+flags.DEFINE_bool(
+    "weight_documents_by_length", False,
+    "Whether the documents of \"random next\" sentences are drawn with a "
+    "probability proportional to their number of word pieces instead of "
+    "uniformly. Requires `indexed_documents`.")
+
+flags.DEFINE_bool(
+    "fast_serialization", False,
+    "Whether to write the TF examples in the protocol buffer wire format "
+    "directly instead of building `tf.train.Example` protos. The output is "
+    "the same as deterministic proto serialization, with the features "
+    "sorted by name.")
+
+flags.DEFINE_bool(
+    "dry_run", False,
+    "Whether to only log statistics of the output (number of instances, "
+    "padding, masked LM predictions, truncation, output size and bucket "
+    "boundaries for `run_pretraining.py`), estimated from a sample of the "
+    "documents, without writing anything. Packing is not taken into "
+    "account.")
+
+flags.DEFINE_float(
+    "dry_run_sample_rate", 0.1,
+    "The fraction of the documents sampled by `dry_run`.")
+
 
 class TrainingInstance(object):
-  """A single training instance (sentence pair)."""
+  """A single training instance (sentence pair).
 
-  def __init__(self, tokens, segment_ids, masked_lm_positions, masked_lm_labels,
-               is_random_next):
-    self.tokens = tokens
+  All fields are compact integer arrays of word piece ids, positions and
+  segment ids rather than lists of Python objects.
+  """
+
+  __slots__ = ("input_ids", "segment_ids", "masked_lm_positions",
+               "masked_lm_ids", "is_random_next")
+
+  def __init__(self, input_ids, segment_ids, masked_lm_positions,
+               masked_lm_ids, is_random_next):
+    self.input_ids = input_ids
     self.segment_ids = segment_ids
     self.is_random_next = is_random_next
     self.masked_lm_positions = masked_lm_positions
-    self.masked_lm_labels = masked_lm_labels
+    self.masked_lm_ids = masked_lm_ids
 
   def __str__(self):
     s = ""
-    s += "tokens: %s\n" % (" ".join(
-        [tokenization.printable_text(x) for x in self.tokens]))
+    s += "input_ids: %s\n" % (" ".join([str(x) for x in self.input_ids]))
     s += "segment_ids: %s\n" % (" ".join([str(x) for x in self.segment_ids]))
     s += "is_random_next: %s\n" % self.is_random_next
     s += "masked_lm_positions: %s\n" % (" ".join(
         [str(x) for x in self.masked_lm_positions]))
-    s += "masked_lm_labels: %s\n" % (" ".join(
-        [tokenization.printable_text(x) for x in self.masked_lm_labels]))
+    s += "masked_lm_ids: %s\n" % (" ".join(
+        [str(x) for x in self.masked_lm_ids]))
     s += "\n"
     return s
 
@@ -90,62 +235,113 @@ class TrainingInstance(object):
     return self.__str__()
 
 
+class PackedTrainingInstance(object):
+  """Several `TrainingInstance`s packed into one row.
+
+  The arrays of the instances are concatenated, with `masked_lm_positions`
+  relative to the row. `sequence_ids` holds the 1-based index of the instance
+  every token belongs to, `position_ids` the position of every token within
+  its instance, and `next_sentence_positions` the position of the [CLS]
+  token of every instance.
+  """
+
+  __slots__ = ("input_ids", "segment_ids", "masked_lm_positions",
+               "masked_lm_ids", "is_random_next", "sequence_ids",
+               "position_ids", "next_sentence_positions")
+
+  def __init__(self, instances):
+    self.input_ids = array.array("i")
+    self.segment_ids = array.array("b")
+    self.masked_lm_positions = array.array("i")
+    self.masked_lm_ids = array.array("i")
+    self.is_random_next = []
+    self.sequence_ids = array.array("i")
+    self.position_ids = array.array("i")
+    self.next_sentence_positions = array.array("i")
+    for (i, instance) in enumerate(instances):
+      start = len(self.input_ids)
+      num_tokens = len(instance.input_ids)
+      self.input_ids.extend(instance.input_ids)
+      self.segment_ids.extend(instance.segment_ids)
+      self.masked_lm_positions.extend(
+          start + position for position in instance.masked_lm_positions)
+      self.masked_lm_ids.extend(instance.masked_lm_ids)
+      self.is_random_next.append(instance.is_random_next)
+      self.sequence_ids.extend([i + 1] * num_tokens)
+      self.position_ids.extend(range(num_tokens))
+      self.next_sentence_positions.append(start)
+
+
+class PretrainingVocab(object):
+  """The word piece ids needed to create `TrainingInstance`s."""
+
+  def __init__(self, vocab):
+    self.cls_id = vocab["[CLS]"]
+    self.sep_id = vocab["[SEP]"]
+    self.mask_id = vocab["[MASK]"]
+    # Random replacements are drawn from every vocab entry, in vocab order.
+    self.ids = list(vocab.values())
+    # The "##" word pieces that continue the previous word piece's word.
+    self.continuation_ids = set(
+        token_id for (token, token_id) in vocab.items()
+        if token.startswith("##"))
+
+
 def write_instance_to_example_files(instances, tokenizer, max_seq_length,
-                                    max_predictions_per_seq, output_files):
-  """Create TF example files from `TrainingInstance`s."""
+                                    max_predictions_per_seq, output_files,
+                                    write_masked_lm=True,
+                                    compression_type=None,
+                                    pad_records=True,
+                                    max_sequences_per_pack=0,
+                                    fast_serialization=False):
+  """Create TF example files from `TrainingInstance`s.
+
+  If `write_masked_lm` is False, the masked LM features are left out. If
+  `pad_records` is False, only the real tokens and predictions are written,
+  without `input_mask` and `masked_lm_weights`, and `run_pretraining.py` pads
+  them when batching. If `max_sequences_per_pack` is > 0, the instances are
+  `PackedTrainingInstance`s. If `fast_serialization` is True, the examples
+  are serialized by an `ExampleSerializer`.
+  """
+  options = tokenization.get_tfrecord_options(compression_type)
   writers = []
   for output_file in output_files:
-    writers.append(tf.python_io.TFRecordWriter(output_file))
+    writers.append(tf.python_io.TFRecordWriter(output_file, options=options))
+
+  serializer = None
+  if fast_serialization:
+    serializer = ExampleSerializer(max(len(tokenizer.vocab), max_seq_length))
 
   writer_index = 0
 
   total_written = 0
   for (inst_index, instance) in enumerate(instances):
-    input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
-    input_mask = [1] * len(input_ids)
-    segment_ids = list(instance.segment_ids)
-    assert len(input_ids) <= max_seq_length
-
-    while len(input_ids) < max_seq_length:
-      input_ids.append(0)
-      input_mask.append(0)
-      segment_ids.append(0)
-
-    assert len(input_ids) == max_seq_length
-    assert len(input_mask) == max_seq_length
-    assert len(segment_ids) == max_seq_length
-
-    masked_lm_positions = list(instance.masked_lm_positions)
-    masked_lm_ids = tokenizer.convert_tokens_to_ids(instance.masked_lm_labels)
-    masked_lm_weights = [1.0] * len(masked_lm_ids)
-
-    while len(masked_lm_positions) < max_predictions_per_seq:
-      masked_lm_positions.append(0)
-      masked_lm_ids.append(0)
-      masked_lm_weights.append(0.0)
-
-    next_sentence_label = 1 if instance.is_random_next else 0
-
-    features = collections.OrderedDict()
-    features["input_ids"] = create_int_feature(input_ids)
-    features["input_mask"] = create_int_feature(input_mask)
-    features["segment_ids"] = create_int_feature(segment_ids)
-    features["masked_lm_positions"] = create_int_feature(masked_lm_positions)
-    features["masked_lm_ids"] = create_int_feature(masked_lm_ids)
-    features["masked_lm_weights"] = create_float_feature(masked_lm_weights)
-    features["next_sentence_labels"] = create_int_feature([next_sentence_label])
-
-    tf_example = tf.train.Example(features=tf.train.Features(feature=features))
-
-    writers[writer_index].write(tf_example.SerializeToString())
+    if serializer:
+      serialized_example = serializer.serialize_example(
+          create_instance_features(
+              instance, max_seq_length, max_predictions_per_seq,
+              write_masked_lm, pad_records, max_sequences_per_pack,
+              serializer.int_feature, serializer.float_feature))
+    if not serializer or inst_index < 20:
+      features = create_instance_features(
+          instance, max_seq_length, max_predictions_per_seq, write_masked_lm,
+          pad_records, max_sequences_per_pack)
+    if not serializer:
+      tf_example = tf.train.Example(
+          features=tf.train.Features(feature=features))
+      serialized_example = tf_example.SerializeToString()
+
+    writers[writer_index].write(serialized_example)
     writer_index = (writer_index + 1) % len(writers)
 
     total_written += 1
 
     if inst_index < 20:
       tf.logging.info("*** Example ***")
-      tf.logging.info("tokens: %s" % " ".join(
-          [tokenization.printable_text(x) for x in instance.tokens]))
+      tf.logging.info("tokens: %s" % " ".join([
+          tokenization.printable_text(x)
+          for x in tokenizer.convert_ids_to_tokens(instance.input_ids)
+      ]))
 
       for feature_name in features.keys():
         feature = features[feature_name]
@@ -161,6 +357,228 @@ def write_instance_to_example_files(instances, tokenizer, max_seq_length,
     writer.close()
 
   tf.logging.info("Wrote %d total instances", total_written)
+  return total_written
+
+
+def create_instance_features(instance, max_seq_length, max_predictions_per_seq,
+                             write_masked_lm, pad_records,
+                             max_sequences_per_pack,
+                             int_feature=None, float_feature=None):
+  """Returns the features of the TF example of an instance.
+
+  The features are created by `int_feature` and `float_feature`, which
+  default to `create_int_feature` and `create_float_feature`.
+  """
+  int_feature = int_feature or create_int_feature
+  float_feature = float_feature or create_float_feature
+
+  num_tokens = len(instance.input_ids)
+  assert num_tokens <= max_seq_length
+  num_predictions = len(instance.masked_lm_positions)
+  assert num_predictions <= max_predictions_per_seq
+
+  features = collections.OrderedDict()
+  if pad_records:
+    # Padding is done by filling a slice of a zero-initialized list.
+    input_ids = [0] * max_seq_length
+    input_ids[:num_tokens] = instance.input_ids
+    input_mask = [1] * num_tokens + [0] * (max_seq_length - num_tokens)
+    segment_ids = [0] * max_seq_length
+    segment_ids[:num_tokens] = instance.segment_ids
+
+    features["input_ids"] = int_feature(input_ids)
+    features["input_mask"] = int_feature(input_mask)
+    features["segment_ids"] = int_feature(segment_ids)
+  else:
+    assert max_sequences_per_pack == 0
+    features["input_ids"] = int_feature(instance.input_ids)
+    features["segment_ids"] = int_feature(instance.segment_ids)
+
+  if write_masked_lm and pad_records:
+    masked_lm_positions = [0] * max_predictions_per_seq
+    masked_lm_positions[:num_predictions] = instance.masked_lm_positions
+    masked_lm_ids = [0] * max_predictions_per_seq
+    masked_lm_ids[:num_predictions] = instance.masked_lm_ids
+    masked_lm_weights = ([1.0] * num_predictions + [0.0] *
+                         (max_predictions_per_seq - num_predictions))
+
+    features["masked_lm_positions"] = int_feature(masked_lm_positions)
+    features["masked_lm_ids"] = int_feature(masked_lm_ids)
+    features["masked_lm_weights"] = float_feature(masked_lm_weights)
+  elif write_masked_lm:
+    features["masked_lm_positions"] = int_feature(
+        instance.masked_lm_positions)
+    features["masked_lm_ids"] = int_feature(instance.masked_lm_ids)
+
+  if max_sequences_per_pack > 0:
+    add_packing_features(features, instance, max_seq_length,
+                         max_sequences_per_pack, int_feature, float_feature)
+  else:
+    next_sentence_label = 1 if instance.is_random_next else 0
+    features["next_sentence_labels"] = int_feature([next_sentence_label])
+  return features
+
+
+def add_packing_features(features, packed_instance, max_seq_length,
+                         max_sequences_per_pack, int_feature=None,
+                         float_feature=None):
+  """Adds the features of a `PackedTrainingInstance` to `features`."""
+  int_feature = int_feature or create_int_feature
+  float_feature = float_feature or create_float_feature
+
+  num_tokens = len(packed_instance.input_ids)
+  num_sequences = len(packed_instance.next_sentence_positions)
+  assert num_sequences <= max_sequences_per_pack
+
+  sequence_ids = [0] * max_seq_length
+  sequence_ids[:num_tokens] = packed_instance.sequence_ids
+  position_ids = [0] * max_seq_length
+  position_ids[:num_tokens] = packed_instance.position_ids
+  next_sentence_positions = [0] * max_sequences_per_pack
+  next_sentence_positions[:num_sequences] = (
+      packed_instance.next_sentence_positions)
+  next_sentence_labels = [0] * max_sequences_per_pack
+  next_sentence_labels[:num_sequences] = [
+      1 if is_random_next else 0
+      for is_random_next in packed_instance.is_random_next
+  ]
+  next_sentence_weights = ([1.0] * num_sequences + [0.0] *
+                           (max_sequences_per_pack - num_sequences))
+
+  features["sequence_ids"] = int_feature(sequence_ids)
+  features["position_ids"] = int_feature(position_ids)
+  features["next_sentence_positions"] = int_feature(next_sentence_positions)
+  features["next_sentence_labels"] = int_feature(next_sentence_labels)
+  features["next_sentence_weights"] = float_feature(next_sentence_weights)
+
+
+def _encode_varint(value):
+  """Encodes an integer as a protocol buffer varint."""
+  if value < 0:
+    # Negative int64 values are encoded as their 64-bit two's complement.
+    value += 1 << 64
+  encoded = bytearray()
+  while value > 0x7f:
+    encoded.append(0x80 | (value & 0x7f))
+    value >>= 7
+  encoded.append(value)
+  return bytes(encoded)
+
+
+class ExampleSerializer(object):
+  """Serializes `tf.train.Example`s without building protos.
+
+  `int_feature` and `float_feature` return the serialized `tf.train.Feature`
+  of a list of values, and `serialize_example` combines them. The result is
+  the same as `SerializeToString(deterministic=True)` of the proto, which
+  sorts the features by name.
+  """
+
+  # The tag bytes of the length-delimited fields of `tf.train.Example`.
+  _EXAMPLE_FEATURES_TAG = b"\x0a"
+  _FEATURES_FEATURE_TAG = b"\x0a"
+  _FEATURE_ENTRY_KEY_TAG = b"\x0a"
+  _FEATURE_ENTRY_VALUE_TAG = b"\x12"
+  _FEATURE_FLOAT_LIST_TAG = b"\x12"
+  _FEATURE_INT64_LIST_TAG = b"\x1a"
+  _LIST_VALUE_TAG = b"\x0a"
+
+  def __init__(self, num_cached_varints):
+    # Looking up the varints of the most common values (word piece ids,
+    # positions and lengths) is much faster than encoding them one by one.
+    self._varints = dict(
+        (value, _encode_varint(value)) for value in range(num_cached_varints))
+    self._feature_keys = {}
+
+  def int_feature(self, values):
+    if not isinstance(values, list):
+      values = list(values)
+    payload = None
+    if values and max(values) < 0x80:
+      # Varints of 0 to 127 are the values themselves as single bytes.
+      try:
+        payload = bytes(bytearray(values))
+      except ValueError:
+        pass
+    if payload is None:
+      try:
+        payload = b"".join(map(self._varints.__getitem__, values))
+      except KeyError:
+        payload = b"".join(map(_encode_varint, values))
+    return self._list_feature(self._FEATURE_INT64_LIST_TAG, payload)
+
+  def float_feature(self, values):
+    payload = struct.pack("<%df" % len(values), *values)
+    return self._list_feature(self._FEATURE_FLOAT_LIST_TAG, payload)
+
+  def _list_feature(self, tag, payload):
+    # Repeated numbers are packed, and left out entirely if there are none.
+    if payload:
+      payload = self._length_delimited(self._LIST_VALUE_TAG, payload)
+    return self._length_delimited(tag, payload)
+
+  def _length_delimited(self, tag, payload):
+    length = self._varints.get(len(payload))
+    if length is None:
+      length = _encode_varint(len(payload))
+    return tag + length + payload
+
+  def serialize_example(self, features):
+    """Returns the serialized example of a dict of serialized features."""
+    entries = []
+    for name in sorted(features):
+      feature_key = self._feature_keys.get(name)
+      if feature_key is None:
+        feature_key = self._length_delimited(self._FEATURE_ENTRY_KEY_TAG,
+                                             name.encode("utf-8"))
+        self._feature_keys[name] = feature_key
+      entries.append(
+          self._length_delimited(
+              self._FEATURES_FEATURE_TAG, feature_key +
+              self._length_delimited(self._FEATURE_ENTRY_VALUE_TAG,
+                                     features[name])))
+    return self._length_delimited(self._EXAMPLE_FEATURES_TAG,
+                                  b"".join(entries))
+
+
+def pack_instances(instances, max_seq_length, max_predictions_per_seq,
+                   max_sequences_per_pack, max_open_packs=64):
+  """Yields `PackedTrainingInstance`s of `instances`.
+
+  Every instance is added to the first open pack it fits into, with at most
+  `max_seq_length` tokens, `max_predictions_per_seq` predictions and
+  `max_sequences_per_pack` instances per pack. If no open pack has room, the
+  fullest of `max_open_packs` open packs is written out to make room for a new
+  one.
+  """
+  # Each open pack is [instances, number of tokens, number of predictions].
+  open_packs = []
+  for instance in instances:
+    num_tokens = len(instance.input_ids)
+    num_predictions = len(instance.masked_lm_positions)
+    for pack in open_packs:
+      if (pack[1] + num_tokens <= max_seq_length and
+          pack[2] + num_predictions <= max_predictions_per_seq):
+        break
+    else:
+      if len(open_packs) == max_open_packs:
+        fullest_pack = max(open_packs, key=lambda pack: pack[1])
+        open_packs.remove(fullest_pack)
+        yield PackedTrainingInstance(fullest_pack[0])
+      pack = [[], 0, 0]
+      open_packs.append(pack)
+
+    pack[0].append(instance)
+    pack[1] += num_tokens
+    pack[2] += num_predictions
+    if (len(pack[0]) == max_sequences_per_pack or
+        pack[1] == max_seq_length or
+        pack[2] == max_predictions_per_seq):
+      open_packs.remove(pack)
+      yield PackedTrainingInstance(pack[0])
+
+  for pack in open_packs:
+    yield PackedTrainingInstance(pack[0])
 
 
 def create_int_feature(values):
@@ -173,54 +591,397 @@ def create_float_feature(values):
   return feature
 
 
-def create_training_instances(input_files, tokenizer, max_seq_length,
-                              dupe_factor, short_seq_prob, masked_lm_prob,
-                              max_predictions_per_seq, rng):
-  """Create `TrainingInstance`s from raw text."""
-  all_documents = [[]]
+def read_documents(input_files, tokenizer, token_cache_dir=None):
+  """Yields the tokenized documents of the input files one at a time.
+
+  Every document is a list of sentences, and every sentence is an array of
+  word piece ids. If `token_cache_dir` is set, the sentences are read from
+  (and if needed first written to) the token cache of every input file.
+  """
+  document = []
+  for input_file in input_files:
+    if token_cache_dir:
+      sentences = read_cached_sentences(input_file, tokenizer, token_cache_dir)
+    else:
+      sentences = read_sentences(input_file, tokenizer)
+    for sentence in sentences:
+      if sentence is None:
+        if document:
+          yield document
+        document = []
+      else:
+        document.append(sentence)
+  if document:
+    yield document
+
 
+def read_sentences(input_file, tokenizer):
+  """Yields the tokenized sentences of an input file.
+
+  Every sentence is an array of word piece ids, and every document boundary
+  is None.
+  """
   # Input file format:
   # (1) One sentence per line. These should ideally be actual sentences, not
   # entire paragraphs or arbitrary spans of text. (Because we use the
   # sentence boundaries for the "next sentence prediction" task).
   # (2) Blank lines between documents. Document boundaries are needed so
   # that the "next sentence prediction" task doesn't span between documents.
-  for input_file in input_files:
-    with tf.gfile.GFile(input_file, "r") as reader:
-      while True:
-        line = tokenization.convert_to_unicode(reader.readline())
-        if not line:
-          break
-        line = line.strip()
+  for line in read_lines(input_file):
+    # Empty lines are used as document delimiters
+    if not line:
+      yield None
+      continue
+    token_ids = tokenizer.encode(line)
+    if token_ids:
+      yield array.array("i", token_ids)
+
 
-        # Empty lines are used as document delimiters
-        if not line:
-          all_documents.append([])
-        tokens = tokenizer.tokenize(line)
-        if tokens:
-          all_documents[-1].append(tokens)
+def read_lines(input_file):
+  """Yields the stripped lines of an input file as unicode."""
+  with tf.gfile.GFile(input_file, "r") as reader:
+    while True:
+      line = tokenization.convert_to_unicode(reader.readline())
+      if not line:
+        break
+      yield line.strip()
 
-  # Remove empty documents
-  all_documents = [x for x in all_documents if x]
-  rng.shuffle(all_documents)
 
-  vocab_words = list(tokenizer.vocab.keys())
+def read_raw_documents(input_files):
+  """Yields the documents of the input files as lists of untokenized lines.
+
+  The documents are split like in `read_documents`, but a document can have
+  lines without any word pieces.
+  """
+  document = []
+  for input_file in input_files:
+    for line in read_lines(input_file):
+      if not line:
+        if document:
+          yield document
+        document = []
+      else:
+        document.append(line)
+  if document:
+    yield document
+
+
+# A token cache file is this header (magic, number of sentences, number of
+# document boundaries, number of word pieces), followed by the int64 sentence
+# offsets, the int64 document boundaries (as sentence indices) and the int32
+# word piece ids of all sentences.
+_TOKEN_CACHE_MAGIC = b"BERTTOK1"
+_TOKEN_CACHE_HEADER = struct.Struct("<8sqqq")
+
+
+def get_token_cache_file(token_cache_dir, input_file, tokenizer):
+  """Returns the token cache file of `input_file`.
+
+  The file name contains a hash of the path, length and modification time of
+  `input_file`, the vocab and `do_lower_case`, so a change to any of them
+  leads to a new cache file.
+  """
+  stat = tf.gfile.Stat(input_file)
+  key = hashlib.md5()
+  key.update(("%s:%d:%d:%s\n" % (input_file, stat.length, stat.mtime_nsec,
+                                  tokenizer.do_lower_case)).encode("utf-8"))
+  for token in tokenizer.vocab:
+    key.update(token.encode("utf-8") + b"\n")
+  return os.path.join(
+      token_cache_dir,
+      "%s.%s.tokens" % (os.path.basename(input_file), key.hexdigest()))
+
+
+def write_token_cache(input_file, tokenizer, token_cache_file):
+  """Tokenizes `input_file` and writes the result to `token_cache_file`."""
+  sentence_offsets = [0]
+  document_boundaries = []
+  token_ids = array.array("i")
+  for sentence in read_sentences(input_file, tokenizer):
+    if sentence is None:
+      document_boundaries.append(len(sentence_offsets) - 1)
+    else:
+      token_ids.extend(sentence)
+      sentence_offsets.append(len(token_ids))
+
+  # Writing to a temporary file first means that other processes never see a
+  # partially written cache file.
+  temp_file = "%s.tmp%d" % (token_cache_file, os.getpid())
+  with open(temp_file, "wb") as writer:
+    writer.write(
+        _TOKEN_CACHE_HEADER.pack(_TOKEN_CACHE_MAGIC,
+                                 len(sentence_offsets) - 1,
+                                 len(document_boundaries), len(token_ids)))
+    np.asarray(sentence_offsets, dtype="<i8").tofile(writer)
+    np.asarray(document_boundaries, dtype="<i8").tofile(writer)
+    np.asarray(token_ids, dtype="<i4").tofile(writer)
+  os.rename(temp_file, token_cache_file)
+
+
+def open_token_cache(input_file, tokenizer, token_cache_dir):
+  """Memory-maps the token cache of `input_file`, creating it if needed.
+
+  Returns:
+    A tuple (sentence_offsets, document_boundaries, token_ids) of read-only
+    arrays backed by the cache file.
+  """
+  token_cache_file = get_token_cache_file(token_cache_dir, input_file,
+                                          tokenizer)
+  if not os.path.exists(token_cache_file):
+    tf.logging.info("Writing token cache %s", token_cache_file)
+    write_token_cache(input_file, tokenizer, token_cache_file)
+
+  data = np.memmap(token_cache_file, dtype=np.uint8, mode="r")
+  (magic, num_sentences, num_boundaries,
+   num_tokens) = _TOKEN_CACHE_HEADER.unpack(
+       data[:_TOKEN_CACHE_HEADER.size].tobytes())
+  if magic != _TOKEN_CACHE_MAGIC:
+    raise ValueError("%s is not a token cache file" % token_cache_file)
+
+  offset = _TOKEN_CACHE_HEADER.size
+  sentence_offsets = data[offset:offset + 8 * (num_sentences + 1)].view("<i8")
+  offset += 8 * (num_sentences + 1)
+  document_boundaries = data[offset:offset + 8 * num_boundaries].view("<i8")
+  offset += 8 * num_boundaries
+  token_ids = data[offset:offset + 4 * num_tokens].view("<i4")
+  return (sentence_offsets, document_boundaries, token_ids)
+
+
+def read_cached_sentences(input_file, tokenizer, token_cache_dir):
+  """Like `read_sentences`, but reads the memory-mapped token cache.
+
+  The token cache of `input_file` is created first if it doesn't exist yet.
+  """
+  (sentence_offsets, document_boundaries,
+   token_ids) = open_token_cache(input_file, tokenizer, token_cache_dir)
+  num_sentences = len(sentence_offsets) - 1
+  num_boundaries = len(document_boundaries)
+
+  boundary_index = 0
+  for sentence_index in range(num_sentences + 1):
+    while (boundary_index < num_boundaries and
+           document_boundaries[boundary_index] == sentence_index):
+      yield None
+      boundary_index += 1
+    if sentence_index < num_sentences:
+      yield array.array(
+          "i", token_ids[sentence_offsets[sentence_index]:
+                         sentence_offsets[sentence_index + 1]].tolist())
+
+
+class DocumentIndex(object):
+  """Random access to the documents of memory-mapped token caches.
+
+  Only the sentence and document offsets are held in memory, so any sentence
+  of any document can be read in constant time without loading the corpus.
+  The documents are the same, and in the same order, as the ones of
+  `read_documents`. Indexing and `len` work like on a list of documents, so
+  a `DocumentIndex` can be used in place of one.
+  """
+
+  def __init__(self, input_files, tokenizer, token_cache_dir,
+               weight_by_length=False):
+    self.weight_by_length = weight_by_length
+    self._token_ids = []
+    self._sentence_offsets = []
+    file_sentence_starts = [0]
+    boundaries = []
+    sentence_lengths = []
+    for input_file in input_files:
+      (sentence_offsets, document_boundaries,
+       token_ids) = open_token_cache(input_file, tokenizer, token_cache_dir)
+      boundaries.append(document_boundaries + file_sentence_starts[-1])
+      sentence_lengths.append(np.diff(sentence_offsets))
+      file_sentence_starts.append(file_sentence_starts[-1] +
+                                  len(sentence_offsets) - 1)
+      self._token_ids.append(token_ids)
+      self._sentence_offsets.append(sentence_offsets)
+    self._file_sentence_starts = np.array(file_sentence_starts, np.int64)
+
+    # Like in `read_documents`, documents are only split at the document
+    # boundaries (not between input files) and are never empty. The last
+    # start is the end of the last document.
+    num_sentences = file_sentence_starts[-1]
+    self._document_starts = np.unique(
+        np.concatenate(boundaries + [np.array([0, num_sentences], np.int64)]))
+
+    # `_document_token_starts[i]` is the number of word pieces before
+    # document i, for sampling documents weighted by length.
+    sentence_token_starts = np.concatenate(
+        [[0]] + sentence_lengths).astype(np.int64).cumsum()
+    self._document_token_starts = sentence_token_starts[self._document_starts]
+
+    self._order = np.arange(len(self._document_starts) - 1, dtype=np.int64)
+    self._positions = self._order.copy()
+
+  def __len__(self):
+    return len(self._order)
+
+  def __getitem__(self, document_index):
+    document_id = self._order[document_index]
+    return _IndexedDocument(self, self._document_starts[document_id],
+                            self._document_starts[document_id + 1])
+
+  def shuffle(self, rng):
+    """Shuffles the documents like `rng.shuffle` on a list of documents."""
+    rng.shuffle(self._order)
+    self._positions[self._order] = np.arange(len(self._order))
+
+  def sample_document_index(self, rng):
+    """Returns the index of a random document."""
+    if not self.weight_by_length:
+      return rng.randint(0, len(self) - 1)
+    token = rng.randint(0, int(self._document_token_starts[-1]) - 1)
+    document_id = np.searchsorted(
+        self._document_token_starts, token, side="right") - 1
+    return int(self._positions[document_id])
+
+  def get_sentence(self, sentence_index):
+    """Returns a sentence by its index in all input files."""
+    file_index = np.searchsorted(
+        self._file_sentence_starts, sentence_index, side="right") - 1
+    sentence_index -= self._file_sentence_starts[file_index]
+    sentence_offsets = self._sentence_offsets[file_index]
+    return array.array(
+        "i", self._token_ids[file_index][
+            sentence_offsets[sentence_index]:
+            sentence_offsets[sentence_index + 1]].tolist())
+
+
+class _IndexedDocument(object):
+  """A document of a `DocumentIndex` that reads its sentences on demand."""
+
+  def __init__(self, document_index, start, end):
+    self._document_index = document_index
+    self._start = start
+    self._end = end
+
+  def __len__(self):
+    return int(self._end - self._start)
+
+  def __getitem__(self, sentence_index):
+    if not 0 <= sentence_index < len(self):
+      raise IndexError("sentence index out of range")
+    return self._document_index.get_sentence(self._start + sentence_index)
+
+
+def create_training_instances(input_files, tokenizer, max_seq_length,
+                              dupe_factor, short_seq_prob, masked_lm_prob,
+                              max_predictions_per_seq, rng, np_rng=None,
+                              apply_masking=True, token_cache_dir=None,
+                              masking_strategy=None, indexed_documents=False,
+                              weight_documents_by_length=False):
+  """Create `TrainingInstance`s from raw text.
+
+  If `np_rng` is given, the masked LM predictions are created with
+  `create_masked_lm_predictions_batch` using `np_rng`. If `apply_masking` is
+  False, the instances have no masked LM predictions at all.
+  `masking_strategy` is passed to `create_masked_lm_predictions`. If
+  `indexed_documents` is True, the documents are read through a
+  `DocumentIndex` over the token caches in `token_cache_dir`.
+  """
+  sample_document_index = None
+  if indexed_documents:
+    all_documents = DocumentIndex(
+        input_files, tokenizer, token_cache_dir,
+        weight_by_length=weight_documents_by_length)
+    all_documents.shuffle(rng)
+    sample_document_index = all_documents.sample_document_index
+  else:
+    all_documents = list(
+        read_documents(input_files, tokenizer, token_cache_dir))
+    rng.shuffle(all_documents)
+
+  vocab = PretrainingVocab(tokenizer.vocab)
+  batch_masking = apply_masking and np_rng is not None
   instances = []
   for _ in range(dupe_factor):
     for document_index in range(len(all_documents)):
       instances.extend(
           create_instances_from_document(
               all_documents, document_index, max_seq_length, short_seq_prob,
-              masked_lm_prob, max_predictions_per_seq, vocab_words, rng))
+              masked_lm_prob, max_predictions_per_seq, vocab, rng,
+              apply_masking=apply_masking and not batch_masking,
+              masking_strategy=masking_strategy,
+              sample_document_index=sample_document_index))
+
+  if batch_masking:
+    create_masked_lm_predictions_batch(instances, masked_lm_prob,
+                                       max_predictions_per_seq, vocab, np_rng)
 
   rng.shuffle(instances)
   return instances
 
 
+def generate_training_instances(input_files, tokenizer, max_seq_length,
+                                dupe_factor, short_seq_prob, masked_lm_prob,
+                                max_predictions_per_seq, rng, window_size,
+                                random_document_pool_size, np_rng=None,
+                                apply_masking=True, token_cache_dir=None,
+                                masking_strategy=None):
+  """Yields `TrainingInstance`s from raw text in windows of documents.
+
+  This is the streaming counterpart of `create_training_instances`. Only the
+  current window of `window_size` documents, its instances and a uniform
+  random sample of at most `random_document_pool_size` earlier documents (for
+  "random next" sentences) are held in memory at any time.
+  """
+  vocab = PretrainingVocab(tokenizer.vocab)
+  batch_masking = apply_masking and np_rng is not None
+  documents = read_documents(input_files, tokenizer, token_cache_dir)
+  random_document_pool = []
+  num_documents_seen = 0
+  while True:
+    window = list(itertools.islice(documents, window_size))
+    if not window:
+      break
+    rng.shuffle(window)
+
+    # The window comes first, so `document_index` below refers to it.
+    candidate_documents = window + random_document_pool
+    instances = []
+    for _ in range(dupe_factor):
+      for document_index in range(len(window)):
+        instances.extend(
+            create_instances_from_document(
+                candidate_documents, document_index, max_seq_length,
+                short_seq_prob, masked_lm_prob, max_predictions_per_seq,
+                vocab, rng, apply_masking=apply_masking and not batch_masking,
+                masking_strategy=masking_strategy))
+
+    if batch_masking:
+      create_masked_lm_predictions_batch(instances, masked_lm_prob,
+                                         max_predictions_per_seq, vocab,
+                                         np_rng)
+
+    rng.shuffle(instances)
+    for instance in instances:
+      yield instance
+
+    # Reservoir sampling keeps the pool a uniform sample of all documents
+    # read so far.
+    for document in window:
+      num_documents_seen += 1
+      if len(random_document_pool) < random_document_pool_size:
+        random_document_pool.append(document)
+      else:
+        j = rng.randint(0, num_documents_seen - 1)
+        if j < random_document_pool_size:
+          random_document_pool[j] = document
+
+
 def create_instances_from_document(
     all_documents, document_index, max_seq_length, short_seq_prob,
-    masked_lm_prob, max_predictions_per_seq, vocab_words, rng):
-  """Creates `TrainingInstance`s for a single document."""
+    masked_lm_prob, max_predictions_per_seq, vocab, rng, apply_masking=True,
+    masking_strategy=None, statistics=None, sample_document_index=None):
+  """Creates `TrainingInstance`s for a single document.
+
+  If `apply_masking` is False, the instances are returned without masked LM
+  predictions, to be masked later by `create_masked_lm_predictions_batch`.
+  If `statistics` is given, the number of truncated instances and tokens are
+  added to this `collections.Counter`. The "random next" documents are drawn
+  by `sample_document_index(rng)` if given, and uniformly otherwise.
+  """
   document = all_documents[document_index]
 
   # Account for [CLS], [SEP], [SEP]
@@ -274,7 +1035,10 @@ def create_instances_from_document(
           # the random document is not the same as the document
           # we're processing.
           for _ in range(10):
-            random_document_index = rng.randint(0, len(all_documents) - 1)
+            if sample_document_index is not None:
+              random_document_index = sample_document_index(rng)
+            else:
+              random_document_index = rng.randint(0, len(all_documents) - 1)
             if random_document_index != document_index:
               break
 
@@ -293,37 +1057,37 @@ def create_instances_from_document(
           is_random_next = False
           for j in range(a_end, len(current_chunk)):
             tokens_b.extend(current_chunk[j])
+        num_truncated_tokens = len(tokens_a) + len(tokens_b) - max_num_tokens
+        if statistics is not None and num_truncated_tokens > 0:
+          statistics["num_truncated_instances"] += 1
+          statistics["num_truncated_tokens"] += num_truncated_tokens
         truncate_seq_pair(tokens_a, tokens_b, max_num_tokens, rng)
 
         assert len(tokens_a) >= 1
         assert len(tokens_b) >= 1
 
-        tokens = []
-        segment_ids = []
-        tokens.append("[CLS]")
-        segment_ids.append(0)
-        for token in tokens_a:
-          tokens.append(token)
-          segment_ids.append(0)
-
-        tokens.append("[SEP]")
-        segment_ids.append(0)
-
-        for token in tokens_b:
-          tokens.append(token)
-          segment_ids.append(1)
-        tokens.append("[SEP]")
-        segment_ids.append(1)
-
-        (tokens, masked_lm_positions,
-         masked_lm_labels) = create_masked_lm_predictions(
-             tokens, masked_lm_prob, max_predictions_per_seq, vocab_words, rng)
+        input_ids = array.array("i", [vocab.cls_id])
+        input_ids.extend(tokens_a)
+        input_ids.append(vocab.sep_id)
+        input_ids.extend(tokens_b)
+        input_ids.append(vocab.sep_id)
+        segment_ids = (array.array("b", [0]) * (len(tokens_a) + 2) +
+                       array.array("b", [1]) * (len(tokens_b) + 1))
+
+        if apply_masking:
+          (input_ids, masked_lm_positions,
+           masked_lm_ids) = create_masked_lm_predictions(
+               input_ids, masked_lm_prob, max_predictions_per_seq, vocab, rng,
+               masking_strategy)
+        else:
+          masked_lm_positions = array.array("i")
+          masked_lm_ids = array.array("i")
         instance = TrainingInstance(
-            tokens=tokens,
+            input_ids=input_ids,
             segment_ids=segment_ids,
             is_random_next=is_random_next,
             masked_lm_positions=masked_lm_positions,
-            masked_lm_labels=masked_lm_labels)
+            masked_lm_ids=masked_lm_ids)
         instances.append(instance)
       current_chunk = []
       current_length = 0
@@ -332,59 +1096,638 @@ def create_instances_from_document(
   return instances
 
 
-def create_masked_lm_predictions(tokens, masked_lm_prob,
-                                 max_predictions_per_seq, vocab_words, rng):
-  """Creates the predictions for the masked LM objective."""
-
-  cand_indexes = []
-  for (i, token) in enumerate(tokens):
-    if token == "[CLS]" or token == "[SEP]":
-      continue
-    cand_indexes.append(i)
-
-  rng.shuffle(cand_indexes)
-
-  output_tokens = list(tokens)
-
-  masked_lm = collections.namedtuple("masked_lm", ["index", "label"])  # pylint: disable=invalid-name
+class TokenMasking(object):
+  """Masks single word pieces."""
+
+  def get_candidate_units(self, input_ids, vocab, rng):
+    """Returns the lists of positions to mask together, in random order."""
+    cand_units = []
+    for (i, token_id) in enumerate(input_ids):
+      if token_id == vocab.cls_id or token_id == vocab.sep_id:
+        continue
+      cand_units.append([i])
+    rng.shuffle(cand_units)
+    return cand_units
+
+
+class WholeWordMasking(TokenMasking):
+  """Masks all the word pieces of a word together."""
+
+  def get_words(self, input_ids, vocab):
+    """Returns the positions of the word pieces of every word."""
+    words = []
+    for (i, token_id) in enumerate(input_ids):
+      if token_id == vocab.cls_id or token_id == vocab.sep_id:
+        continue
+      if (words and token_id in vocab.continuation_ids and
+          words[-1][-1] == i - 1):
+        words[-1].append(i)
+      else:
+        words.append([i])
+    return words
+
+  def get_candidate_units(self, input_ids, vocab, rng):
+    cand_units = self.get_words(input_ids, vocab)
+    rng.shuffle(cand_units)
+    return cand_units
+
+
+class SpanMasking(WholeWordMasking):
+  """Masks spans of whole words, as in SpanBERT.
+
+  Every word starts a candidate span whose length in words is drawn from a
+  geometric distribution clipped to `max_span_length`. Spans end early at the
+  end of a segment.
+  """
+
+  def __init__(self, max_span_length=10, geometric_p=0.2):
+    self.max_span_length = max_span_length
+    self.geometric_p = geometric_p
+
+  def get_candidate_units(self, input_ids, vocab, rng):
+    words = self.get_words(input_ids, vocab)
+    cand_units = []
+    for start in range(len(words)):
+      span_length = 1
+      while (span_length < self.max_span_length and
+             rng.random() >= self.geometric_p):
+        span_length += 1
+      span = list(words[start])
+      for word in words[start + 1:start + span_length]:
+        if word[0] != span[-1] + 1:
+          break
+        span.extend(word)
+      cand_units.append(span)
+    rng.shuffle(cand_units)
+    return cand_units
+
+
+def get_masking_strategy(name, max_span_length=10, span_geometric_p=0.2):
+  """Returns the masking strategy for a `masking_strategy` flag value."""
+  if name == "token":
+    return TokenMasking()
+  if name == "whole_word":
+    return WholeWordMasking()
+  if name == "span":
+    return SpanMasking(max_span_length, span_geometric_p)
+  raise ValueError("Unknown masking strategy: %s" % name)
+
+
+def create_masked_lm_predictions(input_ids, masked_lm_prob,
+                                 max_predictions_per_seq, vocab, rng,
+                                 masking_strategy=None):
+  """Creates the predictions for the masked LM objective.
+
+  Args:
+    input_ids: The word piece ids of the instance.
+    masked_lm_prob: Masked LM probability.
+    max_predictions_per_seq: Maximum number of predictions per instance.
+    vocab: A `PretrainingVocab`.
+    rng: A `random.Random`.
+    masking_strategy: A `TokenMasking`, `WholeWordMasking` or `SpanMasking`
+      that chooses the positions to mask together. Defaults to
+      `TokenMasking`. A group of positions is only masked if all of it fits
+      into `max_predictions_per_seq`.
+
+  Returns:
+    A tuple (output_ids, masked_lm_positions, masked_lm_ids) of arrays.
+  """
+  if masking_strategy is None:
+    masking_strategy = TokenMasking()
+
+  cand_units = masking_strategy.get_candidate_units(input_ids, vocab, rng)
+
+  output_ids = array.array("i", input_ids)
 
   num_to_predict = min(max_predictions_per_seq,
-                       max(1, int(round(len(tokens) * masked_lm_prob))))
+                       max(1, int(round(len(input_ids) * masked_lm_prob))))
 
-  masked_lms = []
+  masked_lm_positions = []
   covered_indexes = set()
-  for index in cand_indexes:
-    if len(masked_lms) >= num_to_predict:
+  for unit in cand_units:
+    if len(masked_lm_positions) >= num_to_predict:
       break
-    if index in covered_indexes:
+    # If adding a whole word or span would exceed the maximum number of
+    # predictions, then just skip it.
+    if len(masked_lm_positions) + len(unit) > num_to_predict:
       continue
-    covered_indexes.add(index)
+    if any(index in covered_indexes for index in unit):
+      continue
+    for index in unit:
+      covered_indexes.add(index)
 
-    masked_token = None
-    # 80% of the time, replace with [MASK]
-    if rng.random() < 0.8:
-      masked_token = "[MASK]"
-    else:
-      # 10% of the time, keep original
-      if rng.random() < 0.5:
-        masked_token = tokens[index]
-      # 10% of the time, replace with random word
+      masked_token_id = None
+      # 80% of the time, replace with [MASK]
+      if rng.random() < 0.8:
+        masked_token_id = vocab.mask_id
       else:
-        masked_token = vocab_words[rng.randint(0, len(vocab_words) - 1)]
+        # 10% of the time, keep original
+        if rng.random() < 0.5:
+          masked_token_id = input_ids[index]
+        # 10% of the time, replace with random word
+        else:
+          masked_token_id = vocab.ids[rng.randint(0, len(vocab.ids) - 1)]
+
+      output_ids[index] = masked_token_id
+
+      masked_lm_positions.append(index)
+
+  masked_lm_positions.sort()
+  masked_lm_ids = array.array("i", [input_ids[p] for p in masked_lm_positions])
+
+  return (output_ids, array.array("i", masked_lm_positions), masked_lm_ids)
+
+
+def create_masked_lm_predictions_batch(instances, masked_lm_prob,
+                                       max_predictions_per_seq, vocab, np_rng,
+                                       block_size=1024):
+  """Creates the masked LM predictions of many instances at once.
+
+  This is a vectorized counterpart of `create_masked_lm_predictions`. Every
+  instance gets the same number of predictions, the predicted positions are
+  drawn uniformly from the same candidates and the 80%/10%/10% replacement
+  is the same, but the random draws differ.
+
+  Args:
+    instances: `TrainingInstance`s without predictions. They are modified in
+      place.
+    masked_lm_prob: Masked LM probability.
+    max_predictions_per_seq: Maximum number of predictions per instance.
+    vocab: A `PretrainingVocab`.
+    np_rng: A seeded `np.random.RandomState` (or anything with a compatible
+      `uniform` method).
+    block_size: Number of instances masked together.
+  """
+  vocab_ids = np.asarray(vocab.ids, dtype=np.int32)
+  for block_start in range(0, len(instances), block_size):
+    block = instances[block_start:block_start + block_size]
+
+    lengths = np.array([len(x.input_ids) for x in block], dtype=np.int64)
+    input_ids = np.zeros([len(block), lengths.max()], dtype=np.int32)
+    for (i, instance) in enumerate(block):
+      input_ids[i, :lengths[i]] = instance.input_ids
+
+    positions = np.arange(input_ids.shape[1])
+    is_candidate = ((positions[np.newaxis, :] < lengths[:, np.newaxis]) &
+                    (input_ids != vocab.cls_id) & (input_ids != vocab.sep_id))
+    num_to_predict = np.minimum(
+        max_predictions_per_seq,
+        np.maximum(1, np.round(lengths * masked_lm_prob).astype(np.int64)))
+
+    # Ranking the candidates by a uniform random key and keeping the
+    # `num_to_predict` first is the same as shuffling them and taking a prefix.
+    keys = np_rng.uniform(size=input_ids.shape)
+    keys[~is_candidate] = 2.0
+    ranks = np.argsort(np.argsort(keys, axis=1), axis=1)
+    is_masked = is_candidate & (ranks < num_to_predict[:, np.newaxis])
+
+    # 80% of the time, replace with [MASK], 10% of the time, keep original and
+    # 10% of the time, replace with random word.
+    replacement_draws = np_rng.uniform(size=input_ids.shape)
+    random_ids = vocab_ids[(np_rng.uniform(size=input_ids.shape) *
+                            len(vocab_ids)).astype(np.int64)]
+    replacement_ids = np.where(
+        replacement_draws < 0.8, vocab.mask_id,
+        np.where(replacement_draws < 0.9, input_ids, random_ids))
+    output_ids = np.where(is_masked, replacement_ids, input_ids)
+
+    for (i, instance) in enumerate(block):
+      masked_lm_positions = np.flatnonzero(is_masked[i])
+      instance.input_ids = array.array("i", output_ids[i, :lengths[i]].tolist())
+      instance.masked_lm_positions = array.array(
+          "i", masked_lm_positions.tolist())
+      instance.masked_lm_ids = array.array(
+          "i", input_ids[i, masked_lm_positions].tolist())
+
+
+# The lengths of the arrays of a `TrainingInstance` in a shuffle bucket file,
+# and its `is_random_next`.
+_BUCKET_INSTANCE_HEADER = struct.Struct("<iiB")
+
+
+def shuffle_instances_externally(instances, num_buckets, rng, temp_dir=None,
+                                 buffer_size=10000):
+  """Yields `instances` in random order, using temporary files on disk.
+
+  Every instance is first appended to one of `num_buckets` files picked at
+  random. The files are then read back one at a time, and each is shuffled in
+  memory. Together this is a uniform random permutation of all instances, but
+  only one bucket is held in memory at a time.
+
+  Args:
+    instances: An iterable of `TrainingInstance`s.
+    num_buckets: Number of temporary files.
+    rng: A `random.Random`.
+    temp_dir: Local directory the temporary files are created in.
+    buffer_size: Number of instances held in memory before they are appended
+      to their files. Only one file is open at a time, so `num_buckets` is
+      not limited by the number of open files.
+  """
+  bucket_dir = tempfile.mkdtemp(prefix="shuffle_buckets", dir=temp_dir)
+  try:
+    bucket_files = [
+        os.path.join(bucket_dir, "bucket-%05d" % i) for i in range(num_buckets)
+    ]
+    buffers = [[] for _ in range(num_buckets)]
+    num_buffered = 0
+    for instance in instances:
+      buffers[rng.randint(0, num_buckets - 1)].append(instance)
+      num_buffered += 1
+      if num_buffered >= buffer_size:
+        _append_bucket_instances(bucket_files, buffers)
+        num_buffered = 0
+    _append_bucket_instances(bucket_files, buffers)
+
+    for bucket_file in bucket_files:
+      # A bucket that no instance was drawn for has no file.
+      if not os.path.exists(bucket_file):
+        continue
+      bucket = _read_bucket_instances(bucket_file)
+      os.remove(bucket_file)
+      rng.shuffle(bucket)
+      for instance in bucket:
+        yield instance
+  finally:
+    shutil.rmtree(bucket_dir, ignore_errors=True)
+
+
+def _append_bucket_instances(bucket_files, buffers):
+  """Appends the buffered instances to their bucket files and clears them."""
+  for (bucket_file, buffer) in zip(bucket_files, buffers):
+    if not buffer:
+      continue
+    with open(bucket_file, "ab") as writer:
+      for instance in buffer:
+        _write_bucket_instance(writer, instance)
+    del buffer[:]
 
-    output_tokens[index] = masked_token
 
-    masked_lms.append(masked_lm(index=index, label=tokens[index]))
+def _write_bucket_instance(writer, instance):
+  writer.write(
+      _BUCKET_INSTANCE_HEADER.pack(
+          len(instance.input_ids), len(instance.masked_lm_positions),
+          int(instance.is_random_next)))
+  instance.input_ids.tofile(writer)
+  instance.segment_ids.tofile(writer)
+  instance.masked_lm_positions.tofile(writer)
+  instance.masked_lm_ids.tofile(writer)
 
-  masked_lms = sorted(masked_lms, key=lambda x: x.index)
 
-  masked_lm_positions = []
-  masked_lm_labels = []
-  for p in masked_lms:
-    masked_lm_positions.append(p.index)
-    masked_lm_labels.append(p.label)
+def _read_bucket_instances(bucket_file):
+  instances = []
+  with open(bucket_file, "rb") as reader:
+    while True:
+      header = reader.read(_BUCKET_INSTANCE_HEADER.size)
+      if not header:
+        break
+      (num_tokens, num_predictions,
+       is_random_next) = _BUCKET_INSTANCE_HEADER.unpack(header)
+      input_ids = array.array("i")
+      input_ids.fromfile(reader, num_tokens)
+      segment_ids = array.array("b")
+      segment_ids.fromfile(reader, num_tokens)
+      masked_lm_positions = array.array("i")
+      masked_lm_positions.fromfile(reader, num_predictions)
+      masked_lm_ids = array.array("i")
+      masked_lm_ids.fromfile(reader, num_predictions)
+      instances.append(
+          TrainingInstance(
+              input_ids=input_ids,
+              segment_ids=segment_ids,
+              masked_lm_positions=masked_lm_positions,
+              masked_lm_ids=masked_lm_ids,
+              is_random_next=bool(is_random_next)))
+  return instances
 
-  return (output_tokens, masked_lm_positions, masked_lm_labels)
+
+def compute_corpus_statistics(input_files, tokenizer, max_seq_length,
+                              dupe_factor, short_seq_prob, masked_lm_prob,
+                              max_predictions_per_seq, rng, sample_rate,
+                              masking_strategy=None, write_masked_lm=True,
+                              pad_records=True, num_buckets=4):
+  """Estimates the output of `create_training_instances` from a sample.
+
+  Every document is sampled with probability `sample_rate` before it is
+  tokenized, so only the sampled documents are tokenized. The instances of
+  the sampled documents are created (with "random next" sentences from the
+  sampled documents) but not written. Counts are projected to all documents.
+  If `write_masked_lm` is False, like with `--dynamic_masking`, the instances
+  are not masked and the report has no masked LM predictions.
+
+  Returns:
+    An `OrderedDict` of statistics.
+  """
+  vocab = PretrainingVocab(tokenizer.vocab)
+  num_documents = 0
+  num_sampled_documents = 0
+  documents = []
+  for lines in read_raw_documents(input_files):
+    num_documents += 1
+    if rng.random() >= sample_rate:
+      continue
+    num_sampled_documents += 1
+    document = []
+    for line in lines:
+      token_ids = tokenizer.encode(line)
+      if token_ids:
+        document.append(array.array("i", token_ids))
+    if document:
+      documents.append(document)
+
+  serializer = ExampleSerializer(max(len(vocab.ids), max_seq_length))
+  statistics = collections.Counter()
+  seq_lengths = []
+  for _ in range(dupe_factor):
+    for document_index in range(len(documents)):
+      for instance in create_instances_from_document(
+          documents, document_index, max_seq_length, short_seq_prob,
+          masked_lm_prob, max_predictions_per_seq, vocab, rng,
+          apply_masking=write_masked_lm, masking_strategy=masking_strategy,
+          statistics=statistics):
+        seq_lengths.append(len(instance.input_ids))
+        statistics["num_masked_lm_predictions"] += len(
+            instance.masked_lm_positions)
+        # Every TFRecord also has a length and two CRCs of 16 bytes in total.
+        statistics["num_output_bytes"] += 16 + len(
+            serializer.serialize_example(
+                create_instance_features(
+                    instance, max_seq_length, max_predictions_per_seq,
+                    write_masked_lm, pad_records, 0, serializer.int_feature,
+                    serializer.float_feature)))
+  seq_lengths = np.array(seq_lengths, dtype=np.int64)
+
+  scale = 0.0
+  if num_sampled_documents:
+    scale = num_documents / num_sampled_documents
+  num_instances = len(seq_lengths)
+  num_tokens = int(seq_lengths.sum())
+
+  report = collections.OrderedDict()
+  report["num_documents"] = num_documents
+  report["num_sampled_documents"] = num_sampled_documents
+  report["num_sampled_instances"] = num_instances
+  report["projected_num_instances"] = int(round(num_instances * scale))
+  report["projected_num_tokens"] = int(round(num_tokens * scale))
+  report["projected_output_bytes"] = int(
+      round(statistics["num_output_bytes"] * scale))
+  if not num_instances:
+    return report
+
+  report["mean_seq_length"] = num_tokens / num_instances
+  report["padding_fraction"] = 1.0 - num_tokens / (
+      num_instances * max_seq_length)
+  if write_masked_lm:
+    report["mean_masked_lm_predictions"] = (
+        statistics["num_masked_lm_predictions"] / num_instances)
+  report["truncation_rate"] = (
+      statistics["num_truncated_instances"] / num_instances)
+  report["truncated_token_fraction"] = statistics["num_truncated_tokens"] / (
+      num_tokens + statistics["num_truncated_tokens"])
+
+  # Buckets hold the lengths below their boundary, so every boundary is a
+  # multiple of 8 above a quantile of the sequence lengths.
+  quantiles = np.percentile(
+      seq_lengths, [100.0 * i / num_buckets for i in range(1, num_buckets)])
+  bucket_boundaries = sorted(
+      set(int(np.ceil((x + 1) / 8.0)) * 8 for x in quantiles))
+  bucket_boundaries = [x for x in bucket_boundaries if x < max_seq_length]
+  report["recommended_bucket_boundaries"] = ",".join(
+      str(x) for x in bucket_boundaries)
+  # At most, every batch is padded to the longest length of its bucket.
+  bucket_lengths = np.array(
+      [x - 1 for x in bucket_boundaries] + [max_seq_length])
+  padded_lengths = bucket_lengths[np.searchsorted(
+      bucket_boundaries, seq_lengths, side="right")]
+  report["max_bucketed_padding_fraction"] = 1.0 - num_tokens / float(
+      padded_lengths.sum())
+  return report
+
+
+def get_shard_seed(random_seed, input_file):
+  """Returns the random seed of the shard created from `input_file`."""
+  key = "%d:%s" % (random_seed, os.path.basename(input_file))
+  return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:8], 16)
+
+
+def get_shard_output_file(output_dir, input_file):
+  """Returns the output file of the shard created from `input_file`."""
+  return os.path.join(output_dir, os.path.basename(input_file) + ".tfrecord")
+
+
+def create_shard(input_file, output_file, tokenizer, seed, max_seq_length,
+                 dupe_factor, short_seq_prob, masked_lm_prob,
+                 max_predictions_per_seq, streaming_window_size,
+                 random_document_pool_size, batch_masking, dynamic_masking,
+                 shuffle_buckets, shuffle_temp_dir, token_cache_dir,
+                 compression_type, pad_records, max_sequences_per_pack,
+                 masking_strategy, indexed_documents,
+                 weight_documents_by_length, fast_serialization):
+  """Creates one output file of TF examples from one input file.
+
+  "Random next" sentences are only drawn from the same input file.
+
+  Returns:
+    The number of instances written.
+  """
+  rng = random.Random(seed)
+  np_rng = None
+  if batch_masking:
+    np_rng = np.random.RandomState(seed)
+  if streaming_window_size > 0:
+    instances = generate_training_instances(
+        [input_file], tokenizer, max_seq_length, dupe_factor, short_seq_prob,
+        masked_lm_prob, max_predictions_per_seq, rng, streaming_window_size,
+        random_document_pool_size, np_rng, apply_masking=not dynamic_masking,
+        token_cache_dir=token_cache_dir, masking_strategy=masking_strategy)
+  else:
+    instances = create_training_instances(
+        [input_file], tokenizer, max_seq_length, dupe_factor, short_seq_prob,
+        masked_lm_prob, max_predictions_per_seq, rng, np_rng,
+        apply_masking=not dynamic_masking, token_cache_dir=token_cache_dir,
+        masking_strategy=masking_strategy,
+        indexed_documents=indexed_documents,
+        weight_documents_by_length=weight_documents_by_length)
+  if shuffle_buckets > 0:
+    instances = shuffle_instances_externally(instances, shuffle_buckets, rng,
+                                             shuffle_temp_dir)
+  if max_sequences_per_pack > 0:
+    instances = pack_instances(instances, max_seq_length,
+                               max_predictions_per_seq, max_sequences_per_pack)
+  return write_instance_to_example_files(
+      instances, tokenizer, max_seq_length, max_predictions_per_seq,
+      [output_file], write_masked_lm=not dynamic_masking,
+      compression_type=compression_type, pad_records=pad_records,
+      max_sequences_per_pack=max_sequences_per_pack,
+      fast_serialization=fast_serialization)
+
+
+def create_shards(input_files, output_dir, vocab_file, do_lower_case,
+                  random_seed, num_workers, resume=False, **shard_kwargs):
+  """Creates one output shard per input file, in a pool of processes.
+
+  A completion marker is written for every finished shard. Since every shard
+  only depends on its input file, seed and settings, a shard with a matching
+  marker does not have to be created again.
+
+  Args:
+    input_files: The input raw text files.
+    output_dir: The directory the output shards are written to.
+    vocab_file: The vocabulary file.
+    do_lower_case: Whether to lower case the input text.
+    random_seed: The seed that every shard seed is derived from.
+    num_workers: Number of processes. With 1 or fewer, the shards are created
+      in this process.
+    resume: Whether to skip the shards whose completion marker matches.
+    **shard_kwargs: The remaining arguments of `create_shard`.
+
+  Returns:
+    A list with a dict describing every shard, sorted by output file.
+  """
+  output_files = {}
+  for input_file in input_files:
+    output_file = get_shard_output_file(output_dir, input_file)
+    if output_file in output_files:
+      raise ValueError("Input files %s and %s would both be written to %s" %
+                       (output_files[output_file], input_file, output_file))
+    output_files[output_file] = input_file
+
+  tf.gfile.MakeDirs(get_shard_marker_dir(output_dir))
+  finished_shards = []
+  tasks = []
+  for (output_file, input_file) in sorted(output_files.items()):
+    seed = get_shard_seed(random_seed, input_file)
+    fingerprint = get_shard_fingerprint(input_file, seed, vocab_file,
+                                        do_lower_case, shard_kwargs)
+    shard = None
+    if resume:
+      shard = read_shard_marker(output_file, fingerprint)
+    if shard:
+      tf.logging.info("Skipping finished shard %s", output_file)
+      finished_shards.append(shard)
+    else:
+      tasks.append((input_file, output_file, seed, fingerprint, shard_kwargs))
+
+  if num_workers <= 1 or len(tasks) <= 1:
+    _init_shard_worker(vocab_file, do_lower_case)
+    shards = [_create_shard_in_worker(task) for task in tasks]
+  else:
+    pool = multiprocessing.Pool(
+        num_workers,
+        initializer=_init_shard_worker,
+        initargs=(vocab_file, do_lower_case))
+    try:
+      shards = pool.map(_create_shard_in_worker, tasks, chunksize=1)
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+  return sorted(finished_shards + shards, key=lambda x: x["output_file"])
+
+
+# The arguments of `create_shard` that do not change its output.
+_SHARD_KWARGS_WITHOUT_EFFECT = ("shuffle_temp_dir", "token_cache_dir",
+                                "indexed_documents")
+
+
+def get_shard_fingerprint(input_file, seed, vocab_file, do_lower_case,
+                          shard_kwargs):
+  """Returns a hash of everything the output shard of `input_file` depends on.
+
+  This includes the length and modification time of `input_file` and
+  `vocab_file`, so changing either of them invalidates the shard.
+  """
+  settings = dict((key, value) for (key, value) in shard_kwargs.items()
+                  if key not in _SHARD_KWARGS_WITHOUT_EFFECT)
+  files = []
+  for path in [input_file, vocab_file]:
+    stat = tf.gfile.Stat(path)
+    files.append([path, stat.length, stat.mtime_nsec])
+  key = json.dumps([files, seed, do_lower_case, settings], sort_keys=True,
+                   default=_get_object_state)
+  return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def _get_object_state(value):
+  # Objects such as masking strategies are described by their class and
+  # attributes.
+  return [type(value).__name__, vars(value)]
+
+
+def get_shard_marker_dir(output_dir):
+  """Returns the directory of the completion markers of `output_dir`."""
+  return os.path.join(output_dir, ".done")
+
+
+def get_shard_marker_file(output_file):
+  """Returns the completion marker file of a shard."""
+  return os.path.join(
+      get_shard_marker_dir(os.path.dirname(output_file)),
+      os.path.basename(output_file) + ".json")
+
+
+def read_shard_marker(output_file, fingerprint):
+  """Returns the shard dict of a finished shard, or None.
+
+  A shard is finished if its completion marker has the same `fingerprint`
+  and its output file exists.
+  """
+  marker_file = get_shard_marker_file(output_file)
+  if not (tf.gfile.Exists(marker_file) and tf.gfile.Exists(output_file)):
+    return None
+  with tf.gfile.GFile(marker_file, "r") as reader:
+    marker = json.loads(reader.read())
+  if marker.get("fingerprint") != fingerprint:
+    return None
+  return marker["shard"]
+
+
+def write_shard_marker(shard, fingerprint):
+  """Marks a shard as finished, after its output file has been written."""
+  marker = collections.OrderedDict()
+  marker["fingerprint"] = fingerprint
+  marker["shard"] = shard
+  with tf.gfile.GFile(get_shard_marker_file(shard["output_file"]),
+                      "w") as writer:
+    writer.write(json.dumps(marker, indent=2, sort_keys=True) + "\n")
+
+
+# The tokenizer of a `create_shards` worker process.
+_shard_worker_tokenizer = None
+
+
+def _init_shard_worker(vocab_file, do_lower_case):
+  global _shard_worker_tokenizer
+  _shard_worker_tokenizer = tokenization.FullTokenizer(
+      vocab_file=vocab_file, do_lower_case=do_lower_case)
+
+
+def _create_shard_in_worker(task):
+  (input_file, output_file, seed, fingerprint, shard_kwargs) = task
+  # A stale marker must not outlive a partially rewritten output file.
+  marker_file = get_shard_marker_file(output_file)
+  if tf.gfile.Exists(marker_file):
+    tf.gfile.Remove(marker_file)
+  num_examples = create_shard(input_file, output_file, _shard_worker_tokenizer,
+                              seed, **shard_kwargs)
+  shard = {
+      "input_file": input_file,
+      "output_file": output_file,
+      "seed": seed,
+      "num_examples": num_examples,
+  }
+  write_shard_marker(shard, fingerprint)
+  return shard
+
+
+def write_manifest(shards, output_dir):
+  """Writes the list of shards and their example counts as JSON."""
+  manifest = collections.OrderedDict()
+  manifest["num_examples"] = sum(shard["num_examples"] for shard in shards)
+  manifest["shards"] = shards
+  manifest_file = os.path.join(output_dir, "manifest.json")
+  with tf.gfile.GFile(manifest_file, "w") as writer:
+    writer.write(json.dumps(manifest, indent=2, sort_keys=True) + "\n")
+  return manifest_file
 
 
 def truncate_seq_pair(tokens_a, tokens_b, max_num_tokens, rng):
@@ -408,8 +1751,31 @@ def truncate_seq_pair(tokens_a, tokens_b, max_num_tokens, rng):
 def main(_):
   tf.logging.set_verbosity(tf.logging.INFO)
 
-  tokenizer = tokenization.FullTokenizer(
-      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+  if not FLAGS.dry_run and bool(FLAGS.output_file) == bool(FLAGS.output_dir):
+    raise ValueError(
+        "Exactly one of `output_file` or `output_dir` must be set.")
+  if FLAGS.unpadded_records and FLAGS.max_sequences_per_pack > 0:
+    raise ValueError(
+        "`unpadded_records` cannot be combined with `max_sequences_per_pack`.")
+  masking_strategy = get_masking_strategy(
+      FLAGS.masking_strategy, FLAGS.max_span_length, FLAGS.span_geometric_p)
+  if FLAGS.masking_strategy != "token" and (FLAGS.batch_masking or
+                                            FLAGS.dynamic_masking):
+    raise ValueError(
+        "`masking_strategy=%s` cannot be combined with `batch_masking` or "
+        "`dynamic_masking`." % FLAGS.masking_strategy)
+  if FLAGS.indexed_documents and (not FLAGS.token_cache_dir or
+                                  FLAGS.streaming_window_size > 0):
+    raise ValueError(
+        "`indexed_documents` requires `token_cache_dir` and cannot be "
+        "combined with `streaming_window_size`.")
+  if FLAGS.weight_documents_by_length and not FLAGS.indexed_documents:
+    raise ValueError(
+        "`weight_documents_by_length` requires `indexed_documents`.")
+  if FLAGS.shuffle_buckets > 0 and FLAGS.streaming_window_size <= 0:
+    raise ValueError(
+        "`shuffle_buckets` requires `streaming_window_size`, since without it "
+        "all instances are already in memory and shuffled globally.")
 
   input_files = []
   for input_pattern in FLAGS.input_file.split(","):
@@ -419,23 +1785,109 @@ def main(_):
   for input_file in input_files:
     tf.logging.info("  %s", input_file)
 
+  if FLAGS.token_cache_dir:
+    tf.gfile.MakeDirs(FLAGS.token_cache_dir)
+
+  if FLAGS.dry_run:
+    tokenizer = tokenization.FullTokenizer(
+        vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+    report = compute_corpus_statistics(
+        input_files, tokenizer, FLAGS.max_seq_length, FLAGS.dupe_factor,
+        FLAGS.short_seq_prob, FLAGS.masked_lm_prob,
+        FLAGS.max_predictions_per_seq, random.Random(FLAGS.random_seed),
+        FLAGS.dry_run_sample_rate, masking_strategy=masking_strategy,
+        write_masked_lm=not FLAGS.dynamic_masking,
+        pad_records=not FLAGS.unpadded_records)
+    tf.logging.info("*** Dry run statistics ***")
+    for (key, value) in report.items():
+      tf.logging.info("  %s = %s", key, value)
+    return
+
+  if FLAGS.output_dir:
+    tf.gfile.MakeDirs(FLAGS.output_dir)
+    shards = create_shards(
+        input_files,
+        FLAGS.output_dir,
+        FLAGS.vocab_file,
+        FLAGS.do_lower_case,
+        FLAGS.random_seed,
+        FLAGS.num_workers,
+        resume=FLAGS.resume,
+        max_seq_length=FLAGS.max_seq_length,
+        dupe_factor=FLAGS.dupe_factor,
+        short_seq_prob=FLAGS.short_seq_prob,
+        masked_lm_prob=FLAGS.masked_lm_prob,
+        max_predictions_per_seq=FLAGS.max_predictions_per_seq,
+        streaming_window_size=FLAGS.streaming_window_size,
+        random_document_pool_size=FLAGS.random_document_pool_size,
+        batch_masking=FLAGS.batch_masking,
+        dynamic_masking=FLAGS.dynamic_masking,
+        shuffle_buckets=FLAGS.shuffle_buckets,
+        shuffle_temp_dir=FLAGS.shuffle_temp_dir,
+        token_cache_dir=FLAGS.token_cache_dir,
+        compression_type=FLAGS.tfrecord_compression_type,
+        pad_records=not FLAGS.unpadded_records,
+        max_sequences_per_pack=FLAGS.max_sequences_per_pack,
+        masking_strategy=masking_strategy,
+        indexed_documents=FLAGS.indexed_documents,
+        weight_documents_by_length=FLAGS.weight_documents_by_length,
+        fast_serialization=FLAGS.fast_serialization)
+    manifest_file = write_manifest(shards, FLAGS.output_dir)
+    tf.logging.info("*** Wrote %d output files, see %s ***", len(shards),
+                    manifest_file)
+    return
+
+  tokenizer = tokenization.FullTokenizer(
+      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+
   rng = random.Random(FLAGS.random_seed)
-  instances = create_training_instances(
-      input_files, tokenizer, FLAGS.max_seq_length, FLAGS.dupe_factor,
-      FLAGS.short_seq_prob, FLAGS.masked_lm_prob, FLAGS.max_predictions_per_seq,
-      rng)
+  np_rng = None
+  if FLAGS.batch_masking:
+    np_rng = np.random.RandomState(FLAGS.random_seed)
+  if FLAGS.streaming_window_size > 0:
+    # Instances are generated lazily while they are being written.
+    instances = generate_training_instances(
+        input_files, tokenizer, FLAGS.max_seq_length, FLAGS.dupe_factor,
+        FLAGS.short_seq_prob, FLAGS.masked_lm_prob,
+        FLAGS.max_predictions_per_seq, rng, FLAGS.streaming_window_size,
+        FLAGS.random_document_pool_size, np_rng,
+        apply_masking=not FLAGS.dynamic_masking,
+        token_cache_dir=FLAGS.token_cache_dir,
+        masking_strategy=masking_strategy)
+  else:
+    instances = create_training_instances(
+        input_files, tokenizer, FLAGS.max_seq_length, FLAGS.dupe_factor,
+        FLAGS.short_seq_prob, FLAGS.masked_lm_prob,
+        FLAGS.max_predictions_per_seq, rng, np_rng,
+        apply_masking=not FLAGS.dynamic_masking,
+        token_cache_dir=FLAGS.token_cache_dir,
+        masking_strategy=masking_strategy,
+        indexed_documents=FLAGS.indexed_documents,
+        weight_documents_by_length=FLAGS.weight_documents_by_length)
+  if FLAGS.shuffle_buckets > 0:
+    instances = shuffle_instances_externally(
+        instances, FLAGS.shuffle_buckets, rng, FLAGS.shuffle_temp_dir)
+  if FLAGS.max_sequences_per_pack > 0:
+    instances = pack_instances(instances, FLAGS.max_seq_length,
+                               FLAGS.max_predictions_per_seq,
+                               FLAGS.max_sequences_per_pack)
 
   output_files = FLAGS.output_file.split(",")
   tf.logging.info("*** Writing to output files ***")
   for output_file in output_files:
     tf.logging.info("  %s", output_file)
 
-  write_instance_to_example_files(instances, tokenizer, FLAGS.max_seq_length,
-                                  FLAGS.max_predictions_per_seq, output_files)
+  write_instance_to_example_files(
+      instances, tokenizer, FLAGS.max_seq_length,
+      FLAGS.max_predictions_per_seq, output_files,
+      write_masked_lm=not FLAGS.dynamic_masking,
+      compression_type=FLAGS.tfrecord_compression_type,
+      pad_records=not FLAGS.unpadded_records,
+      max_sequences_per_pack=FLAGS.max_sequences_per_pack,
+      fast_serialization=FLAGS.fast_serialization)
 
 
 if __name__ == "__main__":
   flags.mark_flag_as_required("input_file")
-  flags.mark_flag_as_required("output_file")
   flags.mark_flag_as_required("vocab_file")
   tf.app.run()
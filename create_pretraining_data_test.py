@@ -0,0 +1,587 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import array
+import collections
+import os
+import random
+import tempfile
+
+import create_pretraining_data
+import numpy as np
+import tokenization
+import tensorflow as tf
+
+
+class CreatePretrainingDataTest(tf.test.TestCase):
+
+  def _make_vocab(self, num_words):
+    vocab = collections.OrderedDict()
+    for token in ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]:
+      vocab[token] = len(vocab)
+    for i in range(num_words):
+      vocab["word%d" % i] = len(vocab)
+    return create_pretraining_data.PretrainingVocab(vocab)
+
+  def _make_instances(self, vocab, num_instances, rng):
+    instances = []
+    for _ in range(num_instances):
+      len_a = rng.randint(1, 40)
+      len_b = rng.randint(1, 40)
+      word_ids = [rng.randint(5, len(vocab.ids) - 1)
+                  for _ in range(len_a + len_b)]
+      input_ids = array.array(
+          "i", [vocab.cls_id] + word_ids[:len_a] + [vocab.sep_id] +
+          word_ids[len_a:] + [vocab.sep_id])
+      segment_ids = (array.array("b", [0]) * (len_a + 2) +
+                     array.array("b", [1]) * (len_b + 1))
+      instances.append(
+          create_pretraining_data.TrainingInstance(
+              input_ids=input_ids,
+              segment_ids=segment_ids,
+              masked_lm_positions=array.array("i"),
+              masked_lm_ids=array.array("i"),
+              is_random_next=False))
+    return instances
+
+  def _get_statistics(self, original_ids, masked_ids, positions, labels,
+                      vocab, statistics):
+    for (position, label) in zip(positions, labels):
+      self.assertEqual(original_ids[position], label)
+      self.assertNotIn(original_ids[position], (vocab.cls_id, vocab.sep_id))
+      if masked_ids[position] == vocab.mask_id:
+        statistics["mask"] += 1
+      elif masked_ids[position] == label:
+        statistics["keep"] += 1
+      else:
+        statistics["random"] += 1
+      statistics["first_position"] += int(position == 1)
+    for (i, (original_id, masked_id)) in enumerate(zip(original_ids,
+                                                       masked_ids)):
+      if i not in positions:
+        self.assertEqual(original_id, masked_id)
+
+  def test_masked_lm_predictions_batch(self):
+    vocab = self._make_vocab(1000)
+    rng = random.Random(12345)
+    instances = self._make_instances(vocab, 3000, rng)
+    original_ids = [array.array("i", x.input_ids) for x in instances]
+
+    expected_statistics = collections.Counter()
+    expected_num_predictions = []
+    for ids in original_ids:
+      (masked_ids, positions,
+       labels) = create_pretraining_data.create_masked_lm_predictions(
+           ids, 0.15, 10, vocab, rng)
+      expected_num_predictions.append(len(positions))
+      self._get_statistics(ids, masked_ids, positions, labels, vocab,
+                           expected_statistics)
+
+    create_pretraining_data.create_masked_lm_predictions_batch(
+        instances, 0.15, 10, vocab, np.random.RandomState(12345),
+        block_size=512)
+
+    statistics = collections.Counter()
+    for (ids, instance) in zip(original_ids, instances):
+      self.assertEqual(list(instance.masked_lm_positions),
+                       sorted(instance.masked_lm_positions))
+      self.assertEqual(len(instance.input_ids), len(ids))
+      self._get_statistics(ids, instance.input_ids,
+                           instance.masked_lm_positions,
+                           instance.masked_lm_ids, vocab, statistics)
+
+    self.assertAllEqual(
+        [len(x.masked_lm_positions) for x in instances],
+        expected_num_predictions)
+
+    total = sum(expected_num_predictions)
+    for key in ["mask", "keep", "random", "first_position"]:
+      self.assertNear(
+          statistics[key] / total, expected_statistics[key] / total, 0.02)
+    self.assertNear(statistics["mask"] / total, 0.8, 0.02)
+    self.assertNear(statistics["keep"] / total, 0.1, 0.02)
+    self.assertNear(statistics["random"] / total, 0.1, 0.02)
+
+  def test_whole_word_and_span_masking(self):
+    vocab = self._make_vocab(1000)
+    continuation_ids = set(vocab.ids[5::3])
+    vocab.continuation_ids = continuation_ids
+    rng = random.Random(12345)
+    instances = self._make_instances(vocab, 300, rng)
+
+    def get_word_masks(ids, positions):
+      word_masks = []
+      for (i, token_id) in enumerate(ids):
+        is_masked = i in positions
+        if (token_id in continuation_ids and word_masks and
+            ids[i - 1] not in (vocab.cls_id, vocab.sep_id)):
+          word_masks[-1].add(is_masked)
+        elif token_id not in (vocab.cls_id, vocab.sep_id):
+          word_masks.append(set([is_masked]))
+      return word_masks
+
+    num_masked_runs = {}
+    for name in ["whole_word", "span"]:
+      masking_strategy = create_pretraining_data.get_masking_strategy(name)
+      num_masked_runs[name] = 0
+      for instance in instances:
+        (masked_ids, positions,
+         labels) = create_pretraining_data.create_masked_lm_predictions(
+             instance.input_ids, 0.15, 10, vocab, rng, masking_strategy)
+        statistics = collections.Counter()
+        self._get_statistics(instance.input_ids, masked_ids, positions,
+                             labels, vocab, statistics)
+        self.assertLessEqual(len(positions), 10)
+        for word_mask in get_word_masks(instance.input_ids, positions):
+          self.assertEqual(len(word_mask), 1)
+        num_masked_runs[name] += sum(
+            1 for (i, position) in enumerate(positions)
+            if i == 0 or positions[i - 1] != position - 1)
+
+    self.assertLess(num_masked_runs["span"], num_masked_runs["whole_word"])
+
+  def test_shuffle_instances_externally(self):
+    vocab = self._make_vocab(1000)
+    rng = random.Random(12345)
+    instances = self._make_instances(vocab, 500, rng)
+    for instance in instances[::2]:
+      (instance.input_ids, instance.masked_lm_positions,
+       instance.masked_lm_ids) = (
+           create_pretraining_data.create_masked_lm_predictions(
+               instance.input_ids, 0.15, 10, vocab, rng))
+      instance.is_random_next = True
+
+    shuffled = list(
+        create_pretraining_data.shuffle_instances_externally(
+            iter(instances), 7, rng, temp_dir=self.get_temp_dir()))
+
+    self.assertNotEqual([str(x) for x in shuffled],
+                        [str(x) for x in instances])
+    self.assertAllEqual(sorted(str(x) for x in shuffled),
+                        sorted(str(x) for x in instances))
+    self.assertAllEqual(
+        [x.segment_ids.typecode for x in shuffled],
+        [x.segment_ids.typecode for x in instances])
+
+    def shuffle(num_buckets, buffer_size):
+      return [
+          str(x) for x in create_pretraining_data.shuffle_instances_externally(
+              iter(instances), num_buckets, random.Random(1),
+              temp_dir=self.get_temp_dir(), buffer_size=buffer_size)
+      ]
+
+    # Appending the instances in small batches does not change the order.
+    self.assertEqual(shuffle(7, 33), shuffle(7, 10000))
+    # Only one bucket file is open at a time, so there can be more buckets
+    # than open files.
+    self.assertEqual(sorted(shuffle(5000, 50)),
+                     sorted(str(x) for x in instances))
+
+  def test_pack_instances(self):
+    vocab = self._make_vocab(1000)
+    rng = random.Random(12345)
+    instances = self._make_instances(vocab, 200, rng)
+    for instance in instances:
+      (instance.input_ids, instance.masked_lm_positions,
+       instance.masked_lm_ids) = (
+           create_pretraining_data.create_masked_lm_predictions(
+               instance.input_ids, 0.15, 10, vocab, rng))
+      instance.is_random_next = rng.random() < 0.5
+
+    packs = list(
+        create_pretraining_data.pack_instances(
+            instances, 128, 20, 3, max_open_packs=4))
+
+    self.assertLess(len(packs), len(instances))
+    unpacked_instances = []
+    for pack in packs:
+      self.assertLessEqual(len(pack.input_ids), 128)
+      self.assertLessEqual(len(pack.masked_lm_positions), 20)
+      self.assertLessEqual(len(pack.next_sentence_positions), 3)
+      self.assertEqual(len(pack.sequence_ids), len(pack.input_ids))
+      self.assertEqual(len(pack.position_ids), len(pack.input_ids))
+      for (i, start) in enumerate(pack.next_sentence_positions):
+        end = start + pack.sequence_ids.count(i + 1)
+        self.assertEqual(list(pack.sequence_ids[start:end]),
+                         [i + 1] * (end - start))
+        self.assertEqual(list(pack.position_ids[start:end]),
+                         list(range(end - start)))
+        positions = [
+            x - start for x in pack.masked_lm_positions if start <= x < end
+        ]
+        masked_lm_ids = [
+            y for (x, y) in zip(pack.masked_lm_positions, pack.masked_lm_ids)
+            if start <= x < end
+        ]
+        unpacked_instances.append(
+            create_pretraining_data.TrainingInstance(
+                input_ids=pack.input_ids[start:end],
+                segment_ids=pack.segment_ids[start:end],
+                masked_lm_positions=array.array("i", positions),
+                masked_lm_ids=array.array("i", masked_lm_ids),
+                is_random_next=pack.is_random_next[i]))
+
+    self.assertAllEqual(
+        sorted(str(x) for x in unpacked_instances),
+        sorted(str(x) for x in instances))
+
+  def test_example_serializer(self):
+    vocab = self._make_vocab(1000)
+    rng = random.Random(12345)
+    instances = self._make_instances(vocab, 50, rng)
+    for instance in instances:
+      (instance.input_ids, instance.masked_lm_positions,
+       instance.masked_lm_ids) = (
+           create_pretraining_data.create_masked_lm_predictions(
+               instance.input_ids, 0.15, 20, vocab, rng))
+      instance.is_random_next = rng.random() < 0.5
+    packs = list(create_pretraining_data.pack_instances(instances, 128, 20, 3))
+
+    serializer = create_pretraining_data.ExampleSerializer(len(vocab.ids))
+    for (instances_to_write, write_masked_lm, pad_records,
+         max_sequences_per_pack) in [(instances, True, True, 0),
+                                     (instances, False, True, 0),
+                                     (instances, True, False, 0),
+                                     (packs, True, True, 3)]:
+      for instance in instances_to_write:
+        features = create_pretraining_data.create_instance_features(
+            instance, 128, 20, write_masked_lm, pad_records,
+            max_sequences_per_pack)
+        tf_example = tf.train.Example(
+            features=tf.train.Features(feature=features))
+        self.assertEqual(
+            serializer.serialize_example(
+                create_pretraining_data.create_instance_features(
+                    instance, 128, 20, write_masked_lm, pad_records,
+                    max_sequences_per_pack, serializer.int_feature,
+                    serializer.float_feature)),
+            tf_example.SerializeToString(deterministic=True))
+
+    values = [-1, 0, 127, 128, 300, 1 << 40]
+    features = {
+        "ints": create_pretraining_data.create_int_feature(values),
+        "floats": create_pretraining_data.create_float_feature([0.1, -2.0]),
+        "no_ints": create_pretraining_data.create_int_feature([]),
+        "no_floats": create_pretraining_data.create_float_feature([]),
+    }
+    tf_example = tf.train.Example(features=tf.train.Features(feature=features))
+    self.assertEqual(
+        serializer.serialize_example({
+            "ints": serializer.int_feature(values),
+            "floats": serializer.float_feature([0.1, -2.0]),
+            "no_ints": serializer.int_feature([]),
+            "no_floats": serializer.float_feature([]),
+        }), tf_example.SerializeToString(deterministic=True))
+
+  def _make_vocab_file(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ",", "[MASK]"
+    ]
+    vocab_file = os.path.join(self.get_temp_dir(), "vocab.txt")
+    with open(vocab_file, "wb") as writer:
+      writer.write("".join([x + "\n" for x in vocab_tokens]).encode("utf-8"))
+    return vocab_file
+
+  def _make_tokenizer(self, do_lower_case=True):
+    return tokenization.FullTokenizer(
+        self._make_vocab_file(), do_lower_case=do_lower_case)
+
+  def _make_input_files(self, input_texts):
+    input_files = []
+    for (i, text) in enumerate(input_texts):
+      input_files.append(os.path.join(self.get_temp_dir(), "input%d.txt" % i))
+      with open(input_files[-1], "w") as writer:
+        writer.write(text)
+    return input_files
+
+  def test_token_cache(self):
+    tokenizer = self._make_tokenizer()
+    input_files = self._make_input_files([
+        "\nunwanted running\nwant\n\n\nrunning, wanted\n",
+        "unwanted\n\nxyz\n\n", "\n", "wa\nwant\n"
+    ])
+    token_cache_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+
+    expected_documents = list(
+        create_pretraining_data.read_documents(input_files, tokenizer))
+    for _ in range(2):
+      documents = list(
+          create_pretraining_data.read_documents(input_files, tokenizer,
+                                                 token_cache_dir))
+      self.assertEqual(documents, expected_documents)
+      self.assertEqual(len(os.listdir(token_cache_dir)), len(input_files))
+
+    self.assertEqual(
+        [[list(sentence) for sentence in document] for document in documents],
+        [[[7, 4, 5, 8, 9], [3]], [[8, 9, 10, 3, 5], [7, 4, 5]], [[0]],
+         [[6], [3]]])
+
+    lower_case_file = create_pretraining_data.get_token_cache_file(
+        token_cache_dir, input_files[0], tokenizer)
+    tokenizer = self._make_tokenizer(do_lower_case=False)
+    self.assertNotEqual(
+        create_pretraining_data.get_token_cache_file(
+            token_cache_dir, input_files[0], tokenizer), lower_case_file)
+
+  def test_compute_corpus_statistics(self):
+    tokenizer = self._make_tokenizer()
+    rng = random.Random(12345)
+    words = ["unwanted", "running", "want", "wa", ",", "wanted", "xyz"]
+    documents = []
+    for _ in range(40):
+      sentences = []
+      for _ in range(rng.randint(1, 10)):
+        sentences.append(" ".join(
+            rng.choice(words) for _ in range(rng.randint(1, 12))))
+      documents.append("\n".join(sentences) + "\n")
+    input_files = self._make_input_files(["\n".join(documents)])
+
+    report = create_pretraining_data.compute_corpus_statistics(
+        input_files, tokenizer, 64, 2, 0.1, 0.15, 5, random.Random(1), 1.0)
+    self.assertEqual(report["num_documents"], 40)
+    self.assertEqual(report["num_sampled_documents"], 40)
+    self.assertEqual(report["projected_num_instances"],
+                     report["num_sampled_instances"])
+    self.assertNear(report["mean_seq_length"],
+                    report["projected_num_tokens"] /
+                    report["projected_num_instances"], 1e-6)
+    self.assertNear(report["padding_fraction"],
+                    1.0 - report["mean_seq_length"] / 64, 1e-6)
+    self.assertLessEqual(report["mean_masked_lm_predictions"], 5)
+    self.assertGreater(report["truncation_rate"], 0)
+    bucket_boundaries = [
+        int(x) for x in report["recommended_bucket_boundaries"].split(",")
+    ]
+    self.assertEqual(bucket_boundaries, sorted(set(bucket_boundaries)))
+    for boundary in bucket_boundaries:
+      self.assertEqual(boundary % 8, 0)
+      self.assertLess(boundary, 64)
+    self.assertLess(report["max_bucketed_padding_fraction"],
+                    report["padding_fraction"])
+
+    # Only the lines of the sampled documents are tokenized.
+    encoded_lines = []
+    encode = tokenizer.encode
+
+    def counting_encode(line):
+      encoded_lines.append(line)
+      return encode(line)
+
+    tokenizer.encode = counting_encode
+    report = create_pretraining_data.compute_corpus_statistics(
+        input_files, tokenizer, 512, 1, 0.0, 0.15, 80, random.Random(1), 0.5)
+    self.assertLess(report["num_sampled_documents"], 40)
+    self.assertLess(len(encoded_lines),
+                    sum(len(document.split("\n")) - 1
+                        for document in documents))
+    self.assertEqual(report["truncation_rate"], 0)
+
+    # Without masked LM features in the output (`--dynamic_masking`), there
+    # are no masked LM predictions to report.
+    report = create_pretraining_data.compute_corpus_statistics(
+        input_files, tokenizer, 64, 1, 0.1, 0.15, 5, random.Random(1), 1.0,
+        write_masked_lm=False)
+    self.assertGreater(report["num_sampled_instances"], 0)
+    self.assertNotIn("mean_masked_lm_predictions", report)
+
+  def _get_shard_kwargs(self):
+    return dict(
+        max_seq_length=32, dupe_factor=2, short_seq_prob=0.1,
+        masked_lm_prob=0.15, max_predictions_per_seq=5,
+        streaming_window_size=0, random_document_pool_size=10,
+        batch_masking=False, dynamic_masking=False, shuffle_buckets=0,
+        shuffle_temp_dir=None, token_cache_dir=None, compression_type=None,
+        pad_records=True, max_sequences_per_pack=0,
+        masking_strategy=create_pretraining_data.get_masking_strategy("span"),
+        indexed_documents=False, weight_documents_by_length=False,
+        fast_serialization=False)
+
+  def _read_output_dir(self, output_dir):
+    contents = {}
+    for (dir_name, _, file_names) in os.walk(output_dir):
+      for file_name in file_names:
+        path = os.path.join(dir_name, file_name)
+        with open(path, "rb") as reader:
+          contents[os.path.relpath(path, output_dir)] = reader.read()
+    return contents
+
+  def test_create_shards_resume(self):
+    vocab_file = self._make_vocab_file()
+    input_files = self._make_input_files([
+        "unwanted running\nwant\n\nrunning, wanted\nwa\n",
+        "unwanted\nwant wa\n\nxyz\nrunning\n", "wa\nwant\nunwanted\n"
+    ])
+    output_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    shard_kwargs = self._get_shard_kwargs()
+
+    shards = create_pretraining_data.create_shards(
+        input_files[:2], output_dir, vocab_file, True, 1, 1, resume=True,
+        **shard_kwargs)
+    self.assertEqual(len(shards), 2)
+    # Skipped shards are not written again.
+    with open(shards[0]["output_file"], "wb") as writer:
+      writer.write(b"finished")
+
+    resumed_shards = create_pretraining_data.create_shards(
+        input_files, output_dir, vocab_file, True, 1, 1, resume=True,
+        **shard_kwargs)
+    self.assertEqual(resumed_shards[:2], shards)
+    self.assertEqual(len(resumed_shards), 3)
+    with open(shards[0]["output_file"], "rb") as reader:
+      self.assertEqual(reader.read(), b"finished")
+
+    shard_kwargs["dupe_factor"] = 1
+    create_pretraining_data.create_shards(
+        input_files, output_dir, vocab_file, True, 1, 1, resume=True,
+        **shard_kwargs)
+    with open(shards[0]["output_file"], "rb") as reader:
+      self.assertNotEqual(reader.read(), b"finished")
+
+  def test_create_shards_num_workers(self):
+    vocab_file = self._make_vocab_file()
+    rng = random.Random(12345)
+    words = ["unwanted", "running", "want", "wa", ",", "wanted", "xyz"]
+    input_texts = []
+    for _ in range(4):
+      documents = []
+      for _ in range(rng.randint(1, 10)):
+        sentences = []
+        for _ in range(rng.randint(1, 8)):
+          sentences.append(" ".join(
+              rng.choice(words) for _ in range(rng.randint(1, 10))))
+        documents.append("\n".join(sentences) + "\n")
+      input_texts.append("\n".join(documents))
+    input_files = self._make_input_files(input_texts)
+    output_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    shard_kwargs = self._get_shard_kwargs()
+    shard_kwargs["batch_masking"] = True
+
+    # Every shard only depends on its input file and seed, so the shards,
+    # their markers and the manifest are the same for any number of workers.
+    outputs = []
+    for num_workers in [1, 2]:
+      shards = create_pretraining_data.create_shards(
+          input_files, output_dir, vocab_file, True, 1, num_workers,
+          **shard_kwargs)
+      create_pretraining_data.write_manifest(shards, output_dir)
+      outputs.append(self._read_output_dir(output_dir))
+    self.assertEqual(len(outputs[0]), 2 * len(input_files) + 1)
+    self.assertIn("manifest.json", outputs[0])
+    self.assertEqual(outputs[1], outputs[0])
+
+  def test_document_index(self):
+    tokenizer = self._make_tokenizer()
+    rng = random.Random(12345)
+    words = ["unwanted", "running", "want", "wa", ",", "wanted", "xyz"]
+    input_texts = []
+    for _ in range(3):
+      documents = []
+      for _ in range(rng.randint(1, 20)):
+        sentences = []
+        for _ in range(rng.randint(1, 8)):
+          sentences.append(" ".join(
+              rng.choice(words) for _ in range(rng.randint(1, 10))))
+        documents.append("\n".join(sentences) + "\n")
+      input_texts.append("\n".join(documents))
+    input_files = self._make_input_files(input_texts + ["\n\n", "want\n"])
+    token_cache_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+
+    documents = list(
+        create_pretraining_data.read_documents(input_files, tokenizer))
+    document_index = create_pretraining_data.DocumentIndex(
+        input_files, tokenizer, token_cache_dir)
+    self.assertEqual(len(document_index), len(documents))
+    self.assertEqual(
+        [[document_index[i][j] for j in range(len(document_index[i]))]
+         for i in range(len(document_index))], documents)
+
+    expected_instances = create_pretraining_data.create_training_instances(
+        input_files, tokenizer, 16, 2, 0.1, 0.15, 3, random.Random(1))
+    instances = create_pretraining_data.create_training_instances(
+        input_files, tokenizer, 16, 2, 0.1, 0.15, 3, random.Random(1),
+        token_cache_dir=token_cache_dir, indexed_documents=True)
+    self.assertEqual([str(x) for x in instances],
+                     [str(x) for x in expected_instances])
+
+    document_index = create_pretraining_data.DocumentIndex(
+        input_files, tokenizer, token_cache_dir, weight_by_length=True)
+    document_index.shuffle(rng)
+    lengths = [sum(len(x) for x in document_index[i])
+               for i in range(len(document_index))]
+    counts = collections.Counter(
+        document_index.sample_document_index(rng) for _ in range(20000))
+    for (i, length) in enumerate(lengths):
+      self.assertNear(counts[i] / 20000, length / sum(lengths), 0.01)
+
+  def test_generate_training_instances(self):
+    tokenizer = self._make_tokenizer()
+    rng = random.Random(12345)
+    words = ["unwanted", "running", "want", "wa", ",", "wanted", "xyz"]
+    documents = []
+    for _ in range(30):
+      sentences = []
+      for _ in range(rng.randint(1, 8)):
+        sentences.append(" ".join(
+            rng.choice(words) for _ in range(rng.randint(1, 10))))
+      documents.append("\n".join(sentences) + "\n")
+    input_files = self._make_input_files(
+        ["\n".join(documents[:20]), "\n".join(documents[20:])])
+
+    # A window over the whole corpus is the same as reading it all at once.
+    for batch_masking in (False, True):
+      np_rngs = [None, None]
+      if batch_masking:
+        np_rngs = [np.random.RandomState(1), np.random.RandomState(1)]
+      expected_instances = create_pretraining_data.create_training_instances(
+          input_files, tokenizer, 16, 2, 0.1, 0.15, 3, random.Random(1),
+          np_rngs[0])
+      instances = create_pretraining_data.generate_training_instances(
+          input_files, tokenizer, 16, 2, 0.1, 0.15, 3, random.Random(1), 30,
+          5, np_rngs[1])
+      self.assertEqual([str(x) for x in instances],
+                       [str(x) for x in expected_instances])
+
+    # Only the window and the random document pool are candidates for
+    # "random next" sentences.
+    num_candidate_documents = []
+    create_instances_from_document = (
+        create_pretraining_data.create_instances_from_document)
+
+    def recording_create_instances_from_document(all_documents, *args,
+                                                 **kwargs):
+      num_candidate_documents.append(len(all_documents))
+      return create_instances_from_document(all_documents, *args, **kwargs)
+
+    create_pretraining_data.create_instances_from_document = (
+        recording_create_instances_from_document)
+    try:
+      instances = list(
+          create_pretraining_data.generate_training_instances(
+              input_files, tokenizer, 16, 2, 0.1, 0.15, 3, random.Random(1),
+              4, 5))
+    finally:
+      create_pretraining_data.create_instances_from_document = (
+          create_instances_from_document)
+    self.assertTrue(instances)
+    # The pool fills up but never grows past `random_document_pool_size`.
+    self.assertEqual(max(num_candidate_documents), 4 + 5)
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -71,6 +71,11 @@ flags.DEFINE_integer(
     "num_tpu_cores", 8,
     "Only used if `use_tpu` is True. Total number of TPU cores to use.")
 
+flags.DEFINE_integer(
+    "num_tokenizer_workers", 1,
+    "Number of processes used to tokenize the examples before they are "
+    "converted to features.")
+
 flags.DEFINE_bool(
     "use_one_hot_embeddings", False,
     "If True, tf.one_hot will be used for embedding lookups, otherwise "
@@ -207,16 +212,34 @@ def model_fn_builder(bert_config, init_checkpoint, layer_indexes, use_tpu,
   return model_fn
 
 
-def convert_examples_to_features(examples, seq_length, tokenizer):
+def tokenize_examples(examples, tokenizer, num_workers):
+  """Returns the (tokens_a, tokens_b) word pieces of each `InputExample`."""
+  texts = []
+  for example in examples:
+    texts.append(example.text_a)
+    texts.append(example.text_b or "")
+  tokens = tokenizer.tokenize_batch(texts, num_workers=num_workers)
+  return [(tokens[i], tokens[i + 1]) for i in range(0, len(tokens), 2)]
+
+
+def convert_examples_to_features(examples, seq_length, tokenizer,
+                                 num_tokenizer_workers=1):
   """Loads a data file into a list of `InputBatch`s."""
 
+  tokenized_examples = None
+  if num_tokenizer_workers > 1:
+    tokenized_examples = tokenize_examples(examples, tokenizer,
+                                           num_tokenizer_workers)
+
   features = []
   for (ex_index, example) in enumerate(examples):
-    tokens_a = tokenizer.tokenize(example.text_a)
-
-    tokens_b = None
-    if example.text_b:
-      tokens_b = tokenizer.tokenize(example.text_b)
+    if tokenized_examples is not None:
+      (tokens_a, tokens_b) = tokenized_examples[ex_index]
+    else:
+      tokens_a = tokenizer.tokenize(example.text_a)
+      tokens_b = None
+      if example.text_b:
+        tokens_b = tokenizer.tokenize(example.text_b)
 
     if tokens_b:
       # Modifies `tokens_a` and `tokens_b` in place so that the total
@@ -360,7 +383,10 @@ def main(_):
   examples = read_examples(FLAGS.input_file)
 
   features = convert_examples_to_features(
-      examples=examples, seq_length=FLAGS.max_seq_length, tokenizer=tokenizer)
+      examples=examples,
+      seq_length=FLAGS.max_seq_length,
+      tokenizer=tokenizer,
+      num_tokenizer_workers=FLAGS.num_tokenizer_workers)
 
   unique_id_to_feature = {}
   for feature in features:
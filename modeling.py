@@ -134,7 +134,10 @@ class BertModel(object):
                input_mask=None,
                token_type_ids=None,
                use_one_hot_embeddings=True,
-               scope=None):
+               scope=None,
+               sequence_ids=None,
+               position_ids=None,
+               pooled_positions=None):
     """Constructor for BertModel.
 
     Args:
@@ -149,6 +152,18 @@ class BertModel(object):
         it is must faster if this is True, on the CPU or GPU, it is faster if
         this is False.
       scope: (optional) variable scope. Defaults to "bert".
+      sequence_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+        For rows that pack several independent sequences, the index of the
+        sequence every token belongs to. Tokens only attend to tokens of the
+        same sequence.
+      position_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+        The position of every token within its sequence. Defaults to
+        [0, 1, ..., seq_length - 1] for every row.
+      pooled_positions: (optional) int32 Tensor of shape [batch_size,
+        num_pooled]. The positions of the tokens the pooler is applied to,
+        e.g. the [CLS] token of every packed sequence. The pooled output then
+        has shape [batch_size * num_pooled, hidden_size]. Defaults to the
+        first token of every row.
 
     Raises:
       ValueError: The config is invalid or one of the input tensor shapes
@@ -192,14 +207,15 @@ class BertModel(object):
             position_embedding_name="position_embeddings",
             initializer_range=config.initializer_range,
             max_position_embeddings=config.max_position_embeddings,
-            dropout_prob=config.hidden_dropout_prob)
+            dropout_prob=config.hidden_dropout_prob,
+            position_ids=position_ids)
 
       with tf.variable_scope("encoder"):
         # This converts a 2D mask of shape [batch_size, seq_length] to a 3D
         # mask of shape [batch_size, seq_length, seq_length] which is used
         # for the attention scores.
         attention_mask = create_attention_mask_from_input_mask(
-            input_ids, input_mask)
+            input_ids, input_mask, sequence_ids=sequence_ids)
 
         # Run the stacked transformer.
         # `sequence_output` shape = [batch_size, seq_length, hidden_size].
@@ -225,7 +241,16 @@ class BertModel(object):
       with tf.variable_scope("pooler"):
         # We "pool" the model by simply taking the hidden state corresponding
         # to the first token. We assume that this has been pre-trained
-        first_token_tensor = tf.squeeze(self.sequence_output[:, 0:1, :], axis=1)
+        if pooled_positions is None:
+          first_token_tensor = tf.squeeze(
+              self.sequence_output[:, 0:1, :], axis=1)
+        else:
+          flat_offsets = tf.reshape(
+              tf.range(0, batch_size, dtype=tf.int32) * seq_length, [-1, 1])
+          flat_positions = tf.reshape(pooled_positions + flat_offsets, [-1])
+          first_token_tensor = tf.gather(
+              tf.reshape(self.sequence_output, [-1, config.hidden_size]),
+              flat_positions)
         self.pooled_output = tf.layers.dense(
             first_token_tensor,
             config.hidden_size,
@@ -436,7 +461,8 @@ def embedding_postprocessor(input_tensor,
                             position_embedding_name="position_embeddings",
                             initializer_range=0.02,
                             max_position_embeddings=512,
-                            dropout_prob=0.1):
+                            dropout_prob=0.1,
+                            position_ids=None):
   """Performs various post-processing on a word embedding tensor.
 
   Args:
@@ -457,6 +483,9 @@ def embedding_postprocessor(input_tensor,
       used with this model. This can be longer than the sequence length of
       input_tensor, but cannot be shorter.
     dropout_prob: float. Dropout probability applied to the final output tensor.
+    position_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+      The position of every token, e.g. restarting at 0 for every sequence
+      packed into one row. Defaults to [0, 1, ..., seq_length - 1].
 
   Returns:
     float tensor with same shape as `input_tensor`.
@@ -504,31 +533,45 @@ def embedding_postprocessor(input_tensor,
       # for position [0, 1, 2, ..., max_position_embeddings-1], and the current
       # sequence has positions [0, 1, 2, ... seq_length-1], so we can just
       # perform a slice.
-      position_embeddings = tf.slice(full_position_embeddings, [0, 0],
-                                     [seq_length, -1])
-      num_dims = len(output.shape.as_list())
-
-      # Only the last two dimensions are relevant (`seq_length` and `width`), so
-      # we broadcast among the first dimensions, which is typically just
-      # the batch size.
-      position_broadcast_shape = []
-      for _ in range(num_dims - 2):
-        position_broadcast_shape.append(1)
-      position_broadcast_shape.extend([seq_length, width])
-      position_embeddings = tf.reshape(position_embeddings,
-                                       position_broadcast_shape)
+      if position_ids is None:
+        position_embeddings = tf.slice(full_position_embeddings, [0, 0],
+                                       [seq_length, -1])
+        num_dims = len(output.shape.as_list())
+
+        # Only the last two dimensions are relevant (`seq_length` and
+        # `width`), so we broadcast among the first dimensions, which is
+        # typically just the batch size.
+        position_broadcast_shape = []
+        for _ in range(num_dims - 2):
+          position_broadcast_shape.append(1)
+        position_broadcast_shape.extend([seq_length, width])
+        position_embeddings = tf.reshape(position_embeddings,
+                                         position_broadcast_shape)
+      else:
+        # Every row has its own positions here, so they are looked up like
+        # the token types.
+        flat_position_ids = tf.reshape(position_ids, [-1])
+        one_hot_ids = tf.one_hot(
+            flat_position_ids, depth=max_position_embeddings)
+        position_embeddings = tf.matmul(one_hot_ids, full_position_embeddings)
+        position_embeddings = tf.reshape(position_embeddings,
+                                         [batch_size, seq_length, width])
       output += position_embeddings
 
   output = layer_norm_and_dropout(output, dropout_prob)
   return output
 
 
-def create_attention_mask_from_input_mask(from_tensor, to_mask):
+def create_attention_mask_from_input_mask(from_tensor, to_mask,
+                                          sequence_ids=None):
   """Create 3D attention mask from a 2D tensor mask.
 
   Args:
     from_tensor: 2D or 3D Tensor of shape [batch_size, from_seq_length, ...].
     to_mask: int32 Tensor of shape [batch_size, to_seq_length].
+    sequence_ids: (optional) int32 Tensor of shape [batch_size, seq_length],
+      for from_seq_length == to_seq_length. If given, the mask is block
+      diagonal: tokens only attend to tokens with the same sequence id.
 
   Returns:
     float Tensor of shape [batch_size, from_seq_length, to_seq_length].
@@ -554,6 +597,12 @@ def create_attention_mask_from_input_mask(from_tensor, to_mask):
   # Here we broadcast along two dimensions to create the mask.
   mask = broadcast_ones * to_mask
 
+  if sequence_ids is not None:
+    same_sequence = tf.equal(
+        tf.expand_dims(sequence_ids, axis=2),
+        tf.expand_dims(sequence_ids, axis=1))
+    mask *= tf.cast(same_sequence, tf.float32)
+
   return mask
 
 
@@ -126,6 +126,50 @@ class BertModelTest(tf.test.TestCase):
   def test_default(self):
     self.run_tester(BertModelTest.BertModelTester(self))
 
+  def test_packed_sequences(self):
+    config = modeling.BertConfig(
+        vocab_size=99,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=37)
+    rng = random.Random(12345)
+    first_ids = [rng.randint(0, 98) for _ in range(3)]
+    second_ids = [rng.randint(0, 98) for _ in range(4)]
+
+    with tf.variable_scope("packed"):
+      packed_model = modeling.BertModel(
+          config=config,
+          is_training=False,
+          input_ids=tf.constant([first_ids + second_ids]),
+          sequence_ids=tf.constant([[1, 1, 1, 2, 2, 2, 2]]),
+          position_ids=tf.constant([[0, 1, 2, 0, 1, 2, 3]]),
+          pooled_positions=tf.constant([[0, 3]]),
+          scope="bert")
+    with tf.variable_scope("packed", reuse=True):
+      model = modeling.BertModel(
+          config=config,
+          is_training=False,
+          input_ids=tf.constant([first_ids + [0] * 4, second_ids + [0] * 3]),
+          input_mask=tf.constant([[1] * 3 + [0] * 4, [1] * 4 + [0] * 3]),
+          scope="bert")
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      (packed_sequence_output, packed_pooled_output, sequence_output,
+       pooled_output) = sess.run([
+           packed_model.get_sequence_output(),
+           packed_model.get_pooled_output(),
+           model.get_sequence_output(),
+           model.get_pooled_output()
+       ])
+
+    self.assertAllClose(packed_sequence_output[0, :3], sequence_output[0, :3],
+                        atol=1e-5)
+    self.assertAllClose(packed_sequence_output[0, 3:], sequence_output[1, :4],
+                        atol=1e-5)
+    self.assertAllClose(packed_pooled_output, pooled_output, atol=1e-5)
+
   def test_config_to_json_string(self):
     config = modeling.BertConfig(vocab_size=99, hidden_size=37)
     obj = json.loads(config.to_json_string())
@@ -123,6 +123,22 @@ flags.DEFINE_integer(
     "num_tpu_cores", 8,
     "Only used if `use_tpu` is True. Total number of TPU cores to use.")
 
+flags.DEFINE_integer(
+    "num_tokenizer_workers", 1,
+    "Number of processes used to tokenize the examples before they are "
+    "converted to features.")
+
+flags.DEFINE_string(
+    "tfrecord_compression_type", "",
+    "Compression type of the TFRecord files of features written to and read "
+    "from `output_dir`: \"\" (none), \"GZIP\" or \"ZLIB\".")
+
+flags.DEFINE_string(
+    "bucket_boundaries", "",
+    "Comma-separated sequence lengths, e.g. \"32,64\". If set, training and "
+    "eval examples are grouped into buckets by their real length, and every "
+    "batch is only padded to its longest example. Not supported on the TPU.")
+
 
 class InputExample(object):
   """A single training/test example for simple sequence classification."""
@@ -356,26 +372,35 @@ class ColaProcessor(DataProcessor):
 
 
 def convert_single_example(ex_index, example, label_list, max_seq_length,
-                           tokenizer):
-  """Converts a single `InputExample` into a single `InputFeatures`."""
+                           tokenizer, encoded_example=None):
+  """Converts a single `InputExample` into a single `InputFeatures`.
+
+  `encoded_example` optionally holds the (ids_a, ids_b) word piece ids of the
+  example, as returned by `encode_examples`.
+  """
   label_map = {}
   for (i, label) in enumerate(label_list):
     label_map[label] = i
 
-  tokens_a = tokenizer.tokenize(example.text_a)
-  tokens_b = None
-  if example.text_b:
-    tokens_b = tokenizer.tokenize(example.text_b)
+  # The word pieces are converted straight to ids, so the truncation below
+  # and the sequence assembly work on ids rather than token strings.
+  if encoded_example is not None:
+    (ids_a, ids_b) = encoded_example
+  else:
+    ids_a = tokenizer.encode(example.text_a)
+    ids_b = None
+    if example.text_b:
+      ids_b = tokenizer.encode(example.text_b)
 
-  if tokens_b:
-    # Modifies `tokens_a` and `tokens_b` in place so that the total
+  if ids_b:
+    # Modifies `ids_a` and `ids_b` in place so that the total
     # length is less than the specified length.
     # Account for [CLS], [SEP], [SEP] with "- 3"
-    _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
+    _truncate_seq_pair(ids_a, ids_b, max_seq_length - 3)
   else:
     # Account for [CLS] and [SEP] with "- 2"
-    if len(tokens_a) > max_seq_length - 2:
-      tokens_a = tokens_a[0:(max_seq_length - 2)]
+    if len(ids_a) > max_seq_length - 2:
+      ids_a = ids_a[0:(max_seq_length - 2)]
 
   # The convention in BERT is:
   # (a) For sequence pairs:
@@ -395,25 +420,23 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
   # For classification tasks, the first vector (corresponding to [CLS]) is
   # used as as the "sentence vector". Note that this only makes sense because
   # the entire model is fine-tuned.
-  tokens = []
+  cls_id = tokenizer.vocab["[CLS]"]
+  sep_id = tokenizer.vocab["[SEP]"]
+  input_ids = []
   segment_ids = []
-  tokens.append("[CLS]")
+  input_ids.append(cls_id)
   segment_ids.append(0)
-  for token in tokens_a:
-    tokens.append(token)
-    segment_ids.append(0)
-  tokens.append("[SEP]")
+  input_ids.extend(ids_a)
+  segment_ids.extend([0] * len(ids_a))
+  input_ids.append(sep_id)
   segment_ids.append(0)
 
-  if tokens_b:
-    for token in tokens_b:
-      tokens.append(token)
-      segment_ids.append(1)
-    tokens.append("[SEP]")
+  if ids_b:
+    input_ids.extend(ids_b)
+    segment_ids.extend([1] * len(ids_b))
+    input_ids.append(sep_id)
     segment_ids.append(1)
 
-  input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
   # The mask has 1 for real tokens and 0 for padding tokens. Only real
   # tokens are attended to.
   input_mask = [1] * len(input_ids)
@@ -432,6 +455,7 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
   if ex_index < 5:
     tf.logging.info("*** Example ***")
     tf.logging.info("guid: %s" % (example.guid))
+    tokens = tokenizer.convert_ids_to_tokens(input_ids[:sum(input_mask)])
     tf.logging.info("tokens: %s" % " ".join(
         [tokenization.printable_text(x) for x in tokens]))
     tf.logging.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
@@ -447,18 +471,39 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
   return feature
 
 
+def encode_examples(examples, tokenizer, num_workers):
+  """Returns the (ids_a, ids_b) word piece ids of each `InputExample`."""
+  texts = []
+  for example in examples:
+    texts.append(example.text_a)
+    texts.append(example.text_b or "")
+  ids = tokenizer.encode_batch(texts, num_workers=num_workers)
+  return [(ids[i], ids[i + 1]) for i in range(0, len(ids), 2)]
+
+
 def file_based_convert_examples_to_features(
-    examples, label_list, max_seq_length, tokenizer, output_file):
+    examples, label_list, max_seq_length, tokenizer, output_file,
+    num_tokenizer_workers=1, compression_type=None):
   """Convert a set of `InputExample`s to a TFRecord file."""
 
-  writer = tf.python_io.TFRecordWriter(output_file)
+  writer = tf.python_io.TFRecordWriter(
+      output_file,
+      options=tokenization.get_tfrecord_options(compression_type))
+
+  encoded_examples = None
+  if num_tokenizer_workers > 1:
+    encoded_examples = encode_examples(examples, tokenizer,
+                                       num_tokenizer_workers)
 
   for (ex_index, example) in enumerate(examples):
     if ex_index % 10000 == 0:
       tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
 
+    encoded_example = None
+    if encoded_examples is not None:
+      encoded_example = encoded_examples[ex_index]
     feature = convert_single_example(ex_index, example, label_list,
-                                     max_seq_length, tokenizer)
+                                     max_seq_length, tokenizer, encoded_example)
 
     def create_int_feature(values):
       f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
@@ -475,8 +520,13 @@ def file_based_convert_examples_to_features(
 
 
 def file_based_input_fn_builder(input_file, seq_length, is_training,
-                                drop_remainder):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+                                drop_remainder, compression_type=None,
+                                bucket_boundaries=None):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  If `bucket_boundaries` is given, the examples are batched by their real
+  length with `bucket_by_sequence_length`, which changes their order.
+  """
 
   name_to_features = {
       "input_ids": tf.FixedLenFeature([seq_length], tf.int64),
@@ -505,11 +555,22 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
 
     # For training, we want a lot of parallel reading and shuffling.
     # For eval, we want no shuffling and parallel reading doesn't matter.
-    d = tf.data.TFRecordDataset(input_file)
+    d = tf.data.TFRecordDataset(input_file, compression_type=compression_type)
     if is_training:
       d = d.repeat()
       d = d.shuffle(buffer_size=100)
 
+    if bucket_boundaries:
+      d = d.map(lambda record: _trim_padding(
+          _decode_record(record, name_to_features),
+          ["input_ids", "input_mask", "segment_ids"]))
+      d = d.apply(
+          tf.contrib.data.bucket_by_sequence_length(
+              lambda example: tf.shape(example["input_ids"])[0],
+              bucket_boundaries,
+              [batch_size] * (len(bucket_boundaries) + 1)))
+      return d
+
     d = d.apply(
         tf.contrib.data.map_and_batch(
             lambda record: _decode_record(record, name_to_features),
@@ -521,6 +582,14 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
   return input_fn
 
 
+def _trim_padding(example, sequence_names):
+  """Removes the padding of the sequence features of a decoded example."""
+  length = tf.reduce_sum(example["input_mask"])
+  for name in sequence_names:
+    example[name] = example[name][:length]
+  return example
+
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
   """Truncates a sequence pair in place to the maximum length."""
 
@@ -723,16 +792,24 @@ def input_fn_builder(features, seq_length, is_training, drop_remainder):
 # This function is not used by this file but is still used by the Colab and
 # people who depend on it.
 def convert_examples_to_features(examples, label_list, max_seq_length,
-                                 tokenizer):
+                                 tokenizer, num_tokenizer_workers=1):
   """Convert a set of `InputExample`s to a list of `InputFeatures`."""
 
+  encoded_examples = None
+  if num_tokenizer_workers > 1:
+    encoded_examples = encode_examples(examples, tokenizer,
+                                       num_tokenizer_workers)
+
   features = []
   for (ex_index, example) in enumerate(examples):
     if ex_index % 10000 == 0:
       tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
 
+    encoded_example = None
+    if encoded_examples is not None:
+      encoded_example = encoded_examples[ex_index]
     feature = convert_single_example(ex_index, example, label_list,
-                                     max_seq_length, tokenizer)
+                                     max_seq_length, tokenizer, encoded_example)
 
     features.append(feature)
   return features
@@ -760,6 +837,12 @@ def main(_):
         "was only trained up to sequence length %d" %
         (FLAGS.max_seq_length, bert_config.max_position_embeddings))
 
+  bucket_boundaries = None
+  if FLAGS.bucket_boundaries:
+    if FLAGS.use_tpu:
+      raise ValueError("`bucket_boundaries` is not supported on the TPU.")
+    bucket_boundaries = [int(x) for x in FLAGS.bucket_boundaries.split(",")]
+
   tf.gfile.MakeDirs(FLAGS.output_dir)
 
   task_name = FLAGS.task_name.lower()
@@ -822,7 +905,8 @@ def main(_):
   if FLAGS.do_train:
     train_file = os.path.join(FLAGS.output_dir, "train.tf_record")
     file_based_convert_examples_to_features(
-        train_examples, label_list, FLAGS.max_seq_length, tokenizer, train_file)
+        train_examples, label_list, FLAGS.max_seq_length, tokenizer, train_file,
+        FLAGS.num_tokenizer_workers, FLAGS.tfrecord_compression_type)
     tf.logging.info("***** Running training *****")
     tf.logging.info("  Num examples = %d", len(train_examples))
     tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
@@ -831,14 +915,17 @@ def main(_):
         input_file=train_file,
         seq_length=FLAGS.max_seq_length,
         is_training=True,
-        drop_remainder=True)
+        drop_remainder=True,
+        compression_type=FLAGS.tfrecord_compression_type,
+        bucket_boundaries=bucket_boundaries)
     estimator.train(input_fn=train_input_fn, max_steps=num_train_steps)
 
   if FLAGS.do_eval:
     eval_examples = processor.get_dev_examples(FLAGS.data_dir)
     eval_file = os.path.join(FLAGS.output_dir, "eval.tf_record")
     file_based_convert_examples_to_features(
-        eval_examples, label_list, FLAGS.max_seq_length, tokenizer, eval_file)
+        eval_examples, label_list, FLAGS.max_seq_length, tokenizer, eval_file,
+        FLAGS.num_tokenizer_workers, FLAGS.tfrecord_compression_type)
 
     tf.logging.info("***** Running evaluation *****")
     tf.logging.info("  Num examples = %d", len(eval_examples))
@@ -858,7 +945,9 @@ def main(_):
         input_file=eval_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
-        drop_remainder=eval_drop_remainder)
+        drop_remainder=eval_drop_remainder,
+        compression_type=FLAGS.tfrecord_compression_type,
+        bucket_boundaries=bucket_boundaries)
 
     result = estimator.evaluate(input_fn=eval_input_fn, steps=eval_steps)
 
@@ -874,7 +963,9 @@ def main(_):
     predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
     file_based_convert_examples_to_features(predict_examples, label_list,
                                             FLAGS.max_seq_length, tokenizer,
-                                            predict_file)
+                                            predict_file,
+                                            FLAGS.num_tokenizer_workers,
+                                            FLAGS.tfrecord_compression_type)
 
     tf.logging.info("***** Running prediction*****")
     tf.logging.info("  Num examples = %d", len(predict_examples))
@@ -890,7 +981,8 @@ def main(_):
         input_file=predict_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
-        drop_remainder=predict_drop_remainder)
+        drop_remainder=predict_drop_remainder,
+        compression_type=FLAGS.tfrecord_compression_type)
 
     result = estimator.predict(input_fn=predict_input_fn)
 
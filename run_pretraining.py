@@ -18,9 +18,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import os
 import modeling
 import optimization
+import tokenization
 import tensorflow as tf
 
 flags = tf.flags
@@ -57,6 +59,70 @@ flags.DEFINE_integer(
     "Maximum number of masked LM predictions per sequence. "
     "Must match data generation.")
 
+flags.DEFINE_bool(
+    "dynamic_masking", False,
+    "Whether the input files have no masked LM predictions (written by "
+    "`create_pretraining_data.py --dynamic_masking`) and should be masked "
+    "in the input pipeline, differently every time an example is read.")
+
+flags.DEFINE_float(
+    "masked_lm_prob", 0.15,
+    "Masked LM probability. Only used if `dynamic_masking` is True.")
+
+flags.DEFINE_string(
+    "vocab_file", None,
+    "The vocabulary file that the BERT model was trained on. Only used if "
+    "`dynamic_masking` is True.")
+
+flags.DEFINE_string(
+    "tfrecord_compression_type", "",
+    "Compression type of the input files: \"\" (none), \"GZIP\" or "
+    "\"ZLIB\". Must match data generation.")
+
+flags.DEFINE_bool(
+    "unpadded_records", False,
+    "Whether the input files hold unpadded examples, written by "
+    "`create_pretraining_data.py --unpadded_records`. Must match data "
+    "generation.")
+
+flags.DEFINE_integer(
+    "max_sequences_per_pack", 0,
+    "If > 0, the input files hold rows of packed sequences, written by "
+    "`create_pretraining_data.py --max_sequences_per_pack`. Must match data "
+    "generation.")
+
+flags.DEFINE_string(
+    "bucket_boundaries", "",
+    "Comma-separated sequence lengths, e.g. \"32,64\". If set, examples are "
+    "grouped into buckets by their real length, and every batch is only "
+    "padded to its longest example. Not supported on the TPU.")
+
+flags.DEFINE_string(
+    "phase2_input_file", None,
+    "Input TF example files (can be a glob or comma separated) for a second "
+    "phase of pre-training. If set, training switches to these files and the "
+    "`phase2_*` lengths at step `phase2_start_step`, continuing from the "
+    "checkpoint with the same optimizer state and learning rate schedule. "
+    "Eval then also uses these files.")
+
+flags.DEFINE_integer(
+    "phase2_start_step", 0,
+    "The global step at which the second phase of pre-training starts.")
+
+flags.DEFINE_integer(
+    "phase2_max_seq_length", 512,
+    "The maximum sequence length of `phase2_input_file`.")
+
+flags.DEFINE_integer(
+    "phase2_max_predictions_per_seq", 80,
+    "The maximum number of masked LM predictions per sequence of "
+    "`phase2_input_file`.")
+
+flags.DEFINE_integer(
+    "phase2_train_batch_size", None,
+    "Total batch size for the second phase of training. Defaults to "
+    "`train_batch_size`.")
+
 flags.DEFINE_bool("do_train", False, "Whether to run training.")
 
 flags.DEFINE_bool("do_eval", False, "Whether to run eval on the dev set.")
@@ -126,6 +192,13 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
     masked_lm_weights = features["masked_lm_weights"]
     next_sentence_labels = features["next_sentence_labels"]
 
+    # These are only present for rows of packed sequences, with one next
+    # sentence prediction per sequence.
+    sequence_ids = features.get("sequence_ids")
+    position_ids = features.get("position_ids")
+    next_sentence_positions = features.get("next_sentence_positions")
+    next_sentence_weights = features.get("next_sentence_weights")
+
     is_training = (mode == tf.estimator.ModeKeys.TRAIN)
 
     model = modeling.BertModel(
@@ -134,7 +207,10 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
         input_ids=input_ids,
         input_mask=input_mask,
         token_type_ids=segment_ids,
-        use_one_hot_embeddings=use_one_hot_embeddings)
+        use_one_hot_embeddings=use_one_hot_embeddings,
+        sequence_ids=sequence_ids,
+        position_ids=position_ids,
+        pooled_positions=next_sentence_positions)
 
     (masked_lm_loss,
      masked_lm_example_loss, masked_lm_log_probs) = get_masked_lm_output(
@@ -143,7 +219,8 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
 
     (next_sentence_loss, next_sentence_example_loss,
      next_sentence_log_probs) = get_next_sentence_output(
-         bert_config, model.get_pooled_output(), next_sentence_labels)
+         bert_config, model.get_pooled_output(), next_sentence_labels,
+         next_sentence_weights)
 
     total_loss = masked_lm_loss + next_sentence_loss
 
@@ -183,10 +260,14 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
           train_op=train_op,
           scaffold_fn=scaffold_fn)
     elif mode == tf.estimator.ModeKeys.EVAL:
+      if next_sentence_weights is None:
+        next_sentence_weights = tf.ones_like(
+            next_sentence_labels, dtype=tf.float32)
 
       def metric_fn(masked_lm_example_loss, masked_lm_log_probs, masked_lm_ids,
                     masked_lm_weights, next_sentence_example_loss,
-                    next_sentence_log_probs, next_sentence_labels):
+                    next_sentence_log_probs, next_sentence_labels,
+                    next_sentence_weights):
         """Computes the loss and accuracy of the model."""
         masked_lm_log_probs = tf.reshape(masked_lm_log_probs,
                                          [-1, masked_lm_log_probs.shape[-1]])
@@ -207,10 +288,13 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
         next_sentence_predictions = tf.argmax(
             next_sentence_log_probs, axis=-1, output_type=tf.int32)
         next_sentence_labels = tf.reshape(next_sentence_labels, [-1])
+        next_sentence_weights = tf.reshape(next_sentence_weights, [-1])
         next_sentence_accuracy = tf.metrics.accuracy(
-            labels=next_sentence_labels, predictions=next_sentence_predictions)
+            labels=next_sentence_labels,
+            predictions=next_sentence_predictions,
+            weights=next_sentence_weights)
         next_sentence_mean_loss = tf.metrics.mean(
-            values=next_sentence_example_loss)
+            values=next_sentence_example_loss, weights=next_sentence_weights)
 
         return {
             "masked_lm_accuracy": masked_lm_accuracy,
@@ -222,7 +306,7 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
       eval_metrics = (metric_fn, [
           masked_lm_example_loss, masked_lm_log_probs, masked_lm_ids,
           masked_lm_weights, next_sentence_example_loss,
-          next_sentence_log_probs, next_sentence_labels
+          next_sentence_log_probs, next_sentence_labels, next_sentence_weights
       ])
       output_spec = tf.contrib.tpu.TPUEstimatorSpec(
           mode=mode,
@@ -282,8 +366,13 @@ def get_masked_lm_output(bert_config, input_tensor, output_weights, positions,
   return (loss, per_example_loss, log_probs)
 
 
-def get_next_sentence_output(bert_config, input_tensor, labels):
-  """Get loss and log probs for the next sentence prediction."""
+def get_next_sentence_output(bert_config, input_tensor, labels,
+                             label_weights=None):
+  """Get loss and log probs for the next sentence prediction.
+
+  `label_weights` (1.0 for real and 0.0 for padding labels) is needed for
+  rows of packed sequences, which have a varying number of labels.
+  """
 
   # Simple binary classification. Note that 0 is "next sentence" and 1 is
   # "random sentence". This weight matrix is not used after pre-training.
@@ -301,7 +390,12 @@ def get_next_sentence_output(bert_config, input_tensor, labels):
     labels = tf.reshape(labels, [-1])
     one_hot_labels = tf.one_hot(labels, depth=2, dtype=tf.float32)
     per_example_loss = -tf.reduce_sum(one_hot_labels * log_probs, axis=-1)
-    loss = tf.reduce_mean(per_example_loss)
+    if label_weights is None:
+      loss = tf.reduce_mean(per_example_loss)
+    else:
+      label_weights = tf.reshape(label_weights, [-1])
+      loss = (tf.reduce_sum(label_weights * per_example_loss) /
+              (tf.reduce_sum(label_weights) + 1e-5))
     return (loss, per_example_loss, log_probs)
 
 
@@ -325,8 +419,24 @@ def input_fn_builder(input_files,
                      max_seq_length,
                      max_predictions_per_seq,
                      is_training,
-                     num_cpu_threads=4):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+                     num_cpu_threads=4,
+                     masking_vocab=None,
+                     masked_lm_prob=0.15,
+                     compression_type=None,
+                     unpadded_records=False,
+                     max_sequences_per_pack=0,
+                     bucket_boundaries=None):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  If `masking_vocab` (a vocab dict from `tokenization.load_vocab`) is given,
+  the input files are expected to have no masked LM features, and the masked
+  LM predictions are created in the input pipeline instead. If
+  `unpadded_records` is True, the input files are expected to hold only the
+  real tokens and predictions, which are padded by `padded_batch`. If
+  `max_sequences_per_pack` is > 0, the input files are expected to hold rows
+  of packed sequences. If `bucket_boundaries` is given, the examples are
+  batched by their real length with `bucket_by_sequence_length`.
+  """
 
   def input_fn(params):
     """The actual input function."""
@@ -339,15 +449,42 @@ def input_fn_builder(input_files,
             tf.FixedLenFeature([max_seq_length], tf.int64),
         "segment_ids":
             tf.FixedLenFeature([max_seq_length], tf.int64),
-        "masked_lm_positions":
-            tf.FixedLenFeature([max_predictions_per_seq], tf.int64),
-        "masked_lm_ids":
-            tf.FixedLenFeature([max_predictions_per_seq], tf.int64),
-        "masked_lm_weights":
-            tf.FixedLenFeature([max_predictions_per_seq], tf.float32),
         "next_sentence_labels":
             tf.FixedLenFeature([1], tf.int64),
     }
+    if max_sequences_per_pack > 0:
+      name_to_features["sequence_ids"] = tf.FixedLenFeature([max_seq_length],
+                                                            tf.int64)
+      name_to_features["position_ids"] = tf.FixedLenFeature([max_seq_length],
+                                                            tf.int64)
+      name_to_features["next_sentence_positions"] = tf.FixedLenFeature(
+          [max_sequences_per_pack], tf.int64)
+      name_to_features["next_sentence_labels"] = tf.FixedLenFeature(
+          [max_sequences_per_pack], tf.int64)
+      name_to_features["next_sentence_weights"] = tf.FixedLenFeature(
+          [max_sequences_per_pack], tf.float32)
+    if masking_vocab is None:
+      name_to_features["masked_lm_positions"] = tf.FixedLenFeature(
+          [max_predictions_per_seq], tf.int64)
+      name_to_features["masked_lm_ids"] = tf.FixedLenFeature(
+          [max_predictions_per_seq], tf.int64)
+      name_to_features["masked_lm_weights"] = tf.FixedLenFeature(
+          [max_predictions_per_seq], tf.float32)
+
+    if unpadded_records:
+      name_to_features = _get_unpadded_features(name_to_features)
+
+    def decode_fn(record):
+      example = _decode_record(record, name_to_features)
+      if unpadded_records:
+        example["input_mask"] = tf.ones_like(example["input_ids"])
+        if "masked_lm_ids" in example:
+          example["masked_lm_weights"] = tf.ones_like(
+              example["masked_lm_ids"], dtype=tf.float32)
+      if masking_vocab is not None:
+        example = _mask_example(example, max_predictions_per_seq,
+                                masked_lm_prob, masking_vocab)
+      return example
 
     # For training, we want a lot of parallel reading and shuffling.
     # For eval, we want no shuffling and parallel reading doesn't matter.
@@ -363,12 +500,14 @@ def input_fn_builder(input_files,
       # even more randomness to the training pipeline.
       d = d.apply(
           tf.contrib.data.parallel_interleave(
-              tf.data.TFRecordDataset,
+              lambda input_file: tf.data.TFRecordDataset(
+                  input_file, compression_type=compression_type),
               sloppy=is_training,
               cycle_length=cycle_length))
       d = d.shuffle(buffer_size=100)
     else:
-      d = tf.data.TFRecordDataset(input_files)
+      d = tf.data.TFRecordDataset(
+          input_files, compression_type=compression_type)
       # Since we evaluate for a fixed number of steps we don't want to encounter
       # out-of-range exceptions.
       d = d.repeat()
@@ -377,17 +516,70 @@ def input_fn_builder(input_files,
     # size dimensions. For eval, we assume we are evaluating on the CPU or GPU
     # and we *don't* want to drop the remainder, otherwise we wont cover
     # every sample.
-    d = d.apply(
-        tf.contrib.data.map_and_batch(
-            lambda record: _decode_record(record, name_to_features),
-            batch_size=batch_size,
-            num_parallel_batches=num_cpu_threads,
-            drop_remainder=True))
+    if bucket_boundaries:
+      d = d.map(
+          lambda record: _trim_padding(decode_fn(record)),
+          num_parallel_calls=num_cpu_threads)
+      d = d.apply(
+          tf.contrib.data.bucket_by_sequence_length(
+              lambda example: tf.shape(example["input_ids"])[0],
+              bucket_boundaries,
+              [batch_size] * (len(bucket_boundaries) + 1)))
+    elif unpadded_records:
+      # Every example is padded to the full lengths, which keeps the batch
+      # shapes fixed.
+      d = d.map(decode_fn, num_parallel_calls=num_cpu_threads)
+      d = d.padded_batch(
+          batch_size,
+          padded_shapes={
+              "input_ids": [max_seq_length],
+              "input_mask": [max_seq_length],
+              "segment_ids": [max_seq_length],
+              "masked_lm_positions": [max_predictions_per_seq],
+              "masked_lm_ids": [max_predictions_per_seq],
+              "masked_lm_weights": [max_predictions_per_seq],
+              "next_sentence_labels": [1],
+          },
+          drop_remainder=True)
+    else:
+      d = d.apply(
+          tf.contrib.data.map_and_batch(
+              decode_fn,
+              batch_size=batch_size,
+              num_parallel_batches=num_cpu_threads,
+              drop_remainder=True))
     return d
 
   return input_fn
 
 
+def _trim_padding(example):
+  """Removes the padding of the sequence features of a decoded example."""
+  length = tf.reduce_sum(example["input_mask"])
+  for name in ["input_ids", "input_mask", "segment_ids", "sequence_ids",
+               "position_ids"]:
+    if name in example:
+      example[name] = example[name][:length]
+  return example
+
+
+def _get_unpadded_features(name_to_features):
+  """Returns the features of unpadded records for padded `name_to_features`.
+
+  `input_mask` and `masked_lm_weights` are not stored in unpadded records,
+  and the other sequence features have variable lengths.
+  """
+  unpadded_features = {}
+  for (name, feature) in name_to_features.items():
+    if name in ("input_mask", "masked_lm_weights"):
+      continue
+    if name == "next_sentence_labels":
+      unpadded_features[name] = feature
+    else:
+      unpadded_features[name] = tf.VarLenFeature(feature.dtype)
+  return unpadded_features
+
+
 def _decode_record(record, name_to_features):
   """Decodes a record to a TensorFlow example."""
   example = tf.parse_single_example(record, name_to_features)
@@ -396,6 +588,8 @@ def _decode_record(record, name_to_features):
   # So cast all int64 to int32.
   for name in list(example.keys()):
     t = example[name]
+    if isinstance(t, tf.SparseTensor):
+      t = tf.sparse_tensor_to_dense(t)
     if t.dtype == tf.int64:
       t = tf.to_int32(t)
     example[name] = t
@@ -403,6 +597,113 @@ def _decode_record(record, name_to_features):
   return example
 
 
+def _mask_example(example, max_predictions_per_seq, masked_lm_prob, vocab):
+  """Adds masked LM predictions to a decoded example.
+
+  This follows `create_masked_lm_predictions` in `create_pretraining_data.py`:
+  `max(1, round(num_tokens * masked_lm_prob))` positions (at most
+  `max_predictions_per_seq`) other than [CLS] and [SEP] are chosen uniformly
+  at random. 80% of them are replaced with [MASK], 10% with a random word and
+  10% are kept.
+  """
+  input_ids = example["input_ids"]
+  seq_length = tf.shape(input_ids)[0]
+
+  num_tokens = tf.reduce_sum(example["input_mask"])
+  is_candidate = tf.logical_and(
+      tf.logical_and(
+          tf.cast(example["input_mask"], tf.bool),
+          tf.not_equal(input_ids, vocab["[CLS]"])),
+      tf.not_equal(input_ids, vocab["[SEP]"]))
+  num_to_predict = tf.minimum(
+      max_predictions_per_seq,
+      tf.maximum(
+          1,
+          tf.to_int32(tf.round(tf.to_float(num_tokens) * masked_lm_prob))))
+
+  # The same random ranking as `create_masked_lm_predictions_batch`: every
+  # non-candidate gets a key above all candidates, so the `num_to_predict`
+  # smallest keys are a uniform sample of the candidates.
+  keys = tf.where(is_candidate, tf.random_uniform([seq_length]),
+                  tf.fill([seq_length], 2.0))
+  (_, order) = tf.nn.top_k(-keys, k=seq_length)
+  ranks = tf.invert_permutation(order)
+  is_masked = tf.logical_and(is_candidate, ranks < num_to_predict)
+
+  # 80% of the time, replace with [MASK], 10% of the time, keep original and
+  # 10% of the time, replace with random word.
+  replacement_draws = tf.random_uniform([seq_length])
+  random_ids = tf.random_uniform(
+      [seq_length], maxval=len(vocab), dtype=tf.int32)
+  replacement_ids = tf.where(
+      replacement_draws < 0.8, tf.fill([seq_length], vocab["[MASK]"]),
+      tf.where(replacement_draws < 0.9, input_ids, random_ids))
+  example["input_ids"] = tf.where(is_masked, replacement_ids, input_ids)
+
+  # `tf.where` returns the positions in increasing order.
+  positions = tf.to_int32(tf.where(is_masked)[:, 0])
+  num_predictions = tf.shape(positions)[0]
+  padding = [[0, max_predictions_per_seq - num_predictions]]
+  example["masked_lm_positions"] = tf.reshape(
+      tf.pad(positions, padding), [max_predictions_per_seq])
+  example["masked_lm_ids"] = tf.reshape(
+      tf.pad(tf.gather(input_ids, positions), padding),
+      [max_predictions_per_seq])
+  example["masked_lm_weights"] = tf.reshape(
+      tf.pad(tf.ones([num_predictions]), padding), [max_predictions_per_seq])
+  return example
+
+
+def get_input_files(input_file):
+  """Returns the files matching a comma-separated list of globs."""
+  input_files = []
+  for input_pattern in input_file.split(","):
+    input_files.extend(tf.gfile.Glob(input_pattern))
+  return input_files
+
+
+TrainingPhase = collections.namedtuple("TrainingPhase", [
+    "input_files", "max_seq_length", "max_predictions_per_seq",
+    "train_batch_size", "max_steps"
+])
+
+
+def get_training_phases(input_files, max_seq_length, max_predictions_per_seq,
+                        train_batch_size, num_train_steps,
+                        max_position_embeddings, phase2_input_files=None,
+                        phase2_start_step=0, phase2_max_seq_length=512,
+                        phase2_max_predictions_per_seq=80,
+                        phase2_train_batch_size=None):
+  """Returns the `TrainingPhase`s of pre-training, in order.
+
+  Without `phase2_input_files`, there is a single phase of `num_train_steps`.
+  Otherwise the first phase ends at `phase2_start_step`, and the second one
+  trains on `phase2_input_files` up to `num_train_steps`.
+  """
+  if phase2_input_files is None:
+    return [
+        TrainingPhase(input_files, max_seq_length, max_predictions_per_seq,
+                      train_batch_size, num_train_steps)
+    ]
+
+  if not 0 < phase2_start_step < num_train_steps:
+    raise ValueError(
+        "`phase2_start_step` must be between 0 and `num_train_steps`.")
+  if phase2_max_seq_length > max_position_embeddings:
+    raise ValueError(
+        "Cannot use sequence length %d because the BERT model "
+        "was only trained up to sequence length %d" %
+        (phase2_max_seq_length, max_position_embeddings))
+  return [
+      TrainingPhase(input_files, max_seq_length, max_predictions_per_seq,
+                    train_batch_size, phase2_start_step),
+      TrainingPhase(phase2_input_files, phase2_max_seq_length,
+                    phase2_max_predictions_per_seq,
+                    phase2_train_batch_size or train_batch_size,
+                    num_train_steps)
+  ]
+
+
 def main(_):
   tf.logging.set_verbosity(tf.logging.INFO)
 
@@ -413,14 +714,49 @@ def main(_):
 
   tf.gfile.MakeDirs(FLAGS.output_dir)
 
-  input_files = []
-  for input_pattern in FLAGS.input_file.split(","):
-    input_files.extend(tf.gfile.Glob(input_pattern))
+  input_files = get_input_files(FLAGS.input_file)
 
   tf.logging.info("*** Input Files ***")
   for input_file in input_files:
     tf.logging.info("  %s" % input_file)
 
+  phase2_input_files = None
+  if FLAGS.phase2_input_file:
+    phase2_input_files = get_input_files(FLAGS.phase2_input_file)
+
+    tf.logging.info("*** Phase 2 Input Files ***")
+    for input_file in phase2_input_files:
+      tf.logging.info("  %s" % input_file)
+
+  training_phases = get_training_phases(
+      input_files=input_files,
+      max_seq_length=FLAGS.max_seq_length,
+      max_predictions_per_seq=FLAGS.max_predictions_per_seq,
+      train_batch_size=FLAGS.train_batch_size,
+      num_train_steps=FLAGS.num_train_steps,
+      max_position_embeddings=bert_config.max_position_embeddings,
+      phase2_input_files=phase2_input_files,
+      phase2_start_step=FLAGS.phase2_start_step,
+      phase2_max_seq_length=FLAGS.phase2_max_seq_length,
+      phase2_max_predictions_per_seq=FLAGS.phase2_max_predictions_per_seq,
+      phase2_train_batch_size=FLAGS.phase2_train_batch_size)
+
+  if FLAGS.unpadded_records and FLAGS.max_sequences_per_pack > 0:
+    raise ValueError(
+        "`unpadded_records` cannot be combined with `max_sequences_per_pack`.")
+
+  bucket_boundaries = None
+  if FLAGS.bucket_boundaries:
+    if FLAGS.use_tpu:
+      raise ValueError("`bucket_boundaries` is not supported on the TPU.")
+    bucket_boundaries = [int(x) for x in FLAGS.bucket_boundaries.split(",")]
+
+  masking_vocab = None
+  if FLAGS.dynamic_masking:
+    if not FLAGS.vocab_file:
+      raise ValueError("`vocab_file` must be set if `dynamic_masking` is True.")
+    masking_vocab = tokenization.load_vocab(FLAGS.vocab_file)
+
   tpu_cluster_resolver = None
   if FLAGS.use_tpu and FLAGS.tpu_name:
     tpu_cluster_resolver = tf.contrib.cluster_resolver.TPUClusterResolver(
@@ -455,25 +791,54 @@ def main(_):
       train_batch_size=FLAGS.train_batch_size,
       eval_batch_size=FLAGS.eval_batch_size)
 
+  # The arguments of `input_fn_builder` that are the same for every phase.
+  input_fn_kwargs = dict(
+      masking_vocab=masking_vocab,
+      masked_lm_prob=FLAGS.masked_lm_prob,
+      compression_type=FLAGS.tfrecord_compression_type,
+      unpadded_records=FLAGS.unpadded_records,
+      max_sequences_per_pack=FLAGS.max_sequences_per_pack,
+      bucket_boundaries=bucket_boundaries)
+
   if FLAGS.do_train:
-    tf.logging.info("***** Running training *****")
-    tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
-    train_input_fn = input_fn_builder(
-        input_files=input_files,
-        max_seq_length=FLAGS.max_seq_length,
-        max_predictions_per_seq=FLAGS.max_predictions_per_seq,
-        is_training=True)
-    estimator.train(input_fn=train_input_fn, max_steps=FLAGS.num_train_steps)
+    # The estimator restores the latest checkpoint in `output_dir`, so a
+    # restarted job skips the steps (and phases) that are already done.
+    for (phase_index, phase) in enumerate(training_phases):
+      if phase_index == 0:
+        tf.logging.info("***** Running training *****")
+      else:
+        tf.logging.info("***** Running training, phase %d *****",
+                        phase_index + 1)
+      tf.logging.info("  Batch size = %d", phase.train_batch_size)
+      tf.logging.info("  Max sequence length = %d", phase.max_seq_length)
+      phase_estimator = estimator
+      if phase.train_batch_size != FLAGS.train_batch_size:
+        phase_estimator = tf.contrib.tpu.TPUEstimator(
+            use_tpu=FLAGS.use_tpu,
+            model_fn=model_fn,
+            config=run_config,
+            train_batch_size=phase.train_batch_size,
+            eval_batch_size=FLAGS.eval_batch_size)
+      train_input_fn = input_fn_builder(
+          input_files=phase.input_files,
+          max_seq_length=phase.max_seq_length,
+          max_predictions_per_seq=phase.max_predictions_per_seq,
+          is_training=True,
+          **input_fn_kwargs)
+      phase_estimator.train(input_fn=train_input_fn, max_steps=phase.max_steps)
 
   if FLAGS.do_eval:
     tf.logging.info("***** Running evaluation *****")
     tf.logging.info("  Batch size = %d", FLAGS.eval_batch_size)
 
+    # Eval uses the input files of the last phase.
+    eval_phase = training_phases[-1]
     eval_input_fn = input_fn_builder(
-        input_files=input_files,
-        max_seq_length=FLAGS.max_seq_length,
-        max_predictions_per_seq=FLAGS.max_predictions_per_seq,
-        is_training=False)
+        input_files=eval_phase.input_files,
+        max_seq_length=eval_phase.max_seq_length,
+        max_predictions_per_seq=eval_phase.max_predictions_per_seq,
+        is_training=False,
+        **input_fn_kwargs)
 
     result = estimator.evaluate(
         input_fn=eval_input_fn, steps=FLAGS.max_eval_steps)
@@ -0,0 +1,287 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import random
+import tempfile
+
+import run_pretraining
+import tensorflow as tf
+
+
+class RunPretrainingTest(tf.test.TestCase):
+
+  def _make_vocab(self, num_words):
+    vocab = collections.OrderedDict()
+    for token in ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]:
+      vocab[token] = len(vocab)
+    for i in range(num_words):
+      vocab["word%d" % i] = len(vocab)
+    return vocab
+
+  def _make_input_ids(self, vocab, len_a, len_b, seq_length, rng):
+    word_ids = [rng.randint(5, len(vocab) - 1) for _ in range(len_a + len_b)]
+    input_ids = ([vocab["[CLS]"]] + word_ids[:len_a] + [vocab["[SEP]"]] +
+                 word_ids[len_a:] + [vocab["[SEP]"]])
+    input_mask = [1] * len(input_ids)
+    while len(input_ids) < seq_length:
+      input_ids.append(vocab["[PAD]"])
+      input_mask.append(0)
+    return (input_ids, input_mask)
+
+  def _make_examples(self, lengths, max_predictions_per_seq, rng):
+    """Returns unpadded examples, with their index as the second token."""
+    examples = []
+    for (i, length) in enumerate(lengths):
+      word_ids = [rng.randint(5, 99) for _ in range(length - 3)]
+      input_ids = [2, 100 + i] + word_ids + [3]
+      num_predictions = rng.randint(1, min(max_predictions_per_seq,
+                                           length - 2))
+      masked_lm_positions = sorted(rng.sample(range(1, length - 1),
+                                              num_predictions))
+      examples.append({
+          "input_ids": input_ids,
+          "segment_ids": [0] * (length // 2) + [1] * (length - length // 2),
+          "masked_lm_positions": masked_lm_positions,
+          "masked_lm_ids": [input_ids[x] for x in masked_lm_positions],
+          "next_sentence_labels": [i % 2],
+      })
+    return examples
+
+  def _write_examples(self, examples, max_seq_length, max_predictions_per_seq,
+                      pad_records):
+    """Writes examples like `create_pretraining_data.py` and returns the file.
+
+    If `pad_records` is True, the sequences are padded and `input_mask` and
+    `masked_lm_weights` are written too.
+    """
+    output_file = os.path.join(
+        tempfile.mkdtemp(dir=self.get_temp_dir()), "examples.tfrecord")
+    writer = tf.python_io.TFRecordWriter(output_file)
+    for example in examples:
+      values = dict(example)
+      if pad_records:
+        num_tokens = len(example["input_ids"])
+        num_predictions = len(example["masked_lm_ids"])
+        values["input_mask"] = [1] * num_tokens
+        values["masked_lm_weights"] = [1.0] * num_predictions
+        for name in ["input_ids", "input_mask", "segment_ids"]:
+          values[name] = values[name] + [0] * (max_seq_length - num_tokens)
+        for name in ["masked_lm_positions", "masked_lm_ids",
+                     "masked_lm_weights"]:
+          values[name] = values[name] + [0] * (
+              max_predictions_per_seq - num_predictions)
+      features = {}
+      for (name, value) in values.items():
+        if name == "masked_lm_weights":
+          features[name] = tf.train.Feature(
+              float_list=tf.train.FloatList(value=value))
+        else:
+          features[name] = tf.train.Feature(
+              int64_list=tf.train.Int64List(value=value))
+      tf_example = tf.train.Example(
+          features=tf.train.Features(feature=features))
+      writer.write(tf_example.SerializeToString())
+    writer.close()
+    return output_file
+
+  def _read_batches(self, input_fn, batch_size, num_batches):
+    dataset = input_fn({"batch_size": batch_size})
+    features = dataset.make_one_shot_iterator().get_next()
+    with self.test_session() as sess:
+      return [sess.run(features) for _ in range(num_batches)]
+
+  def test_unpadded_records(self):
+    rng = random.Random(12345)
+    max_seq_length = 64
+    max_predictions_per_seq = 5
+    examples = self._make_examples(
+        [rng.randint(8, max_seq_length) for _ in range(6)],
+        max_predictions_per_seq, rng)
+
+    all_batches = []
+    for pad_records in [True, False]:
+      input_file = self._write_examples(examples, max_seq_length,
+                                        max_predictions_per_seq, pad_records)
+      input_fn = run_pretraining.input_fn_builder(
+          [input_file], max_seq_length, max_predictions_per_seq,
+          is_training=False, unpadded_records=not pad_records)
+      # Eval repeats the input, so the fourth batch is the first again.
+      all_batches.append(self._read_batches(input_fn, 2, 4))
+
+    (padded_batches, unpadded_batches) = all_batches
+    for (padded_batch, unpadded_batch) in zip(padded_batches,
+                                              unpadded_batches):
+      self.assertEqual(sorted(unpadded_batch.keys()),
+                       sorted(padded_batch.keys()))
+      for name in padded_batch:
+        self.assertEqual(unpadded_batch[name].shape, padded_batch[name].shape)
+        self.assertEqual(unpadded_batch[name].dtype, padded_batch[name].dtype)
+        self.assertAllEqual(unpadded_batch[name], padded_batch[name])
+    self.assertAllEqual(padded_batches[0]["input_ids"][0],
+                        examples[0]["input_ids"] + [0] *
+                        (max_seq_length - len(examples[0]["input_ids"])))
+
+  def test_bucket_boundaries(self):
+    rng = random.Random(12345)
+    max_seq_length = 64
+    max_predictions_per_seq = 5
+    bucket_boundaries = [16, 32]
+    # Four examples per bucket, so every bucket only has full batches of 2
+    # and the first 6 batches are one pass over the input.
+    lengths = [rng.randint(8, 15) for _ in range(4)]
+    lengths += [rng.randint(16, 31) for _ in range(4)]
+    lengths += [rng.randint(32, max_seq_length) for _ in range(4)]
+    rng.shuffle(lengths)
+    examples = self._make_examples(lengths, max_predictions_per_seq, rng)
+
+    for pad_records in [True, False]:
+      input_file = self._write_examples(examples, max_seq_length,
+                                        max_predictions_per_seq, pad_records)
+      input_fn = run_pretraining.input_fn_builder(
+          [input_file], max_seq_length, max_predictions_per_seq,
+          is_training=False, unpadded_records=not pad_records,
+          bucket_boundaries=bucket_boundaries)
+      batches = self._read_batches(input_fn, 2, 6)
+
+      example_indices = []
+      for batch in batches:
+        batch_lengths = batch["input_mask"].sum(axis=1)
+        # Every batch is padded to its longest example, within one bucket.
+        self.assertEqual(batch["input_ids"].shape,
+                         (2, max(batch_lengths)))
+        self.assertEqual(batch["segment_ids"].shape, batch["input_ids"].shape)
+        bucket_indices = [
+            sum(1 for x in bucket_boundaries if length >= x)
+            for length in batch_lengths
+        ]
+        self.assertEqual(len(set(bucket_indices)), 1)
+        for (i, length) in enumerate(batch_lengths):
+          example = examples[batch["input_ids"][i][1] - 100]
+          self.assertAllEqual(batch["input_ids"][i][:length],
+                              example["input_ids"])
+          self.assertEqual(len(example["input_ids"]), length)
+          example_indices.append(batch["input_ids"][i][1] - 100)
+      # No example is dropped or duplicated.
+      self.assertEqual(sorted(example_indices), list(range(len(examples))))
+
+  def test_mask_example(self):
+    tf.set_random_seed(1)
+    vocab = self._make_vocab(1000)
+    rng = random.Random(12345)
+    seq_length = 128
+
+    # With [CLS] and [SEP], 50 + 50 words are 103 tokens, so there are
+    # round(103 * 0.15) = 15 predictions unless `max_predictions_per_seq` is
+    # lower. 1 word is 4 tokens, and round(4 * 0.1) = 0 is raised to 1.
+    test_cases = [(50, 50, 20, 0.15, 15), (50, 50, 10, 0.15, 10),
+                  (1, 0, 20, 0.1, 1)]
+    statistics = collections.Counter()
+    for (len_a, len_b, max_predictions_per_seq, masked_lm_prob,
+         expected_num_predictions) in test_cases:
+      (input_ids, input_mask) = self._make_input_ids(vocab, len_a, len_b,
+                                                     seq_length, rng)
+      example = {
+          "input_ids": tf.constant(input_ids, dtype=tf.int32),
+          "input_mask": tf.constant(input_mask, dtype=tf.int32),
+      }
+      example = run_pretraining._mask_example(
+          example, max_predictions_per_seq, masked_lm_prob, vocab)
+
+      with self.test_session() as sess:
+        for _ in range(200):
+          masked_example = sess.run(example)
+          positions = list(masked_example["masked_lm_positions"])
+          labels = list(masked_example["masked_lm_ids"])
+          weights = list(masked_example["masked_lm_weights"])
+          masked_ids = list(masked_example["input_ids"])
+
+          self.assertEqual(len(positions), max_predictions_per_seq)
+          self.assertEqual(len(labels), max_predictions_per_seq)
+          self.assertEqual(weights, [1.0] * expected_num_predictions +
+                           [0.0] * (max_predictions_per_seq -
+                                    expected_num_predictions))
+          self.assertEqual(
+              positions[expected_num_predictions:],
+              [0] * (max_predictions_per_seq - expected_num_predictions))
+          self.assertEqual(
+              labels[expected_num_predictions:],
+              [0] * (max_predictions_per_seq - expected_num_predictions))
+
+          positions = positions[:expected_num_predictions]
+          labels = labels[:expected_num_predictions]
+          self.assertEqual(positions, sorted(set(positions)))
+          for (position, label) in zip(positions, labels):
+            self.assertEqual(input_mask[position], 1)
+            self.assertNotIn(input_ids[position],
+                             (vocab["[CLS]"], vocab["[SEP]"]))
+            self.assertEqual(input_ids[position], label)
+            if masked_ids[position] == vocab["[MASK]"]:
+              statistics["mask"] += 1
+            elif masked_ids[position] == label:
+              statistics["keep"] += 1
+            else:
+              statistics["random"] += 1
+          for (i, (original_id, masked_id)) in enumerate(zip(input_ids,
+                                                             masked_ids)):
+            if i not in positions:
+              self.assertEqual(original_id, masked_id)
+
+    num_predictions = sum(statistics.values())
+    self.assertNear(statistics["mask"] / num_predictions, 0.8, 0.02)
+    self.assertNear(statistics["keep"] / num_predictions, 0.1, 0.02)
+    self.assertNear(statistics["random"] / num_predictions, 0.1, 0.02)
+
+  def test_get_training_phases(self):
+    phases = run_pretraining.get_training_phases(
+        input_files=["a"], max_seq_length=128, max_predictions_per_seq=20,
+        train_batch_size=256, num_train_steps=1000,
+        max_position_embeddings=512)
+    self.assertEqual(phases, [
+        run_pretraining.TrainingPhase(["a"], 128, 20, 256, 1000)])
+
+    phase_kwargs = dict(
+        input_files=["a"], max_seq_length=128, max_predictions_per_seq=20,
+        train_batch_size=256, num_train_steps=1000,
+        max_position_embeddings=512, phase2_input_files=["b"],
+        phase2_start_step=900, phase2_max_seq_length=512,
+        phase2_max_predictions_per_seq=80)
+    phases = run_pretraining.get_training_phases(**phase_kwargs)
+    self.assertEqual(phases, [
+        run_pretraining.TrainingPhase(["a"], 128, 20, 256, 900),
+        run_pretraining.TrainingPhase(["b"], 512, 80, 256, 1000)])
+
+    # `main` builds a second estimator for a different phase 2 batch size.
+    phases = run_pretraining.get_training_phases(
+        phase2_train_batch_size=32, **phase_kwargs)
+    self.assertEqual([phase.train_batch_size for phase in phases], [256, 32])
+
+    for phase2_start_step in [-1, 0, 1000, 1001]:
+      phase_kwargs["phase2_start_step"] = phase2_start_step
+      with self.assertRaises(ValueError):
+        run_pretraining.get_training_phases(**phase_kwargs)
+
+    phase_kwargs["phase2_start_step"] = 900
+    phase_kwargs["phase2_max_seq_length"] = 1024
+    with self.assertRaises(ValueError):
+      run_pretraining.get_training_phases(**phase_kwargs)
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -153,11 +153,26 @@ flags.DEFINE_float(
     "null_score_diff_threshold", 0.0,
     "If null_score - best_non_null is greater than the threshold predict null.")
 
+flags.DEFINE_string(
+    "tfrecord_compression_type", "",
+    "Compression type of the TFRecord files of features written to and read "
+    "from `output_dir`: \"\" (none), \"GZIP\" or \"ZLIB\".")
+
+flags.DEFINE_string(
+    "bucket_boundaries", "",
+    "Comma-separated sequence lengths, e.g. \"128,256\". If set, features "
+    "are grouped into buckets by their real length, and every batch is only "
+    "padded to its longest feature. Not supported on the TPU.")
+
 
 class SquadExample(object):
   """A single training/test example for simple sequence classification.
 
      For examples without an answer, the start and end position are -1.
+
+     `paragraph_text` and `char_to_word_offset` are optional. When they are
+     given, the paragraph is tokenized in one pass and predictions are
+     projected back to the paragraph through character offsets.
   """
 
   def __init__(self,
@@ -167,10 +182,14 @@ class SquadExample(object):
                orig_answer_text=None,
                start_position=None,
                end_position=None,
-               is_impossible=False):
+               is_impossible=False,
+               paragraph_text=None,
+               char_to_word_offset=None):
     self.qas_id = qas_id
     self.question_text = question_text
     self.doc_tokens = doc_tokens
+    self.paragraph_text = paragraph_text
+    self.char_to_word_offset = char_to_word_offset
     self.orig_answer_text = orig_answer_text
     self.start_position = start_position
     self.end_position = end_position
@@ -209,12 +228,14 @@ class InputFeatures(object):
                segment_ids,
                start_position=None,
                end_position=None,
-               is_impossible=None):
+               is_impossible=None,
+               token_to_char_span=None):
     self.unique_id = unique_id
     self.example_index = example_index
     self.doc_span_index = doc_span_index
     self.tokens = tokens
     self.token_to_orig_map = token_to_orig_map
+    self.token_to_char_span = token_to_char_span
     self.token_is_max_context = token_is_max_context
     self.input_ids = input_ids
     self.input_mask = input_mask
@@ -300,7 +321,9 @@ def read_squad_examples(input_file, is_training):
             orig_answer_text=orig_answer_text,
             start_position=start_position,
             end_position=end_position,
-            is_impossible=is_impossible)
+            is_impossible=is_impossible,
+            paragraph_text=paragraph_text,
+            char_to_word_offset=char_to_word_offset)
         examples.append(example)
 
   return examples
@@ -313,21 +336,20 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
 
   unique_id = 1000000000
 
+  prev_paragraph_text = None
   for (example_index, example) in enumerate(examples):
     query_tokens = tokenizer.tokenize(example.question_text)
 
     if len(query_tokens) > max_query_length:
       query_tokens = query_tokens[0:max_query_length]
 
-    tok_to_orig_index = []
-    orig_to_tok_index = []
-    all_doc_tokens = []
-    for (i, token) in enumerate(example.doc_tokens):
-      orig_to_tok_index.append(len(all_doc_tokens))
-      sub_tokens = tokenizer.tokenize(token)
-      for sub_token in sub_tokens:
-        tok_to_orig_index.append(i)
-        all_doc_tokens.append(sub_token)
+    # Consecutive examples usually share a paragraph, so its tokenization is
+    # reused until the paragraph changes.
+    if (example.paragraph_text is None or
+        example.paragraph_text is not prev_paragraph_text):
+      prev_paragraph_text = example.paragraph_text
+      (all_doc_tokens, all_doc_char_spans, tok_to_orig_index,
+       orig_to_tok_index) = _tokenize_doc(example, tokenizer)
 
     tok_start_position = None
     tok_end_position = None
@@ -366,6 +388,9 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
     for (doc_span_index, doc_span) in enumerate(doc_spans):
       tokens = []
       token_to_orig_map = {}
+      token_to_char_span = None
+      if all_doc_char_spans is not None:
+        token_to_char_span = {}
       token_is_max_context = {}
       segment_ids = []
       tokens.append("[CLS]")
@@ -379,6 +404,9 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
       for i in range(doc_span.length):
         split_token_index = doc_span.start + i
         token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
+        if token_to_char_span is not None:
+          token_to_char_span[len(tokens)] = (
+              all_doc_char_spans[split_token_index])
 
         is_max_context = _check_is_max_context(doc_spans, doc_span_index,
                                                split_token_index)
@@ -464,7 +492,8 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
           segment_ids=segment_ids,
           start_position=start_position,
           end_position=end_position,
-          is_impossible=example.is_impossible)
+          is_impossible=example.is_impossible,
+          token_to_char_span=token_to_char_span)
 
       # Run callback
       output_fn(feature)
@@ -472,6 +501,43 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
       unique_id += 1
 
 
+def _tokenize_doc(example, tokenizer):
+  """Tokenizes the document of a `SquadExample` into word pieces.
+
+  Returns:
+    A tuple (doc_tokens, doc_char_spans, tok_to_orig_index, orig_to_tok_index).
+    `doc_char_spans[i]` is the (start, end) span of `doc_tokens[i]` in
+    `example.paragraph_text`, or `doc_char_spans` is None if the example has
+    no paragraph text.
+  """
+  tok_to_orig_index = []
+  orig_to_tok_index = []
+
+  if example.paragraph_text is None:
+    doc_tokens = []
+    for (i, token) in enumerate(example.doc_tokens):
+      orig_to_tok_index.append(len(doc_tokens))
+      sub_tokens = tokenizer.tokenize(token)
+      for sub_token in sub_tokens:
+        tok_to_orig_index.append(i)
+        doc_tokens.append(sub_token)
+    return (doc_tokens, None, tok_to_orig_index, orig_to_tok_index)
+
+  # Every whitespace character of `read_squad_examples` is also whitespace to
+  # the tokenizer, so tokenizing the whole paragraph gives the same word pieces
+  # as tokenizing each of `example.doc_tokens`, along with their offsets.
+  (doc_tokens, doc_char_spans) = tokenizer.tokenize_with_offsets(
+      example.paragraph_text)
+  for (start, _) in doc_char_spans:
+    orig_index = example.char_to_word_offset[start]
+    while len(orig_to_tok_index) <= orig_index:
+      orig_to_tok_index.append(len(tok_to_orig_index))
+    tok_to_orig_index.append(orig_index)
+  while len(orig_to_tok_index) < len(example.doc_tokens):
+    orig_to_tok_index.append(len(tok_to_orig_index))
+  return (doc_tokens, doc_char_spans, tok_to_orig_index, orig_to_tok_index)
+
+
 def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
                          orig_answer_text):
   """Returns tokenized answer spans that better match the annotated answer."""
@@ -683,8 +749,13 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
   return model_fn
 
 
-def input_fn_builder(input_file, seq_length, is_training, drop_remainder):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+def input_fn_builder(input_file, seq_length, is_training, drop_remainder,
+                     compression_type=None, bucket_boundaries=None):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  If `bucket_boundaries` is given, the features are batched by their real
+  length with `bucket_by_sequence_length`, which changes their order.
+  """
 
   name_to_features = {
       "unique_ids": tf.FixedLenFeature([], tf.int64),
@@ -717,11 +788,22 @@ def input_fn_builder(input_file, seq_length, is_training, drop_remainder):
 
     # For training, we want a lot of parallel reading and shuffling.
     # For eval, we want no shuffling and parallel reading doesn't matter.
-    d = tf.data.TFRecordDataset(input_file)
+    d = tf.data.TFRecordDataset(input_file, compression_type=compression_type)
     if is_training:
       d = d.repeat()
       d = d.shuffle(buffer_size=100)
 
+    if bucket_boundaries:
+      d = d.map(lambda record: _trim_padding(
+          _decode_record(record, name_to_features),
+          ["input_ids", "input_mask", "segment_ids"]))
+      d = d.apply(
+          tf.contrib.data.bucket_by_sequence_length(
+              lambda example: tf.shape(example["input_ids"])[0],
+              bucket_boundaries,
+              [batch_size] * (len(bucket_boundaries) + 1)))
+      return d
+
     d = d.apply(
         tf.contrib.data.map_and_batch(
             lambda record: _decode_record(record, name_to_features),
@@ -733,6 +815,14 @@ def input_fn_builder(input_file, seq_length, is_training, drop_remainder):
   return input_fn
 
 
+def _trim_padding(example, sequence_names):
+  """Removes the padding of the sequence features of a decoded example."""
+  length = tf.reduce_sum(example["input_mask"])
+  for name in sequence_names:
+    example[name] = example[name][:length]
+  return example
+
+
 RawResult = collections.namedtuple("RawResult",
                                    ["unique_id", "start_logits", "end_logits"])
 
@@ -831,7 +921,17 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
       if len(nbest) >= n_best_size:
         break
       feature = features[pred.feature_index]
-      if pred.start_index > 0:  # this is a non-null prediction
+      if pred.start_index > 0 and feature.token_to_char_span is not None:
+        # The word pieces know their character spans in the paragraph, so the
+        # prediction is a direct slice of the original text.
+        (orig_char_start, _) = feature.token_to_char_span[pred.start_index]
+        (_, orig_char_end) = feature.token_to_char_span[pred.end_index]
+        final_text = example.paragraph_text[orig_char_start:orig_char_end]
+        if final_text in seen_predictions:
+          continue
+
+        seen_predictions[final_text] = True
+      elif pred.start_index > 0:  # this is a non-null prediction
         tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
         orig_doc_start = feature.token_to_orig_map[pred.start_index]
         orig_doc_end = feature.token_to_orig_map[pred.end_index]
@@ -1057,11 +1157,13 @@ def _compute_softmax(scores):
 class FeatureWriter(object):
   """Writes InputFeature to TF example file."""
 
-  def __init__(self, filename, is_training):
+  def __init__(self, filename, is_training, compression_type=None):
     self.filename = filename
     self.is_training = is_training
     self.num_features = 0
-    self._writer = tf.python_io.TFRecordWriter(filename)
+    self._writer = tf.python_io.TFRecordWriter(
+        filename,
+        options=tokenization.get_tfrecord_options(compression_type))
 
   def process_feature(self, feature):
     """Write a InputFeature to the TFRecordWriter as a tf.train.Example."""
@@ -1118,6 +1220,9 @@ def validate_flags_or_throw(bert_config):
         "The max_seq_length (%d) must be greater than max_query_length "
         "(%d) + 3" % (FLAGS.max_seq_length, FLAGS.max_query_length))
 
+  if FLAGS.bucket_boundaries and FLAGS.use_tpu:
+    raise ValueError("`bucket_boundaries` is not supported on the TPU.")
+
 
 def main(_):
   tf.logging.set_verbosity(tf.logging.INFO)
@@ -1126,6 +1231,10 @@ def main(_):
 
   validate_flags_or_throw(bert_config)
 
+  bucket_boundaries = None
+  if FLAGS.bucket_boundaries:
+    bucket_boundaries = [int(x) for x in FLAGS.bucket_boundaries.split(",")]
+
   tf.gfile.MakeDirs(FLAGS.output_dir)
 
   tokenizer = tokenization.FullTokenizer(
@@ -1185,7 +1294,8 @@ def main(_):
     # in memory.
     train_writer = FeatureWriter(
         filename=os.path.join(FLAGS.output_dir, "train.tf_record"),
-        is_training=True)
+        is_training=True,
+        compression_type=FLAGS.tfrecord_compression_type)
     convert_examples_to_features(
         examples=train_examples,
         tokenizer=tokenizer,
@@ -1207,7 +1317,9 @@ def main(_):
         input_file=train_writer.filename,
         seq_length=FLAGS.max_seq_length,
         is_training=True,
-        drop_remainder=True)
+        drop_remainder=True,
+        compression_type=FLAGS.tfrecord_compression_type,
+        bucket_boundaries=bucket_boundaries)
     estimator.train(input_fn=train_input_fn, max_steps=num_train_steps)
 
   if FLAGS.do_predict:
@@ -1216,7 +1328,8 @@ def main(_):
 
     eval_writer = FeatureWriter(
         filename=os.path.join(FLAGS.output_dir, "eval.tf_record"),
-        is_training=False)
+        is_training=False,
+        compression_type=FLAGS.tfrecord_compression_type)
     eval_features = []
 
     def append_feature(feature):
@@ -1244,7 +1357,9 @@ def main(_):
         input_file=eval_writer.filename,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
-        drop_remainder=False)
+        drop_remainder=False,
+        compression_type=FLAGS.tfrecord_compression_type,
+        bucket_boundaries=bucket_boundaries)
 
     # If running eval on the TPU, you will need to specify the number of
     # steps.
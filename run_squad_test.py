@@ -0,0 +1,89 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import random
+import tempfile
+
+import run_squad
+import tensorflow as tf
+
+
+def _create_int_feature(values):
+  return tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+
+
+class RunSquadTest(tf.test.TestCase):
+
+  def test_bucket_boundaries(self):
+    rng = random.Random(12345)
+    seq_length = 64
+    bucket_boundaries = [16, 32]
+    lengths = [rng.randint(2, seq_length) for _ in range(25)]
+
+    input_file = os.path.join(
+        tempfile.mkdtemp(dir=self.get_temp_dir()), "eval.tf_record")
+    writer = tf.python_io.TFRecordWriter(input_file)
+    all_input_ids = []
+    for (unique_id, length) in enumerate(lengths):
+      input_ids = [rng.randint(5, 99) for _ in range(length)]
+      all_input_ids.append(input_ids)
+      padding = [0] * (seq_length - length)
+      features = {
+          "input_ids": _create_int_feature(input_ids + padding),
+          "input_mask": _create_int_feature([1] * length + padding),
+          "segment_ids": _create_int_feature([0] * seq_length),
+          "unique_ids": _create_int_feature([unique_id]),
+      }
+      tf_example = tf.train.Example(
+          features=tf.train.Features(feature=features))
+      writer.write(tf_example.SerializeToString())
+    writer.close()
+
+    input_fn = run_squad.input_fn_builder(
+        input_file, seq_length, is_training=False, drop_remainder=False,
+        bucket_boundaries=bucket_boundaries)
+    dataset = input_fn({"batch_size": 4})
+    features = dataset.make_one_shot_iterator().get_next()
+
+    unique_ids = []
+    with self.test_session() as sess:
+      while True:
+        try:
+          batch = sess.run(features)
+        except tf.errors.OutOfRangeError:
+          break
+        batch_lengths = batch["input_mask"].sum(axis=1)
+        # Every batch is padded to its longest example, within one bucket.
+        self.assertEqual(batch["input_ids"].shape,
+                         (len(batch_lengths), max(batch_lengths)))
+        bucket_indices = [
+            sum(1 for x in bucket_boundaries if length >= x)
+            for length in batch_lengths
+        ]
+        self.assertEqual(len(set(bucket_indices)), 1)
+        for (i, unique_id) in enumerate(batch["unique_ids"]):
+          self.assertAllEqual(batch["input_ids"][i][:batch_lengths[i]],
+                              all_input_ids[unique_id])
+          unique_ids.append(unique_id)
+    # No example is dropped or duplicated.
+    self.assertEqual(sorted(unique_ids), list(range(len(lengths))))
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -18,11 +18,22 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import array
 import collections
+import itertools
+import mmap
+import multiprocessing
+import struct
+import sys
 import unicodedata
 import six
 import tensorflow as tf
 
+try:
+  from collections.abc import Mapping  # pylint: disable=g-importing-member
+except ImportError:
+  from collections import Mapping  # pylint: disable=g-importing-member
+
 
 def convert_to_unicode(text):
   """Converts `text` to Unicode (if it's not already), assuming utf-8 input."""
@@ -68,20 +79,250 @@ def printable_text(text):
 
 
 def load_vocab(vocab_file):
-  """Loads a vocabulary file into a dictionary."""
+  """Loads a vocabulary file into a dictionary.
+
+  If a compiled copy of `vocab_file` (see `compile_vocab`) exists and is up to
+  date, a memory-mapped `CompiledVocab` is returned instead, which behaves
+  like the dictionary but does not have to be built.
+  """
+  compiled_vocab = _load_compiled_vocab(vocab_file)
+  if compiled_vocab is not None:
+    return compiled_vocab
+  return _tokens_to_vocab(_load_text_vocab_tokens(vocab_file))
+
+
+def invert_vocab(vocab):
+  """Returns the mapping from ids to tokens of a vocab."""
+  if isinstance(vocab, CompiledVocab):
+    return vocab.inverse()
+  return {v: k for k, v in vocab.items()}
+
+
+def _tokens_to_vocab(tokens):
   vocab = collections.OrderedDict()
-  index = 0
-  with tf.gfile.GFile(vocab_file, "r") as reader:
-    while True:
-      token = convert_to_unicode(reader.readline())
-      if not token:
-        break
-      token = token.strip()
-      vocab[token] = index
-      index += 1
+  for (index, token) in enumerate(tokens):
+    vocab[token] = index
   return vocab
 
 
+# File name suffix and header of a compiled vocabulary file. The header
+# records the magic string, the size and modification time of the text
+# vocabulary it was compiled from, the number of distinct tokens, the number
+# of ids, and the number of nodes and hash table slots of the two word piece
+# tries.
+_COMPILED_VOCAB_SUFFIX = ".compiled"
+_COMPILED_VOCAB_MAGIC = b"BERTVOC2"
+_COMPILED_VOCAB_HEADER = struct.Struct("<8sqqIIIIII")
+
+
+def get_compiled_vocab_file(vocab_file):
+  """Returns the path of the compiled copy of `vocab_file`."""
+  return vocab_file + _COMPILED_VOCAB_SUFFIX
+
+
+def compile_vocab(vocab_file):
+  """Writes a compiled copy of `vocab_file` next to it for faster loading.
+
+  The compiled file holds the tokens and both word piece tries of
+  `WordpieceTokenizer` as flat arrays, so `load_vocab` can memory-map it
+  instead of building a dictionary and the tries in every process. After the
+  header, it contains these little-endian uint32 arrays:
+
+    * The byte offset of every distinct token in the token data, in the
+      order of `load_vocab`, and their ids.
+    * For every id, the index of its token (0xffffffff if it has none).
+    * For each trie (all tokens, and the "##" tokens without the prefix): the
+      id + 1 of the token ending at every node (0 for none), and an
+      open-addressing hash table of the edges, as parallel arrays of parent
+      node + 1 (0 for an empty slot), character and child node.
+
+  followed by the UTF-8 encoded tokens. It is ignored by `load_vocab` once
+  `vocab_file` changes.
+
+  Args:
+    vocab_file: The text vocabulary file.
+
+  Returns:
+    The path of the compiled vocabulary file.
+  """
+  (source_length, source_mtime) = _get_file_stats(vocab_file)
+  tokens = _load_text_vocab_tokens(vocab_file)
+  entries = list(_tokens_to_vocab(tokens).items())
+
+  token_data = []
+  token_offsets = [0]
+  for (token, _) in entries:
+    token_data.append(token.encode("utf-8"))
+    token_offsets.append(token_offsets[-1] + len(token_data[-1]))
+  id_entries = [_NO_ENTRY] * len(tokens)
+  for (entry_index, (_, token_id)) in enumerate(entries):
+    id_entries[token_id] = entry_index
+
+  word_start_trie = _build_flat_trie(entries)
+  word_continuation_trie = _build_flat_trie(
+      [(token[2:], token_id)
+       for (token, token_id) in entries
+       if token.startswith("##")])
+
+  arrays = [token_offsets, [x[1] for x in entries], id_entries]
+  arrays.extend(word_start_trie)
+  arrays.extend(word_continuation_trie)
+
+  compiled_vocab_file = get_compiled_vocab_file(vocab_file)
+  with tf.gfile.GFile(compiled_vocab_file, "wb") as writer:
+    writer.write(
+        _COMPILED_VOCAB_HEADER.pack(
+            _COMPILED_VOCAB_MAGIC, source_length, source_mtime, len(entries),
+            len(tokens), len(word_start_trie[0]), len(word_start_trie[1]),
+            len(word_continuation_trie[0]), len(word_continuation_trie[1])))
+    for values in arrays:
+      writer.write(struct.pack("<%dI" % len(values), *values))
+    writer.write(b"".join(token_data))
+  return compiled_vocab_file
+
+
+def _load_text_vocab_tokens(vocab_file):
+  """Returns the tokens of a text vocabulary file, one per line."""
+  with tf.gfile.GFile(vocab_file, "rb") as reader:
+    lines = convert_to_unicode(reader.read()).split("\n")
+  # A trailing newline does not start another token.
+  if lines and not lines[-1]:
+    lines.pop()
+  return [line.strip() for line in lines]
+
+
+def _load_compiled_vocab(vocab_file):
+  """Returns the `CompiledVocab` of an up-to-date compiled vocab, or None."""
+  compiled_vocab_file = get_compiled_vocab_file(vocab_file)
+  if not tf.gfile.Exists(compiled_vocab_file):
+    return None
+
+  data = _map_file(compiled_vocab_file)
+  if len(data) < _COMPILED_VOCAB_HEADER.size:
+    return None
+  header = _COMPILED_VOCAB_HEADER.unpack_from(data, 0)
+  if header[0] != _COMPILED_VOCAB_MAGIC:
+    return None
+  if header[1:3] != _get_file_stats(vocab_file):
+    tf.logging.warning("Ignoring out of date compiled vocab file %s",
+                       compiled_vocab_file)
+    return None
+  return CompiledVocab(vocab_file, data, *header[3:])
+
+
+def _map_file(path):
+  """Memory-maps a local file, or reads any other file into memory."""
+  try:
+    with open(path, "rb") as reader:
+      return mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+  except (IOError, OSError, ValueError):
+    with tf.gfile.GFile(path, "rb") as reader:
+      return reader.read()
+
+
+def _get_file_stats(path):
+  """Returns the (length, modification time) of a file."""
+  stat = tf.gfile.Stat(path)
+  return (stat.length, stat.mtime_nsec)
+
+
+# The id entry of an id without a token, and the multiplier of the trie edge
+# hash.
+_NO_ENTRY = 0xffffffff
+_TRIE_HASH_MULTIPLIER = 0x9e3779b1
+
+
+class CompiledVocab(Mapping):
+  """A read-only vocab dictionary backed by a compiled vocabulary file.
+
+  Tokens are looked up in the memory-mapped word piece trie, and are iterated
+  in the same order as the dictionary of `load_vocab`. A pickled
+  `CompiledVocab` is loaded again from `vocab_file` when it is unpickled.
+  """
+
+  def __init__(self, vocab_file, data, num_entries, num_ids, num_start_nodes,
+               num_start_slots, num_continuation_nodes,
+               num_continuation_slots):
+    self.vocab_file = vocab_file
+    self._data = data
+    self._num_entries = num_entries
+    arrays = []
+    offset = _COMPILED_VOCAB_HEADER.size
+    for count in [
+        num_entries + 1, num_entries, num_ids, num_start_nodes,
+        num_start_slots, num_start_slots, num_start_slots,
+        num_continuation_nodes, num_continuation_slots,
+        num_continuation_slots, num_continuation_slots
+    ]:
+      arrays.append(_uint32_array(data, offset, count))
+      offset += 4 * count
+    (self._token_offsets, self._entry_ids, self._id_entries) = arrays[:3]
+    self._token_data_start = offset
+    self.word_start_trie = _FlatTrie(*arrays[3:7])
+    self.word_continuation_trie = _FlatTrie(*arrays[7:11])
+
+  def __reduce__(self):
+    # The memory map cannot be pickled, so the file is mapped again.
+    return (load_vocab, (self.vocab_file,))
+
+  def __getitem__(self, token):
+    token_id = self.word_start_trie.get(token)
+    if token_id is None:
+      raise KeyError(token)
+    return token_id
+
+  def __iter__(self):
+    for entry_index in range(self._num_entries):
+      yield self._get_token(entry_index)
+
+  def __len__(self):
+    return self._num_entries
+
+  def items(self):
+    return [(self._get_token(entry_index), self._entry_ids[entry_index])
+            for entry_index in range(self._num_entries)]
+
+  def values(self):
+    return list(self._entry_ids)
+
+  def inverse(self):
+    """Returns the mapping from ids to tokens."""
+    return _CompiledInverseVocab(self)
+
+  def _get_token(self, entry_index):
+    start = self._token_data_start + self._token_offsets[entry_index]
+    end = self._token_data_start + self._token_offsets[entry_index + 1]
+    return self._data[start:end].decode("utf-8")
+
+
+class _CompiledInverseVocab(object):
+  """The mapping from ids to tokens of a `CompiledVocab`."""
+
+  def __init__(self, vocab):
+    self._vocab = vocab
+
+  def __reduce__(self):
+    return (invert_vocab, (self._vocab,))
+
+  def __getitem__(self, token_id):
+    if not 0 <= token_id < len(self._vocab._id_entries):
+      raise KeyError(token_id)
+    entry_index = self._vocab._id_entries[token_id]
+    if entry_index == _NO_ENTRY:
+      raise KeyError(token_id)
+    return self._vocab._get_token(entry_index)
+
+
+def _uint32_array(data, offset, count):
+  """Returns a view of `count` little-endian uint32s at `offset` of `data`."""
+  if six.PY3 and sys.byteorder == "little":
+    return memoryview(data)[offset:offset + 4 * count].cast("I")
+  values = array.array("I", bytes(data[offset:offset + 4 * count]))
+  if sys.byteorder != "little":
+    values.byteswap()
+  return values
+
+
 def convert_by_vocab(vocab, items):
   """Converts a sequence of [tokens|ids] using the vocab."""
   output = []
@@ -98,6 +339,24 @@ def convert_ids_to_tokens(inv_vocab, ids):
   return convert_by_vocab(inv_vocab, ids)
 
 
+def get_tfrecord_options(compression_type):
+  """Returns the `TFRecordWriter` options for a compression type flag.
+
+  `compression_type` is "" or None (no compression), "GZIP" or "ZLIB", the
+  same strings that `tf.data.TFRecordDataset` takes.
+  """
+  if not compression_type:
+    return None
+  compression_types = {
+      "GZIP": tf.python_io.TFRecordCompressionType.GZIP,
+      "ZLIB": tf.python_io.TFRecordCompressionType.ZLIB,
+  }
+  if compression_type not in compression_types:
+    raise ValueError("Unsupported TFRecord compression type: %s" %
+                     compression_type)
+  return tf.python_io.TFRecordOptions(compression_types[compression_type])
+
+
 def whitespace_tokenize(text):
   """Runs basic whitespace cleaning and splitting on a peice of text."""
   text = text.strip()
@@ -110,26 +369,214 @@ def whitespace_tokenize(text):
 class FullTokenizer(object):
   """Runs end-to-end tokenziation."""
 
-  def __init__(self, vocab_file, do_lower_case=True):
+  def __init__(self, vocab_file, do_lower_case=True, cache_size=65536):
+    """Constructs a FullTokenizer.
+
+    Args:
+      vocab_file: The vocabulary file.
+      do_lower_case: Whether to lower case the input.
+      cache_size: Maximum number of basic tokens whose word pieces are
+        memoized in an LRU cache. Set to 0 to disable the cache.
+    """
+    self.vocab_file = vocab_file
+    self.do_lower_case = do_lower_case
+    self.cache_size = cache_size
     self.vocab = load_vocab(vocab_file)
-    self.inv_vocab = {v: k for k, v in self.vocab.items()}
+    self.inv_vocab = invert_vocab(self.vocab)
     self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
     self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+    self.wordpiece_cache = None
+    if cache_size > 0:
+      self.wordpiece_cache = WordpieceCache(cache_size)
 
   def tokenize(self, text):
     split_tokens = []
     for token in self.basic_tokenizer.tokenize(text):
-      for sub_token in self.wordpiece_tokenizer.tokenize(token):
-        split_tokens.append(sub_token)
+      (sub_tokens, _) = self._tokenize_word(token)
+      split_tokens.extend(sub_tokens)
 
     return split_tokens
 
+  def tokenize_with_offsets(self, text):
+    """Tokenizes a piece of text and tracks where each word piece came from.
+
+    Args:
+      text: The text to tokenize.
+
+    Returns:
+      A tuple (tokens, offsets), where `tokens` is the same as `tokenize(text)`
+      and `offsets[i]` is the (start, end) span in `convert_to_unicode(text)`
+      of the characters that produced `tokens[i]`.
+    """
+    (tokens, _, offsets) = self._encode_with_offsets(text)
+    return (tokens, offsets)
+
+  def encode(self, text, return_offsets=False):
+    """Converts a piece of text directly to word piece ids.
+
+    This is equivalent to `convert_tokens_to_ids(tokenize(text))`, but takes
+    the ids straight from the word piece matcher.
+
+    Args:
+      text: The text to encode.
+      return_offsets: Whether to also return the character span of each word
+        piece.
+
+    Returns:
+      A list of ids. If `return_offsets` is True, a tuple (ids, offsets) where
+      `offsets[i]` is the (start, end) span in `convert_to_unicode(text)` of
+      the characters that produced `ids[i]`.
+    """
+    if return_offsets:
+      (_, ids, offsets) = self._encode_with_offsets(text)
+      return (ids, offsets)
+
+    ids = []
+    for token in self.basic_tokenizer.tokenize(text):
+      (_, sub_ids) = self._tokenize_word(token)
+      ids.extend(sub_ids)
+    return ids
+
+  def tokenize_batch(self, texts, num_workers=1, chunk_size=256):
+    """Tokenizes a sequence of texts, optionally in a pool of processes.
+
+    Args:
+      texts: An iterable of texts.
+      num_workers: Number of worker processes. With 1 or fewer, the texts are
+        tokenized in this process.
+      chunk_size: Number of texts sent to a worker at a time.
+
+    Returns:
+      A list with `tokenize(text)` for each text, in input order.
+    """
+    return self._run_batch("tokenize", texts, num_workers, chunk_size)
+
+  def encode_batch(self, texts, num_workers=1, chunk_size=256):
+    """Like `tokenize_batch`, but returns `encode(text)` for each text."""
+    return self._run_batch("encode", texts, num_workers, chunk_size)
+
   def convert_tokens_to_ids(self, tokens):
     return convert_by_vocab(self.vocab, tokens)
 
   def convert_ids_to_tokens(self, ids):
     return convert_by_vocab(self.inv_vocab, ids)
 
+  def _run_batch(self, method_name, texts, num_workers, chunk_size):
+    """Applies `method_name` to every text, sharded across processes."""
+    if num_workers <= 1:
+      method = getattr(self, method_name)
+      return [method(text) for text in texts]
+
+    # Each worker builds its own tokenizer once, so only the texts and the
+    # results are sent between processes.
+    pool = multiprocessing.Pool(
+        num_workers,
+        initializer=_init_batch_worker,
+        initargs=(self.vocab_file, self.do_lower_case, self.cache_size))
+    try:
+      output = []
+      tasks = ((method_name, chunk) for chunk in _chunks(texts, chunk_size))
+      for results in pool.imap(_run_batch_chunk, tasks):
+        output.extend(results)
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+    return output
+
+  def _encode_with_offsets(self, text):
+    """Returns the word pieces, ids and character spans of a piece of text."""
+    tokens = []
+    ids = []
+    offsets = []
+    for (token, char_spans) in self.basic_tokenizer.tokenize_with_char_spans(
+        text):
+      (sub_tokens, sub_ids) = self._tokenize_word(token)
+      tokens.extend(sub_tokens)
+      ids.extend(sub_ids)
+      offsets.extend(_get_wordpiece_offsets(sub_tokens, char_spans))
+    return (tokens, ids, offsets)
+
+  def _tokenize_word(self, token):
+    """Returns the (word pieces, ids) of a single basic token."""
+    if self.wordpiece_cache is not None:
+      entry = self.wordpiece_cache.get(token)
+      if entry is not None:
+        return entry
+
+    (sub_tokens, sub_ids) = self.wordpiece_tokenizer.tokenize_word(token)
+    entry = (tuple(sub_tokens), tuple(sub_ids))
+
+    if self.wordpiece_cache is not None:
+      self.wordpiece_cache.put(token, entry)
+    return entry
+
+
+# The tokenizer of a `FullTokenizer.tokenize_batch` worker process.
+_batch_worker_tokenizer = None
+
+
+def _init_batch_worker(vocab_file, do_lower_case, cache_size):
+  global _batch_worker_tokenizer
+  _batch_worker_tokenizer = FullTokenizer(
+      vocab_file, do_lower_case=do_lower_case, cache_size=cache_size)
+
+
+def _run_batch_chunk(task):
+  (method_name, texts) = task
+  method = getattr(_batch_worker_tokenizer, method_name)
+  return [method(text) for text in texts]
+
+
+def _chunks(iterable, chunk_size):
+  """Yields successive lists of at most `chunk_size` items of `iterable`."""
+  iterator = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(iterator, chunk_size))
+    if not chunk:
+      return
+    yield chunk
+
+
+class WordpieceCache(object):
+  """Bounded least-recently-used cache from basic tokens to word pieces."""
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = collections.OrderedDict()
+
+  def get(self, key):
+    """Returns the cached value for `key`, or None if it is not cached."""
+    value = self._entries.pop(key, None)
+    if value is None:
+      self.misses += 1
+      return None
+    # Re-inserting moves the entry to the most-recently-used end.
+    self._entries[key] = value
+    self.hits += 1
+    return value
+
+  def put(self, key, value):
+    """Caches `value` for `key`, evicting the least-recently-used entry."""
+    if key in self._entries:
+      del self._entries[key]
+    elif len(self._entries) >= self.max_size:
+      self._entries.popitem(last=False)
+      self.evictions += 1
+    self._entries[key] = value
+
+  def clear(self):
+    self._entries.clear()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self._entries)
+
 
 class BasicTokenizer(object):
   """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
@@ -145,6 +592,9 @@ class BasicTokenizer(object):
   def tokenize(self, text):
     """Tokenizes a piece of text."""
     text = convert_to_unicode(text)
+    if _is_ascii(text):
+      return self._tokenize_ascii(text)
+
     text = self._clean_text(text)
 
     # This was added on November 1st, 2018 for the multilingual and Chinese
@@ -166,13 +616,98 @@ class BasicTokenizer(object):
     output_tokens = whitespace_tokenize(" ".join(split_tokens))
     return output_tokens
 
+  def tokenize_with_char_spans(self, text):
+    """Tokenizes a piece of text, keeping track of the original characters.
+
+    The tokens are the same as `tokenize(text)`.
+
+    Args:
+      text: The text to tokenize.
+
+    Returns:
+      A list of (token, char_spans) tuples, where `char_spans[i]` is the
+      (start, end) span in `convert_to_unicode(text)` of the character that
+      produced `token[i]`. If lower casing or accent stripping cannot be
+      attributed to individual characters (e.g. a final sigma), every
+      character of the affected word gets the span of the whole word.
+    """
+    text = convert_to_unicode(text)
+
+    output = []
+    word_chars = []
+    word_positions = []
+    for (i, char) in enumerate(text):
+      char_class = _char_class(char)
+      # Invalid characters are removed without splitting the word.
+      if char_class & _INVALID:
+        continue
+      if (char_class & (_WHITESPACE | _CHINESE)) or char.isspace():
+        if word_chars:
+          output.extend(self._split_word_with_char_spans(
+              word_chars, word_positions))
+          word_chars = []
+          word_positions = []
+        if char_class & _CHINESE:
+          output.extend(self._split_word_with_char_spans([char], [i]))
+        continue
+      word_chars.append(char)
+      word_positions.append(i)
+    if word_chars:
+      output.extend(
+          self._split_word_with_char_spans(word_chars, word_positions))
+    return output
+
+  def _split_word_with_char_spans(self, chars, positions):
+    """Normalizes and splits a single whitespace-delimited word."""
+    word = "".join(chars)
+    if self.do_lower_case:
+      normalized = self._run_strip_accents(word.lower())
+      char_pieces = [self._run_strip_accents(char.lower()) for char in chars]
+      if "".join(char_pieces) == normalized:
+        char_spans = []
+        for (piece, position) in zip(char_pieces, positions):
+          char_spans.extend([(position, position + 1)] * len(piece))
+      else:
+        char_spans = [(positions[0], positions[-1] + 1)] * len(normalized)
+    else:
+      normalized = word
+      char_spans = [(position, position + 1) for position in positions]
+
+    # This is `_run_split_on_punc` followed by `whitespace_tokenize`.
+    output = []
+    start = None
+    for (i, char) in enumerate(normalized):
+      is_space = char.isspace()
+      if is_space or _char_class(char) & _PUNCTUATION:
+        if start is not None:
+          output.append((normalized[start:i], char_spans[start:i]))
+          start = None
+        if not is_space:
+          output.append((char, char_spans[i:i + 1]))
+      elif start is None:
+        start = i
+    if start is not None:
+      output.append((normalized[start:], char_spans[start:]))
+    return output
+
+  def _tokenize_ascii(self, text):
+    """Tokenizes a piece of pure-ASCII text.
+
+    ASCII text has no accents or CJK characters, so cleanup and punctuation
+    splitting reduce to a single `translate` call. The output is identical to
+    the general path in `tokenize`.
+    """
+    text = text.translate(_ASCII_TRANSLATE_TABLE)
+    if self.do_lower_case:
+      text = text.lower()
+    return text.split()
+
   def _run_strip_accents(self, text):
     """Strips accents from a piece of text."""
     text = unicodedata.normalize("NFD", text)
     output = []
     for char in text:
-      cat = unicodedata.category(char)
-      if cat == "Mn":
+      if _char_class(char) & _NONSPACING_MARK:
         continue
       output.append(char)
     return "".join(output)
@@ -185,7 +720,7 @@ class BasicTokenizer(object):
     output = []
     while i < len(chars):
       char = chars[i]
-      if _is_punctuation(char):
+      if _char_class(char) & _PUNCTUATION:
         output.append([char])
         start_new_word = True
       else:
@@ -201,8 +736,7 @@ class BasicTokenizer(object):
     """Adds whitespace around any CJK character."""
     output = []
     for char in text:
-      cp = ord(char)
-      if self._is_chinese_char(cp):
+      if _char_class(char) & _CHINESE:
         output.append(" ")
         output.append(char)
         output.append(" ")
@@ -212,34 +746,16 @@ class BasicTokenizer(object):
 
   def _is_chinese_char(self, cp):
     """Checks whether CP is the codepoint of a CJK character."""
-    # This defines a "chinese character" as anything in the CJK Unicode block:
-    #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
-    #
-    # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
-    # despite its name. The modern Korean Hangul alphabet is a different block,
-    # as is Japanese Hiragana and Katakana. Those alphabets are used to write
-    # space-separated words, so they are not treated specially and handled
-    # like the all of the other languages.
-    if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
-        (cp >= 0x3400 and cp <= 0x4DBF) or  #
-        (cp >= 0x20000 and cp <= 0x2A6DF) or  #
-        (cp >= 0x2A700 and cp <= 0x2B73F) or  #
-        (cp >= 0x2B740 and cp <= 0x2B81F) or  #
-        (cp >= 0x2B820 and cp <= 0x2CEAF) or
-        (cp >= 0xF900 and cp <= 0xFAFF) or  #
-        (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
-      return True
-
-    return False
+    return _is_chinese_char(cp)
 
   def _clean_text(self, text):
     """Performs invalid character removal and whitespace cleanup on text."""
     output = []
     for char in text:
-      cp = ord(char)
-      if cp == 0 or cp == 0xfffd or _is_control(char):
+      char_class = _char_class(char)
+      if char_class & _INVALID:
         continue
-      if _is_whitespace(char):
+      if char_class & _WHITESPACE:
         output.append(" ")
       else:
         output.append(char)
@@ -254,6 +770,29 @@ class WordpieceTokenizer(object):
     self.unk_token = unk_token
     self.max_input_chars_per_word = max_input_chars_per_word
 
+    # The greedy longest-match-first search is run over two character tries
+    # built once from the vocab: one over every vocab entry (used at the start
+    # of a word) and one over the "##" continuation entries with the prefix
+    # stripped (used everywhere else). This avoids building a candidate
+    # substring for every possible end position. Each entry stores the id so
+    # that ids come straight out of the match. A `CompiledVocab` already
+    # contains both tries.
+    if isinstance(vocab, CompiledVocab):
+      self._word_start_trie = vocab.word_start_trie
+      self._word_continuation_trie = vocab.word_continuation_trie
+    else:
+      self._word_start_trie = _DictTrie(vocab.items())
+      self._word_continuation_trie = _DictTrie(
+          [(token[2:], index)
+           for (token, index) in vocab.items()
+           if token.startswith("##")])
+
+  def __reduce__(self):
+    # The tries of a `CompiledVocab` are views of its memory map, so they are
+    # taken from the vocab again when unpickled.
+    return (WordpieceTokenizer, (self.vocab, self.unk_token,
+                                 self.max_input_chars_per_word))
+
   def tokenize(self, text):
     """Tokenizes a piece of text into its word pieces.
 
@@ -276,36 +815,200 @@ class WordpieceTokenizer(object):
 
     output_tokens = []
     for token in whitespace_tokenize(text):
-      chars = list(token)
-      if len(chars) > self.max_input_chars_per_word:
-        output_tokens.append(self.unk_token)
-        continue
+      (sub_tokens, _) = self.tokenize_word(token)
+      output_tokens.extend(sub_tokens)
+    return output_tokens
+
+  def tokenize_word(self, token):
+    """Tokenizes a single word into its word pieces and their ids.
 
-      is_bad = False
-      start = 0
-      sub_tokens = []
-      while start < len(chars):
-        end = len(chars)
-        cur_substr = None
-        while start < end:
-          substr = "".join(chars[start:end])
-          if start > 0:
-            substr = "##" + substr
-          if substr in self.vocab:
-            cur_substr = substr
-            break
-          end -= 1
-        if cur_substr is None:
-          is_bad = True
-          break
-        sub_tokens.append(cur_substr)
-        start = end
-
-      if is_bad:
-        output_tokens.append(self.unk_token)
+    Args:
+      token: A single token without whitespace, which should have already been
+        passed through `BasicTokenizer`.
+
+    Returns:
+      A tuple (sub_tokens, sub_ids) of lists. The id of the unknown token is
+      None if it is not in the vocabulary.
+    """
+    if len(token) <= self.max_input_chars_per_word:
+      matches = self._longest_match(token)
+      if matches is not None:
+        return matches
+    return ([self.unk_token], [self.vocab.get(self.unk_token)])
+
+  def _longest_match(self, token):
+    """Splits a word into (tokens, ids), or returns None if impossible."""
+    num_chars = len(token)
+    start = 0
+    sub_tokens = []
+    sub_ids = []
+    while start < num_chars:
+      if start == 0:
+        (token_id, end) = self._word_start_trie.longest_prefix(token, start)
       else:
-        output_tokens.extend(sub_tokens)
-    return output_tokens
+        (token_id, end) = self._word_continuation_trie.longest_prefix(
+            token, start)
+      if token_id is None:
+        return None
+      if start == 0:
+        sub_tokens.append(token[:end])
+      else:
+        sub_tokens.append("##" + token[start:end])
+      sub_ids.append(token_id)
+      start = end
+    return (sub_tokens, sub_ids)
+
+
+def _get_wordpiece_offsets(sub_tokens, char_spans):
+  """Returns the (start, end) character span of each word piece of a word."""
+  lengths = [len(sub_tokens[0])] + [len(x) - 2 for x in sub_tokens[1:]]
+  if sum(lengths) != len(char_spans):
+    # The word was replaced by the unknown token.
+    return [(char_spans[0][0], char_spans[-1][1])] * len(sub_tokens)
+
+  offsets = []
+  start = 0
+  for length in lengths:
+    offsets.append((char_spans[start][0], char_spans[start + length - 1][1]))
+    start += length
+  return offsets
+
+
+# Key under which a trie node stores the vocab entry that ends at that node.
+# Characters are always length-1 strings, so this can never collide with one.
+_TRIE_END = None
+
+
+class _DictTrie(object):
+  """A character trie of nested dicts, built from (key, value) pairs."""
+
+  def __init__(self, items):
+    self._root = {}
+    for (key, value) in items:
+      if not key:
+        continue
+      node = self._root
+      for char in key:
+        node = node.setdefault(char, {})
+      node[_TRIE_END] = value
+
+  def longest_prefix(self, text, start):
+    """Returns the (value, end) of the longest key that is `text[start:end]`.
+
+    The value is None if no key starts at `start`.
+    """
+    node = self._root
+    value = None
+    end = start
+    for i in range(start, len(text)):
+      node = node.get(text[i])
+      if node is None:
+        break
+      if _TRIE_END in node:
+        value = node[_TRIE_END]
+        end = i + 1
+    return (value, end)
+
+
+class _FlatTrie(object):
+  """A character trie stored in flat arrays (see `compile_vocab`)."""
+
+  def __init__(self, node_values, slot_parents, slot_chars, slot_children):
+    self._node_values = node_values
+    self._slot_parents = slot_parents
+    self._slot_chars = slot_chars
+    self._slot_children = slot_children
+    self._mask = len(slot_parents) - 1
+
+  def get(self, key):
+    """Returns the value of `key`, or None."""
+    node = 0
+    for char in key:
+      node = self._get_child(node, ord(char))
+      if node is None:
+        return None
+    value = self._node_values[node]
+    if not value:
+      return None
+    return value - 1
+
+  def longest_prefix(self, text, start):
+    """Like `_DictTrie.longest_prefix`."""
+    # This is `_get_child` inlined, since it runs for every character.
+    node_values = self._node_values
+    slot_parents = self._slot_parents
+    slot_chars = self._slot_chars
+    slot_children = self._slot_children
+    mask = self._mask
+    value = None
+    end = start
+    node = 0
+    for i in range(start, len(text)):
+      char = ord(text[i])
+      slot = (node * _TRIE_HASH_MULTIPLIER ^ char) & mask
+      parent = slot_parents[slot]
+      while parent and (parent != node + 1 or slot_chars[slot] != char):
+        slot = (slot + 1) & mask
+        parent = slot_parents[slot]
+      if not parent:
+        break
+      node = slot_children[slot]
+      node_value = node_values[node]
+      if node_value:
+        value = node_value - 1
+        end = i + 1
+    return (value, end)
+
+  def _get_child(self, node, char):
+    slot_parents = self._slot_parents
+    slot = (node * _TRIE_HASH_MULTIPLIER ^ char) & self._mask
+    while True:
+      parent = slot_parents[slot]
+      if not parent:
+        return None
+      if parent == node + 1 and self._slot_chars[slot] == char:
+        return self._slot_children[slot]
+      slot = (slot + 1) & self._mask
+
+
+def _build_flat_trie(items):
+  """Returns the arrays of a `_FlatTrie` of (key, value) pairs.
+
+  Unlike `_DictTrie`, an empty key is stored at the root, so that `get` finds
+  every key.
+  """
+  node_values = [0]
+  edges = []
+  children = [{}]
+  for (key, value) in items:
+    node = 0
+    for char in key:
+      child = children[node].get(char)
+      if child is None:
+        child = len(node_values)
+        children[node][char] = child
+        children.append({})
+        node_values.append(0)
+        edges.append((node, ord(char), child))
+      node = child
+    node_values[node] = value + 1
+
+  # The hash table is at most half full, so probe sequences stay short.
+  num_slots = 1
+  while num_slots < 2 * len(edges):
+    num_slots *= 2
+  mask = num_slots - 1
+  slot_parents = [0] * num_slots
+  slot_chars = [0] * num_slots
+  slot_children = [0] * num_slots
+  for (parent, char, child) in edges:
+    slot = (parent * _TRIE_HASH_MULTIPLIER ^ char) & mask
+    while slot_parents[slot]:
+      slot = (slot + 1) & mask
+    slot_parents[slot] = parent + 1
+    slot_chars[slot] = char
+    slot_children[slot] = child
+  return (node_values, slot_parents, slot_chars, slot_children)
 
 
 def _is_whitespace(char):
@@ -346,3 +1049,102 @@ def _is_punctuation(char):
   if cat.startswith("P"):
     return True
   return False
+
+
+def _is_chinese_char(cp):
+  """Checks whether CP is the codepoint of a CJK character."""
+  # This defines a "chinese character" as anything in the CJK Unicode block:
+  #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
+  #
+  # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
+  # despite its name. The modern Korean Hangul alphabet is a different block,
+  # as is Japanese Hiragana and Katakana. Those alphabets are used to write
+  # space-separated words, so they are not treated specially and handled
+  # like the all of the other languages.
+  if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
+      (cp >= 0x3400 and cp <= 0x4DBF) or  #
+      (cp >= 0x20000 and cp <= 0x2A6DF) or  #
+      (cp >= 0x2A700 and cp <= 0x2B73F) or  #
+      (cp >= 0x2B740 and cp <= 0x2B81F) or  #
+      (cp >= 0x2B820 and cp <= 0x2CEAF) or
+      (cp >= 0xF900 and cp <= 0xFAFF) or  #
+      (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
+    return True
+
+  return False
+
+
+# Bit flags for the character classes used by `BasicTokenizer`.
+_WHITESPACE = 1
+_CONTROL = 2
+_PUNCTUATION = 4
+_CHINESE = 8
+_NONSPACING_MARK = 16
+# Characters removed by `BasicTokenizer._clean_text`: NUL, the replacement
+# character and control characters.
+_INVALID = 32
+
+
+def _compute_char_class(cp):
+  """Computes the character class bit flags of a codepoint."""
+  char = six.unichr(cp)
+  char_class = 0
+  if _is_whitespace(char):
+    char_class |= _WHITESPACE
+  if _is_control(char):
+    char_class |= _CONTROL
+  if _is_punctuation(char):
+    char_class |= _PUNCTUATION
+  if _is_chinese_char(cp):
+    char_class |= _CHINESE
+  if unicodedata.category(char) == "Mn":
+    char_class |= _NONSPACING_MARK
+  if cp == 0 or cp == 0xfffd or char_class & _CONTROL:
+    char_class |= _INVALID
+  return char_class
+
+
+# The character classes of the Basic Multilingual Plane are computed once at
+# import time so that they can be looked up with a single index. Codepoints in
+# the higher planes are rare, so they fall back to `_compute_char_class`.
+_CHAR_CLASS_TABLE_SIZE = 0x10000
+_CHAR_CLASS_TABLE = bytearray(
+    [_compute_char_class(cp) for cp in range(_CHAR_CLASS_TABLE_SIZE)])
+
+
+def _char_class(char):
+  """Returns the character class bit flags of `char`."""
+  cp = ord(char)
+  if cp < _CHAR_CLASS_TABLE_SIZE:
+    return _CHAR_CLASS_TABLE[cp]
+  return _compute_char_class(cp)
+
+
+def _is_ascii(text):
+  """Checks whether a unicode string only contains ASCII characters."""
+  try:
+    text.encode("ascii")
+  except UnicodeError:
+    return False
+  return True
+
+
+def _build_ascii_translate_table():
+  """Builds the `translate` table used by `BasicTokenizer._tokenize_ascii`.
+
+  Invalid characters are removed, whitespace becomes a space and punctuation
+  is surrounded by spaces so that a whitespace split separates it out.
+  """
+  table = {}
+  for cp in range(128):
+    char_class = _CHAR_CLASS_TABLE[cp]
+    if char_class & _INVALID:
+      table[cp] = None
+    elif char_class & _WHITESPACE:
+      table[cp] = u" "
+    elif char_class & _PUNCTUATION:
+      table[cp] = u" " + six.unichr(cp) + u" "
+  return table
+
+
+_ASCII_TRANSLATE_TABLE = _build_ascii_translate_table()
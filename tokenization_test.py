@@ -17,8 +17,12 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import pickle
+import sys
 import tempfile
+import unicodedata
 
+import six
 import tokenization
 import tensorflow as tf
 
@@ -44,6 +48,166 @@ class TokenizationTest(tf.test.TestCase):
     self.assertAllEqual(
         tokenizer.convert_tokens_to_ids(tokens), [7, 4, 5, 10, 8, 9])
 
+  def test_full_tokenizer_encode(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ","
+    ]
+    vocab_file = self._write_vocab_file(vocab_tokens)
+
+    tokenizer = tokenization.FullTokenizer(vocab_file)
+    os.unlink(vocab_file)
+
+    text = u"UNwant\u00E9d,running  w\u00E0nte"
+    self.assertAllEqual(
+        tokenizer.encode(text),
+        tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text)))
+
+    (ids, offsets) = tokenizer.encode(text, return_offsets=True)
+    self.assertAllEqual(ids, [7, 4, 5, 10, 8, 9, 0])
+    self.assertAllEqual(
+        offsets, [(0, 2), (2, 6), (6, 8), (8, 9), (9, 13), (13, 16),
+                  (18, 23)])
+
+  def test_basic_tokenizer_char_spans(self):
+    tokenizer = tokenization.BasicTokenizer(do_lower_case=True)
+
+    text = u" H\u00E9l\x05lo,  \u535Aw\u0301orld "
+    tokens_with_spans = tokenizer.tokenize_with_char_spans(text)
+    self.assertAllEqual(
+        [x[0] for x in tokens_with_spans], tokenizer.tokenize(text))
+    self.assertAllEqual(tokens_with_spans, [
+        (u"hello", [(1, 2), (2, 3), (3, 4), (5, 6), (6, 7)]),
+        (u",", [(7, 8)]),
+        (u"\u535A", [(10, 11)]),
+        (u"world", [(11, 12), (13, 14), (14, 15), (15, 16), (16, 17)]),
+    ])
+
+  def test_full_tokenizer_batch(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ","
+    ]
+    vocab_file = self._write_vocab_file(vocab_tokens)
+
+    tokenizer = tokenization.FullTokenizer(vocab_file)
+    texts = [u"UNwant\u00E9d,running %d" % i for i in range(10)]
+    tokens = tokenizer.tokenize_batch(texts, num_workers=2, chunk_size=3)
+    ids = tokenizer.encode_batch(texts, num_workers=2, chunk_size=3)
+    os.unlink(vocab_file)
+
+    self.assertAllEqual(tokens, [tokenizer.tokenize(x) for x in texts])
+    self.assertAllEqual(ids, [tokenizer.encode(x) for x in texts])
+    self.assertAllEqual(tokenizer.tokenize_batch(texts), tokens)
+
+  def test_compiled_vocab(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ",", u"\u00E9", "", "##", "wa"
+    ]
+    vocab_file = self._write_vocab_file(vocab_tokens)
+    text_vocab = tokenization.load_vocab(vocab_file)
+    text_tokenizer = tokenization.FullTokenizer(vocab_file)
+
+    compiled_vocab_file = tokenization.compile_vocab(vocab_file)
+    self.assertEqual(compiled_vocab_file,
+                     tokenization.get_compiled_vocab_file(vocab_file))
+    vocab = tokenization.load_vocab(vocab_file)
+    self.assertIsInstance(vocab, tokenization.CompiledVocab)
+    self.assertAllEqual(list(vocab.items()), list(text_vocab.items()))
+    self.assertAllEqual(list(vocab), list(text_vocab))
+    self.assertEqual(len(vocab), len(text_vocab))
+    for token in text_vocab:
+      self.assertIn(token, vocab)
+      self.assertEqual(vocab[token], text_vocab[token])
+    for token in ["w", "want##", "##wa", u"\u00E9\u00E9"]:
+      self.assertNotIn(token, vocab)
+      self.assertIsNone(vocab.get(token))
+
+    tokenizer = tokenization.FullTokenizer(vocab_file)
+    text = u"UNwant\u00E9d,running wa ##ing xyz \u00E9"
+    self.assertAllEqual(tokenizer.tokenize(text), text_tokenizer.tokenize(text))
+    self.assertAllEqual(tokenizer.encode(text), text_tokenizer.encode(text))
+    ids = list(range(len(vocab_tokens)))
+    del ids[6]  # The first "wa" is shadowed by the second one.
+    self.assertAllEqual(tokenizer.convert_ids_to_tokens(ids),
+                        text_tokenizer.convert_ids_to_tokens(ids))
+    with self.assertRaises(KeyError):
+      tokenizer.convert_ids_to_tokens([6])
+
+    # The compiled vocab is mapped again when a tokenizer is unpickled.
+    unpickled_tokenizer = pickle.loads(pickle.dumps(tokenizer))
+    self.assertIsInstance(unpickled_tokenizer.vocab,
+                          tokenization.CompiledVocab)
+    self.assertAllEqual(list(unpickled_tokenizer.vocab.items()),
+                        list(text_vocab.items()))
+    self.assertAllEqual(unpickled_tokenizer.tokenize(text),
+                        text_tokenizer.tokenize(text))
+    self.assertAllEqual(unpickled_tokenizer.encode(text),
+                        text_tokenizer.encode(text))
+    self.assertAllEqual(unpickled_tokenizer.convert_ids_to_tokens(ids),
+                        text_tokenizer.convert_ids_to_tokens(ids))
+
+    os.unlink(compiled_vocab_file)
+    # Without the compiled vocab, the text vocab is loaded instead.
+    unpickled_tokenizer = pickle.loads(pickle.dumps(tokenizer))
+    self.assertNotIsInstance(unpickled_tokenizer.vocab,
+                             tokenization.CompiledVocab)
+    self.assertAllEqual(unpickled_tokenizer.encode(text),
+                        text_tokenizer.encode(text))
+    self.assertAllEqual(unpickled_tokenizer.convert_ids_to_tokens(ids),
+                        text_tokenizer.convert_ids_to_tokens(ids))
+
+    os.unlink(vocab_file)
+
+  def test_full_tokenizer_cache(self):
+    vocab_tokens = [
+        "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+        "##ing", ","
+    ]
+    vocab_file = self._write_vocab_file(vocab_tokens)
+
+    tokenizer = tokenization.FullTokenizer(vocab_file, cache_size=2)
+    uncached_tokenizer = tokenization.FullTokenizer(vocab_file, cache_size=0)
+    os.unlink(vocab_file)
+
+    self.assertIsNone(uncached_tokenizer.wordpiece_cache)
+
+    text = u"UNwant\u00E9d,running unwanted running, unwanted"
+    self.assertAllEqual(
+        tokenizer.tokenize(text), uncached_tokenizer.tokenize(text))
+    self.assertAllEqual(
+        tokenizer.tokenize(text), uncached_tokenizer.tokenize(text))
+
+    cache = tokenizer.wordpiece_cache
+    self.assertEqual(len(cache), 2)
+    self.assertGreater(cache.hits, 0)
+    self.assertGreater(cache.evictions, 0)
+    self.assertEqual(cache.hits + cache.misses, 14)
+
+  def test_wordpiece_cache(self):
+    cache = tokenization.WordpieceCache(max_size=2)
+
+    cache.put("a", 1)
+    cache.put("b", 2)
+    self.assertEqual(cache.get("a"), 1)
+    cache.put("c", 3)
+
+    # "b" was the least recently used entry.
+    self.assertIsNone(cache.get("b"))
+    self.assertEqual(cache.get("a"), 1)
+    self.assertEqual(cache.get("c"), 3)
+    self.assertEqual(len(cache), 2)
+    self.assertEqual(cache.hits, 3)
+    self.assertEqual(cache.misses, 1)
+    self.assertEqual(cache.evictions, 1)
+
+  def _write_vocab_file(self, vocab_tokens):
+    with tempfile.NamedTemporaryFile(delete=False) as vocab_writer:
+      vocab_writer.write(
+          "".join([x + "\n" for x in vocab_tokens]).encode("utf-8"))
+      return vocab_writer.name
+
   def test_chinese(self):
     tokenizer = tokenization.BasicTokenizer()
 
@@ -59,6 +223,20 @@ class TokenizationTest(tf.test.TestCase):
         ["hello", "!", "how", "are", "you", "?"])
     self.assertAllEqual(tokenizer.tokenize(u"H\u00E9llo"), ["hello"])
 
+  def test_basic_tokenizer_ascii(self):
+    tokenizer = tokenization.BasicTokenizer(do_lower_case=True)
+
+    # Pure-ASCII text takes the fast path, so it must agree with the same
+    # text once a non-ASCII character forces the general path.
+    text = u"\x00Do\x05n't STOP\x0b(now)\r\n--at 3.14$!"
+    self.assertAllEqual(
+        tokenizer.tokenize(text),
+        ["don", "'", "t", "stop", "(", "now", ")", "-", "-", "at", "3", ".",
+         "14", "$", "!"])
+    self.assertAllEqual(
+        tokenizer.tokenize(text + u"\u00E9"),
+        tokenizer.tokenize(text + u" e"))
+
   def test_basic_tokenizer_no_lower(self):
     tokenizer = tokenization.BasicTokenizer(do_lower_case=False)
 
@@ -86,6 +264,24 @@ class TokenizationTest(tf.test.TestCase):
     self.assertAllEqual(
         tokenizer.tokenize("unwantedX running"), ["[UNK]", "runn", "##ing"])
 
+  def test_wordpiece_tokenizer_longest_match(self):
+    vocab_tokens = [
+        "[UNK]", "a", "ab", "abc", "##b", "##bc", "##c", "##d", "##abcd", "##"
+    ]
+
+    vocab = {}
+    for (i, token) in enumerate(vocab_tokens):
+      vocab[token] = i
+    tokenizer = tokenization.WordpieceTokenizer(
+        vocab=vocab, max_input_chars_per_word=8)
+
+    self.assertAllEqual(tokenizer.tokenize("abcd"), ["abc", "##d"])
+    self.assertAllEqual(tokenizer.tokenize("aabcd"), ["a", "##abcd"])
+    self.assertAllEqual(tokenizer.tokenize("abbc"), ["ab", "##bc"])
+    self.assertAllEqual(tokenizer.tokenize("abce"), ["[UNK]"])
+    self.assertAllEqual(tokenizer.tokenize("b"), ["[UNK]"])
+    self.assertAllEqual(tokenizer.tokenize("abcdabcda"), ["[UNK]"])
+
   def test_convert_tokens_to_ids(self):
     vocab_tokens = [
         "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
@@ -127,6 +323,42 @@ class TokenizationTest(tf.test.TestCase):
     self.assertFalse(tokenization._is_punctuation(u"A"))
     self.assertFalse(tokenization._is_punctuation(u" "))
 
+  def test_char_class_matches_predicates(self):
+    tokenizer = tokenization.BasicTokenizer()
+    for cp in range(sys.maxunicode + 1):
+      char = six.unichr(cp)
+      char_class = tokenization._char_class(char)
+      self.assertEqual(
+          bool(char_class & tokenization._WHITESPACE),
+          tokenization._is_whitespace(char))
+      self.assertEqual(
+          bool(char_class & tokenization._CONTROL),
+          tokenization._is_control(char))
+      self.assertEqual(
+          bool(char_class & tokenization._PUNCTUATION),
+          tokenization._is_punctuation(char))
+      self.assertEqual(
+          bool(char_class & tokenization._CHINESE),
+          tokenizer._is_chinese_char(cp))
+      self.assertEqual(
+          bool(char_class & tokenization._NONSPACING_MARK),
+          unicodedata.category(char) == "Mn")
+      self.assertEqual(
+          bool(char_class & tokenization._INVALID),
+          cp == 0 or cp == 0xfffd or tokenization._is_control(char))
+
+  def test_get_tfrecord_options(self):
+    self.assertIsNone(tokenization.get_tfrecord_options(""))
+    self.assertIsNone(tokenization.get_tfrecord_options(None))
+    self.assertEqual(
+        tokenization.get_tfrecord_options("GZIP").compression_type,
+        tf.python_io.TFRecordCompressionType.GZIP)
+    self.assertEqual(
+        tokenization.get_tfrecord_options("ZLIB").compression_type,
+        tf.python_io.TFRecordCompressionType.ZLIB)
+    with self.assertRaises(ValueError):
+      tokenization.get_tfrecord_options("LZ4")
+
 
 if __name__ == "__main__":
   tf.test.main()